@@ -1,25 +1,21 @@
 import os
+import sys
 import glob
+import json
+import uuid
 import argparse
-from pypdf import PdfWriter
+import toml
+from pypdf import PdfReader, PdfWriter
 
-def main():
-    parser = argparse.ArgumentParser(description="Concatenate individual PDF reports into a single file.")
-    parser.add_argument("--dropbox_dir", default=os.path.expanduser("~/Dropbox"), help="The base directory where the individual reports are saved.")
-    parser.add_argument("--output_file", default="consolidated_report.pdf", help="The name of the final concatenated PDF file.")
-    args = parser.parse_args()
-
-    dropbox_dir = args.dropbox_dir
-    output_file = os.path.join(dropbox_dir, args.output_file)
-
-    if not os.path.isdir(dropbox_dir):
-        print(f"Error: Dropbox directory not found at {dropbox_dir}")
-        return
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils"))
+import derivatives_catalog
 
-    merger = PdfWriter()
-    report_files_to_merge = []
+# Input signatures of the consolidated reports, kept in dropbox_dir so unchanged reports are not rewritten.
+MANIFEST_NAME = ".concatenate_manifest.json"
 
-    print("Scanning for reports to concatenate...")
+def find_reports(dropbox_dir):
+    """The per-subject reports in consolidation order, with the outline entry (subject, session, title) of each."""
+    reports = []
 
     subject_folders = glob.glob(os.path.join(dropbox_dir, 'sub-AL*'))
     subject_folders.extend(glob.glob(os.path.join(dropbox_dir, 'sub-MD*')))
@@ -33,18 +29,18 @@ def main():
             session_folder = os.path.join(subject_folder, session_name)
             if not os.path.isdir(session_folder) or not session_name.startswith('ses-'):
                 continue
-            
+
             print(f"    - Processing session: {session_name}")
 
+            def add(path, title):
+                if os.path.exists(path):
+                    reports.append({"subject": subject_id, "session": session_name, "title": title, "path": path})
+
             # 1. Anatomical QC
-            anat_qc_path = os.path.join(session_folder, f"{subject_id}_{session_name}_anatomical_QC.pdf")
-            if os.path.exists(anat_qc_path):
-                report_files_to_merge.append(anat_qc_path)
+            add(os.path.join(session_folder, f"{subject_id}_{session_name}_anatomical_QC.pdf"), "Anatomical QC")
 
             # 2. Preproc QC
-            preproc_qc_path = os.path.join(session_folder, f"{subject_id}_{session_name}_preproc_QC.pdf")
-            if os.path.exists(preproc_qc_path):
-                report_files_to_merge.append(preproc_qc_path)
+            add(os.path.join(session_folder, f"{subject_id}_{session_name}_preproc_QC.pdf"), "Preprocessing QC")
 
             # Find all analysis names for this session
             analysis_names = sorted([
@@ -55,27 +51,109 @@ def main():
 
             for analysis_name in analysis_names:
                 # 3. Analysis QC
-                analysis_qc_path = os.path.join(session_folder, f"{subject_id}_{session_name}_{analysis_name}_QC.pdf")
-                if os.path.exists(analysis_qc_path):
-                    report_files_to_merge.append(analysis_qc_path)
+                add(os.path.join(session_folder, f"{subject_id}_{session_name}_{analysis_name}_QC.pdf"), f"{analysis_name} QC")
 
                 # 4. Analysis Results
-                analysis_results_path = os.path.join(session_folder, f"{subject_id}_{session_name}_{analysis_name}_results.pdf")
-                if os.path.exists(analysis_results_path):
-                    report_files_to_merge.append(analysis_results_path)
+                add(os.path.join(session_folder, f"{subject_id}_{session_name}_{analysis_name}_results.pdf"), f"{analysis_name} results")
 
-    if not report_files_to_merge:
-        print("No PDF reports found to merge.")
-        return
+    return reports
 
-    print("\nConcatenating the following files in order:")
-    for f in report_files_to_merge:
-        print(f"  -> {os.path.relpath(f, dropbox_dir)}")
-        merger.append(f)
+def shard_name(report, shard_by, groups):
+    group = groups.get(report["subject"], "NA")
+    return {"group": group, "session": report["session"], "group_session": f"{group}_{report['session']}"}[shard_by]
 
-    print(f"\nWriting consolidated report to: {output_file}")
-    merger.write(output_file)
+def reports_signature(reports, dropbox_dir):
+    return [[os.path.relpath(r["path"], dropbox_dir), r["title"], derivatives_catalog.file_signature(r["path"])] for r in reports]
+
+def write_consolidated(reports, output_file, dropbox_dir):
+    """
+    Merges the reports one file at a time under a subject -> session -> report outline, then renames into place.
+    The writer keeps every appended page until it is written, so memory grows with the reports of one output file.
+    """
+    merger = PdfWriter()
+    parents = {}
+    for report in reports:
+        print(f"  -> {os.path.relpath(report['path'], dropbox_dir)}")
+        reader = PdfReader(report["path"])
+        first_page = len(merger.pages)
+        merger.append(reader, import_outline=False)
+        if report["subject"] not in parents:
+            parents[report["subject"]] = merger.add_outline_item(report["subject"], first_page, is_open=False)
+        session_key = (report["subject"], report["session"])
+        if session_key not in parents:
+            parents[session_key] = merger.add_outline_item(report["session"], first_page, parent=parents[report["subject"]])
+        merger.add_outline_item(report["title"], first_page, parent=parents[session_key])
+
+    folder, name = os.path.split(output_file)
+    tmp_path = os.path.join(folder, f".~{name}.{uuid.uuid4().hex[:8]}.tmp")
+    merger.write(tmp_path)
     merger.close()
+    os.replace(tmp_path, output_file)
+
+def main():
+    parser = argparse.ArgumentParser(description="Concatenate individual PDF reports into consolidated reports (one per group and session by default).")
+    parser.add_argument("--dropbox_dir", default=os.path.expanduser("~/Dropbox"), help="The base directory where the individual reports are saved.")
+    parser.add_argument("--output_file", default="consolidated_report.pdf", help="The name of the final concatenated PDF file.")
+    parser.add_argument("--shard_by", choices=["group", "session", "group_session", "none"], default="group_session", help="Write one consolidated report per group and/or session (<output_file>_<shard>.pdf), holding one shard in memory at a time. 'none' writes a single file; its memory grows with the cohort.")
+    parser.add_argument("--config", default="analysis_configs/main_config.toml", help="Main config with the subjects' groups (for --shard_by group).")
+    parser.add_argument("--force", action="store_true", help="Rewrite every consolidated report, even when its inputs are unchanged.")
+    args = parser.parse_args()
+
+    dropbox_dir = args.dropbox_dir
+
+    if not os.path.isdir(dropbox_dir):
+        print(f"Error: Dropbox directory not found at {dropbox_dir}")
+        return
+
+    print("Scanning for reports to concatenate...")
+    reports = find_reports(dropbox_dir)
+
+    if not reports:
+        print("No PDF reports found to merge.")
+        return
+
+    groups = {}
+    if args.shard_by in ("group", "group_session") and os.path.exists(args.config):
+        groups = {s["id"]: s.get("group", "NA") for s in toml.load(args.config).get("subjects", [])}
+
+    # Each consolidated report (the single file, or every shard) is rewritten only when its inputs changed
+    stem, extension = os.path.splitext(args.output_file)
+    outputs = {}
+    for report in reports:
+        name = args.output_file if args.shard_by == "none" else f"{stem}_{shard_name(report, args.shard_by, groups)}{extension}"
+        outputs.setdefault(name, []).append(report)
+
+    manifest_path = os.path.join(dropbox_dir, MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    def save_manifest():
+        tmp_path = f"{manifest_path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, manifest_path)
+
+    # Consolidated reports written by an earlier run that are no longer produced (e.g. after changing --shard_by)
+    for name in [name for name in manifest if name not in outputs]:
+        stale_file = os.path.join(dropbox_dir, name)
+        if os.path.exists(stale_file):
+            print(f"Removing stale consolidated report: {stale_file}")
+            os.remove(stale_file)
+        del manifest[name]
+    save_manifest()
+
+    for name, shard_reports in outputs.items():
+        output_file = os.path.join(dropbox_dir, name)
+        signature = reports_signature(shard_reports, dropbox_dir)
+        if not args.force and manifest.get(name) == signature and os.path.exists(output_file):
+            print(f"\nUnchanged: {output_file} ({len(shard_reports)} reports)")
+            continue
+        print(f"\nWriting consolidated report to: {output_file}")
+        write_consolidated(shard_reports, output_file, dropbox_dir)
+        manifest[name] = signature
+        save_manifest()
 
     print("--- Concatenation complete! ---")
 
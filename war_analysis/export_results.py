@@ -1,19 +1,36 @@
 import os
+import sys
 import glob
 import re
+import json
+import hashlib
+import uuid
 import pdfkit
 from fpdf import FPDF
-from PIL import Image
 import argparse
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
 import toml
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils"))
+import derivatives_catalog
+import report_images
+
+# Source signatures of the exported PDFs, kept in dropbox_dir so unchanged PDFs are not re-rendered.
+MANIFEST_NAME = ".export_manifest.json"
+
 # --- PDF Class with Enhanced Styling ---
 class PDF(FPDF):
-    def __init__(self, orientation='P', unit='mm', format='A4', title='', subject_info=''):
+    def __init__(self, orientation='P', unit='mm', format='A4', title='', subject_info='', report_date=None):
         super().__init__(orientation, unit, format)
         self.doc_title = title
         self.subject_info = subject_info
+        # The footer date and the PDF metadata come from the sources, so unchanged reports are byte-identical
+        self.report_date = report_date or datetime.now(timezone.utc)
+        self.set_creation_date(self.report_date)
+        self.set_creator("export_results.py")
+        self.set_title(title)
+        self.set_subject(subject_info)
         self.set_auto_page_break(auto=True, margin=15)
         self.header_color = (34, 54, 104)
         self.body_color = (0, 0, 0)
@@ -32,7 +49,7 @@ class PDF(FPDF):
         self.set_text_color(128)
         self.cell(0, 10, f'Page {self.page_no()}', 0, 0, 'C')
         self.set_x(-50)
-        self.cell(0, 10, datetime.now().strftime("%Y-%m-%d"), 0, 0, 'R')
+        self.cell(0, 10, self.report_date.strftime("%Y-%m-%d"), 0, 0, 'R')
 
     def section_title(self, title):
         self.set_font('Arial', 'B', 12)
@@ -52,50 +69,55 @@ def convert_html_to_pdf(html_path, pdf_path):
         print(f"Converting {html_path} to {pdf_path}...")
         pdfkit.from_file(html_path, pdf_path, options={'enable-local-file-access': ''})
         print("  -> Success.")
+        return True
     except Exception as e:
         print(f"  -> Failed to convert file. Error: {e}")
+        return False
 
-def create_pdf_from_images(image_folder, pdf_path, title, subject_info, description=""):
-    images = sorted(glob.glob(os.path.join(image_folder, '*')))
+def create_pdf_from_images(image_folder, pdf_path, title, subject_info, image_cache, description="", report_date=None):
+    images = sorted(path for path in glob.glob(os.path.join(image_folder, '*')) if path.lower().endswith(report_images.IMAGE_EXTENSIONS))
     if not images:
         print(f"No images found in {image_folder}")
-        return
+        return False
 
     print(f"Creating {pdf_path}...")
-    pdf = PDF(title=title, subject_info=subject_info)
+    pdf = PDF(title=title, subject_info=subject_info, report_date=report_date)
     pdf.add_page()
     if description:
         pdf.section_title("Description")
         pdf.section_body(description)
 
+    # Print-resolution derivatives are embedded instead of the full-size images
+    prepared = report_images.prepare(images, image_cache)
     y_coord = pdf.get_y()
     for image_path in images:
+        if image_path not in prepared: continue
+        embed_path, (w, h) = prepared[image_path]
         try:
-            with Image.open(image_path) as img:
-                w, h = img.size
-                pdf_width = 190  # Content width
-                pdf_height = pdf_width * h / w
+            pdf_width = 190  # Content width
+            pdf_height = pdf_width * h / w
 
-                if y_coord + pdf_height > 270:
-                    pdf.add_page()
-                    y_coord = pdf.get_y()
+            if y_coord + pdf_height > 270:
+                pdf.add_page()
+                y_coord = pdf.get_y()
 
-                pdf.image(image_path, x=10, y=y_coord, w=pdf_width)
-                y_coord += pdf_height + 5
+            pdf.image(embed_path, x=10, y=y_coord, w=pdf_width)
+            y_coord += pdf_height + 5
         except Exception as e:
             print(f"  -> Failed to process image {image_path}. Error: {e}")
 
     pdf.output(pdf_path)
     print("  -> Success.")
+    return True
 
-def create_glm_results_pdf(image_folder, pdf_path, title, subject_info, model_config):
+def create_glm_results_pdf(image_folder, pdf_path, title, subject_info, model_config, image_cache, report_date=None):
     images = sorted(glob.glob(os.path.join(image_folder, '*.jpg'))) or sorted(glob.glob(os.path.join(image_folder, '*.png')))
     if not images:
         print(f"No images found in {image_folder}")
-        return
+        return False
 
     print(f"Creating {pdf_path}...")
-    pdf = PDF(title=title, subject_info=subject_info)
+    pdf = PDF(title=title, subject_info=subject_info, report_date=report_date)
     pdf.add_page()
 
     pdf.section_title("Analysis Model Summary")
@@ -104,8 +126,10 @@ def create_glm_results_pdf(image_folder, pdf_path, title, subject_info, model_co
         f"Basis Function: {model_config.get('basis', 'N/A')}"
     )
 
+    prepared = report_images.prepare(images, image_cache)
     image_groups = {}
     for image_path in images:
+        if image_path not in prepared: continue
         filename = os.path.basename(image_path)
         prefix = re.split(r'[._]', filename)[0]
         if prefix not in image_groups:
@@ -127,10 +151,9 @@ def create_glm_results_pdf(image_folder, pdf_path, title, subject_info, model_co
             total_aspect_ratio = 0
             img_dims = []
             for image_path in group_images:
-                with Image.open(image_path) as img:
-                    w, h = img.size
-                    img_dims.append((w, h))
-                    total_aspect_ratio += w / h
+                w, h = prepared[image_path][1]
+                img_dims.append((w, h))
+                total_aspect_ratio += w / h
             
             common_height = page_width / total_aspect_ratio
             
@@ -140,7 +163,7 @@ def create_glm_results_pdf(image_folder, pdf_path, title, subject_info, model_co
                 w, h = img_dims[i]
                 new_width = common_height * w / h
                 try:
-                    pdf.image(image_path, x=x, y=y, w=new_width, h=common_height)
+                    pdf.image(prepared[image_path][0], x=x, y=y, w=new_width, h=common_height)
                     x += new_width
                 except Exception as e:
                     print(f"  -> Failed to process image {image_path}. Error: {e}")
@@ -148,81 +171,186 @@ def create_glm_results_pdf(image_folder, pdf_path, title, subject_info, model_co
         else:
             y = pdf.get_y()
             for image_path in group_images:
+                embed_path, (w, h) = prepared[image_path]
                 try:
-                    with Image.open(image_path) as img:
-                        w, h = img.size
-                        pdf_width = 190
-                        pdf_height = pdf_width * h / w
-                        if y + pdf_height > 270:
-                            pdf.add_page()
-                            y = pdf.get_y()
-                        pdf.image(image_path, x=10, y=y, w=pdf_width)
-                        y += pdf_height + 5
+                    pdf_width = 190
+                    pdf_height = pdf_width * h / w
+                    if y + pdf_height > 270:
+                        pdf.add_page()
+                        y = pdf.get_y()
+                    pdf.image(embed_path, x=10, y=y, w=pdf_width)
+                    y += pdf_height + 5
                 except Exception as e:
                     print(f"  -> Failed to process image {image_path}. Error: {e}")
 
     pdf.output(pdf_path)
     print("  -> Success.")
+    return True
 
-def main():
-    parser = argparse.ArgumentParser(description="Export MRI analysis results to PDF.")
-    parser.add_argument("--output_dir", default="/media/user/PortableSSD/MDMA/Output", help="Analysis output directory.")
-    parser.add_argument("--dropbox_dir", default=os.path.expanduser("~/Dropbox"), help="Directory to save exported PDFs.")
-    args = parser.parse_args()
-
-    try:
-        main_config = toml.load("analysis_configs/main_config.toml")
-        analysis_models = toml.load("analysis_configs/analysis_models.toml")
-    except FileNotFoundError as e:
-        print(f"Error: Configuration file not found. {e}")
-        return
-
+# --- Export Jobs ---
+def collect_jobs(output_dir, dropbox_dir, main_config, analysis_models, image_cache, qc_html=True):
+    """One job per PDF of every subject/session, with the source folder or file it is rendered from."""
+    jobs = []
     for subject_config in main_config.get("subjects", []):
         subject_id = subject_config["id"]
         subject_group = subject_config.get("group", "N/A")
-        print(f"--- Processing subject: {subject_id} (Group: {subject_group}) ---")
 
         for session_config in subject_config.get("sessions", []):
             session_id = f"ses-{session_config['id']}"
-            print(f"  - Processing session: {session_id} -")
-
-            session_folder = os.path.join(args.output_dir, subject_id, session_id)
+            session_folder = os.path.join(output_dir, subject_id, session_id)
             if not os.path.isdir(session_folder): continue
 
-            dest_folder = os.path.join(args.dropbox_dir, subject_id, session_id)
-            os.makedirs(dest_folder, exist_ok=True)
-            
+            dest_folder = os.path.join(dropbox_dir, subject_id, session_id)
             subject_info_str = f"Subject: {subject_id} | Session: {session_id} | Group: {subject_group}"
 
             html_path = os.path.join(session_folder, "func_preproc", f"{subject_id}_preproc.results", f"QC_{subject_id}_preproc", "index.html")
-            if os.path.exists(html_path):
-                pdf_path = os.path.join(dest_folder, f"{subject_id}_{session_id}_preproc_QC.pdf")
-                convert_html_to_pdf(html_path, pdf_path)
+            if qc_html and os.path.exists(html_path):
+                jobs.append({"kind": "html", "source": html_path,
+                             "pdf_path": os.path.join(dest_folder, f"{subject_id}_{session_id}_preproc_QC.pdf")})
 
             anat_warped_folder = os.path.join(session_folder, "anat_warped")
             if os.path.isdir(anat_warped_folder):
-                pdf_path = os.path.join(dest_folder, f"{subject_id}_{session_id}_anatomical_QC.pdf")
-                create_pdf_from_images(anat_warped_folder, pdf_path, "Anatomical QC Report", subject_info_str, "Results of anatomical data warping to MNI space.")
+                jobs.append({"kind": "images", "source": anat_warped_folder,
+                             "pdf_path": os.path.join(dest_folder, f"{subject_id}_{session_id}_anatomical_QC.pdf"),
+                             "title": "Anatomical QC Report", "subject_info": subject_info_str, "image_cache": image_cache,
+                             "description": "Results of anatomical data warping to MNI space."})
 
             glm_base_folder = os.path.join(session_folder, "glm")
-            if os.path.isdir(glm_base_folder):
-                for analysis_name, model_config in analysis_models.items():
-                    analysis_folder = os.path.join(glm_base_folder, analysis_name)
-                    if not os.path.isdir(analysis_folder): continue
-                    
-                    print(f"    - Processing analysis: {analysis_name} -")
-                    
-                    glm_qc_media_folder = os.path.join(analysis_folder, f"{subject_id}_{analysis_name}.results", f"QC_{subject_id}_{analysis_name}", "media")
-                    if os.path.isdir(glm_qc_media_folder):
-                        pdf_path = os.path.join(dest_folder, f"{subject_id}_{session_id}_{analysis_name}_QC.pdf")
-                        create_pdf_from_images(glm_qc_media_folder, pdf_path, f"GLM QC: {analysis_name}", subject_info_str, "Quality control metrics from the AFNI preprocessing and GLM pipeline.")
-
-                    glm_results_qc_folder = os.path.join(analysis_folder, "QC")
-                    if os.path.isdir(glm_results_qc_folder):
-                        pdf_path = os.path.join(dest_folder, f"{subject_id}_{session_id}_{analysis_name}_results.pdf")
-                        create_glm_results_pdf(glm_results_qc_folder, pdf_path, f"GLM Results: {analysis_name}", subject_info_str, model_config)
-
-    print("--- All processing complete ---")
+            if not os.path.isdir(glm_base_folder): continue
+            for analysis_name, model_config in analysis_models.items():
+                analysis_folder = os.path.join(glm_base_folder, analysis_name)
+                if not os.path.isdir(analysis_folder): continue
+
+                glm_qc_media_folder = os.path.join(analysis_folder, f"{subject_id}_{analysis_name}.results", f"QC_{subject_id}_{analysis_name}", "media")
+                if os.path.isdir(glm_qc_media_folder):
+                    jobs.append({"kind": "images", "source": glm_qc_media_folder,
+                                 "pdf_path": os.path.join(dest_folder, f"{subject_id}_{session_id}_{analysis_name}_QC.pdf"),
+                                 "title": f"GLM QC: {analysis_name}", "subject_info": subject_info_str, "image_cache": image_cache,
+                                 "description": "Quality control metrics from the AFNI preprocessing and GLM pipeline."})
+
+                glm_results_qc_folder = os.path.join(analysis_folder, "QC")
+                if os.path.isdir(glm_results_qc_folder):
+                    jobs.append({"kind": "glm_results", "source": glm_results_qc_folder,
+                                 "pdf_path": os.path.join(dest_folder, f"{subject_id}_{session_id}_{analysis_name}_results.pdf"),
+                                 "title": f"GLM Results: {analysis_name}", "subject_info": subject_info_str, "image_cache": image_cache,
+                                 "model_config": model_config})
+    return jobs
+
+def source_files(job):
+    # The QC index.html pulls in the images and styles of its whole QC folder; image reports only use the images
+    if job["kind"] == "html":
+        folder = os.path.dirname(job["source"])
+        return sorted(os.path.join(root, name) for root, _, names in os.walk(folder) for name in names)
+    return sorted(path for path in glob.glob(os.path.join(job["source"], '*')) if path.lower().endswith(report_images.IMAGE_EXTENSIONS))
+
+def job_signature(job):
+    """Hash of the job settings and the size/mtime of every source file."""
+    settings = {key: value for key, value in job.items() if key != "pdf_path"}
+    sources = [[path, derivatives_catalog.file_signature(path)] for path in source_files(job)]
+    return hashlib.sha256(json.dumps([settings, sources], sort_keys=True, default=str).encode()).hexdigest()[:24]
+
+def content_hash(pdf_path):
+    """Hash of a PDF without its volatile metadata (creation/modification dates and file ID, e.g. from wkhtmltopdf)."""
+    with open(pdf_path, "rb") as f:
+        content = f.read()
+    content = re.sub(rb"/(CreationDate|ModDate)\s*\([^)]*\)|/ID\s*\[[^\]]*\]", b"", content)
+    return hashlib.sha256(content).hexdigest()
+
+def publish(tmp_path, pdf_path):
+    """Atomically moves a rendered PDF into place, unless the existing file has the same content. Returns True if replaced."""
+    if os.path.exists(pdf_path) and content_hash(pdf_path) == content_hash(tmp_path):
+        os.remove(tmp_path)
+        print(f"  -> Unchanged: {pdf_path}")
+        return False
+    os.replace(tmp_path, pdf_path)
+    return True
+
+def run_job(job):
+    os.makedirs(os.path.dirname(job["pdf_path"]), exist_ok=True)
+    # Rendered under a temporary name ('.~' files are skipped by sync clients) in the destination folder, so the
+    # published file is only ever replaced whole
+    folder, name = os.path.split(job["pdf_path"])
+    tmp_path = os.path.join(folder, f".~{name}.{uuid.uuid4().hex[:8]}.tmp")
+    sources = source_files(job)
+    report_date = datetime.fromtimestamp(max(os.path.getmtime(path) for path in sources), timezone.utc) if sources else None
+    try:
+        if job["kind"] == "html":
+            success = convert_html_to_pdf(job["source"], tmp_path)
+        elif job["kind"] == "glm_results":
+            success = create_glm_results_pdf(job["source"], tmp_path, job["title"], job["subject_info"], job["model_config"], job["image_cache"], report_date)
+        else:
+            success = create_pdf_from_images(job["source"], tmp_path, job["title"], job["subject_info"], job["image_cache"], job["description"], report_date)
+        if success:
+            publish(tmp_path, job["pdf_path"])
+        return success
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def load_manifest(dropbox_dir):
+    path = os.path.join(dropbox_dir, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+def save_manifest(dropbox_dir, manifest):
+    path = os.path.join(dropbox_dir, MANIFEST_NAME)
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Export MRI analysis results to PDF.")
+    parser.add_argument("--output_dir", default="/media/user/PortableSSD/MDMA/Output", help="Analysis output directory.")
+    parser.add_argument("--dropbox_dir", default=os.path.expanduser("~/Dropbox"), help="Directory to save exported PDFs.")
+    parser.add_argument("--n_procs", type=int, default=None, help="PDFs rendered in parallel (default: all cores).")
+    parser.add_argument("--image_cache", help="Cache of print-resolution report images (default: <output_dir>/_export_cache/images).")
+    parser.add_argument("--skip_qc_html", action="store_true", help="Skip the wkhtmltopdf conversion of the afni_proc QC pages (browse them in the QC dashboard, utils/qc_dashboard.py).")
+    parser.add_argument("--force", action="store_true", help="Re-render every PDF, even when its sources are unchanged.")
+    args = parser.parse_args()
+
+    try:
+        main_config = toml.load("analysis_configs/main_config.toml")
+        analysis_models = toml.load("analysis_configs/analysis_models.toml")
+    except FileNotFoundError as e:
+        print(f"Error: Configuration file not found. {e}")
+        return
+
+    # A PDF is only rendered again when it is missing or its sources (or settings) changed since the last export
+    os.makedirs(args.dropbox_dir, exist_ok=True)
+    manifest = load_manifest(args.dropbox_dir)
+    image_cache = args.image_cache or os.path.join(args.output_dir, "_export_cache", "images")
+    jobs = collect_jobs(args.output_dir, args.dropbox_dir, main_config, analysis_models, image_cache, not args.skip_qc_html)
+    todo = []
+    for job in jobs:
+        key = os.path.relpath(job["pdf_path"], args.dropbox_dir)
+        signature = job_signature(job)
+        if args.force or manifest.get(key) != signature or not os.path.exists(job["pdf_path"]):
+            todo.append((key, signature, job))
+    print(f"--- {len(todo)} of {len(jobs)} PDFs to export ({len(jobs) - len(todo)} unchanged) ---")
+
+    failed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.n_procs) as executor:
+            futures = {executor.submit(run_job, job): (key, signature) for key, signature, job in todo}
+            for future in as_completed(futures):
+                key, signature = futures[future]
+                try:
+                    success = future.result()
+                except Exception as e:
+                    print(f"  -> Failed to export {key}. Error: {e}")
+                    success = False
+                if success:
+                    manifest[key] = signature
+                else:
+                    manifest.pop(key, None)
+                    failed += 1
+    finally:
+        save_manifest(args.dropbox_dir, manifest)
+
+    print(f"--- All processing complete ({failed} failed) ---")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,16 +1,27 @@
 import argparse
 import os
 import subprocess
+import sys
 import json
+import time
 import toml
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from functools import partial
 from rich.console import Console
 from rich.panel import Panel
+from rich.table import Table
 from rich.progress import Progress, SpinnerColumn, TextColumn, BarColumn, TimeRemainingColumn
 from rich import print as rprint
 from rich.traceback import install
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "utils"))
+import clustsim_cache
+import derivatives_catalog
+import group_cube
+import group_incremental
+import group_mask
+import qc_queue
+
 # Install rich traceback handler
 install()
 
@@ -22,6 +33,8 @@ def run_step(subject, session, config, analysis_name, step_name, extra_args=None
         "create_timings": "00_create_timings.sh",
         "preprocess_anat": "01_preprocess_anat.sh",
         "preprocess_func": "02_preprocess_func.sh",
+        "glm_baseline": "03a_prepare_glm_baseline.sh",
+        "glm_native": "03b_fit_native_glm.sh",
         "glm": "03_run_glm.sh",
     }
     script_name = script_map.get(step_name)
@@ -71,6 +84,48 @@ def run_step(subject, session, config, analysis_name, step_name, extra_args=None
         console.log(f"[bold red]✖ {step_name}[/] failed for [bold]{subject}[/]. See log: [underline]{log_file_path}[/]")
         return False
 
+def get_baseline_dir(config, subject, session):
+    """Location of the nuisance design shared by all GLM models of a subject/session."""
+    return os.path.join(config["output_dir"], subject, f"ses-{session}", "glm", "_shared_baseline")
+
+def get_qc_queue_dir(config):
+    """Queue of QC render jobs shared by all subjects and group analyses (--qc queue)."""
+    return os.path.join(config["output_dir"], "qc_queue")
+
+def get_qc_args(args, config):
+    """QC options of the glm and group scripts: the montage renderer and, with --qc queue, the queue."""
+    qc_args = ["--renderer", config.get("qc_renderer", "afni")]
+    if args.qc == "queue":
+        qc_args.extend(["--qc", "queue", "--qc_queue", get_qc_queue_dir(config)])
+    return qc_args
+
+def start_qc_worker(args, config):
+    """Starts a low-priority worker that renders queued QC images while the pipeline runs."""
+    if args.qc != "queue":
+        return None
+    queue_dir = get_qc_queue_dir(config)
+    qc_queue.open_queue(queue_dir)
+    os.makedirs("logs", exist_ok=True)
+    console.log(f"[dim]QC images are rendered in the background ({args.qc_width} at a time). See log: logs/qc_queue.log[/]")
+    # The worker keeps its own copy of the log descriptor, so the parent's handle is closed once it started
+    with open(os.path.join("logs", "qc_queue.log"), "a") as log_file:
+        return subprocess.Popen(
+            [sys.executable, os.path.join("utils", "qc_queue.py"), "worker",
+             "--queue", queue_dir, "--width", str(args.qc_width), "--until_closed"],
+            stdout=log_file, stderr=subprocess.STDOUT
+        )
+
+def finish_qc_worker(process, config):
+    """Closes the QC queue and waits for the worker to render the remaining jobs."""
+    if process is None:
+        return
+    queue_dir = get_qc_queue_dir(config)
+    qc_queue.close_queue(queue_dir)
+    with console.status("Waiting for queued QC images..."):
+        process.wait()
+    counts = qc_queue.status(queue_dir)
+    console.log(f"QC queue finished: {counts['done']} done, {counts['failed']} failed.")
+
 def process_subject(subject_id, args, main_config, analysis_models, progress=None, task_id=None):
     """Runs the requested pipeline steps for a single subject."""
     # Find subject-specific config
@@ -134,6 +189,48 @@ def process_subject(subject_id, args, main_config, analysis_models, progress=Non
                     console.log(f"[red]Error:[/] --analysis is required for 'glm' step.")
                     break
 
+                native_models = [a for a in analysis_names if analysis_models.get(a, {}).get("backend") == "native"]
+                baseline_args = None
+                if args.shared_baseline or native_models:
+                    if progress and task_id:
+                        progress.update(task_id, description=f"[cyan]{subject_id}[/] - glm: shared baseline")
+                    baseline_success = run_step(
+                        subject=subject_id,
+                        session=session_id_str,
+                        config=main_config,
+                        analysis_name=None,
+                        step_name="glm_baseline",
+                        extra_args=[
+                            "--censor_motion", str(main_config.get("censor_motion_threshold", 0.5)),
+                            "--censor_outliers", str(main_config.get("censor_outlier_threshold", 0.05)),
+                        ]
+                    )
+                    if not baseline_success:
+                        console.log(f"[red]Stopping pipeline for {subject_id} because the shared GLM baseline failed.[/]")
+                        break
+                    baseline_args = ["--baseline", get_baseline_dir(main_config, subject_id, session_id_str)]
+
+                # Native models of this session are fitted together in one pass over the data; 03_run_glm.sh
+                # then only exports their QC images.
+                prefitted_models = [a for a in native_models
+                                    if session_config.get("has_scr", False) or not analysis_models[a].get("requires_scr", False)]
+                if len(prefitted_models) > 1:
+                    if progress and task_id:
+                        progress.update(task_id, description=f"[cyan]{subject_id}[/] - glm: native models")
+                    native_success = run_step(
+                        subject=subject_id,
+                        session=session_id_str,
+                        config=main_config,
+                        analysis_name=None,
+                        step_name="glm_native",
+                        extra_args=["--analyses", ",".join(prefitted_models)] + baseline_args
+                    )
+                    if not native_success:
+                        console.log(f"[red]Stopping pipeline for {subject_id} because the native GLM pass failed.[/]")
+                        break
+                else:
+                    prefitted_models = []
+
                 all_glm_success = True
                 for analysis_name in analysis_names:
                     analysis_model_config = analysis_models.get(analysis_name, {})
@@ -147,17 +244,28 @@ def process_subject(subject_id, args, main_config, analysis_models, progress=Non
                     if progress and task_id:
                         progress.update(task_id, description=f"[cyan]{subject_id}[/] - glm: {analysis_name}")
 
+                    # Native models always fit against the shared baseline; afni models only with --shared_baseline.
+                    glm_extra_args = baseline_args if args.shared_baseline or analysis_name in native_models else extra_args
+                    if analysis_name in prefitted_models:
+                        glm_extra_args = ["--prefitted"]
+                    elif args.reml_slabs > 1 and analysis_name not in native_models:
+                        # Subjects running in parallel share the machine's cores.
+                        cores = max(1, (os.cpu_count() or 1) // max(1, args.n_procs))
+                        glm_extra_args = (glm_extra_args or []) + ["--reml_slabs", str(args.reml_slabs), "--cores", str(cores)]
+                    glm_extra_args = (glm_extra_args or []) + get_qc_args(args, main_config)
                     success = run_step(
                         subject=subject_id,
                         session=session_id_str,
                         config=main_config,
                         analysis_name=analysis_name,
                         step_name=step,
-                        extra_args=extra_args
+                        extra_args=glm_extra_args
                     )
                     if not success:
                         all_glm_success = False
                         break
+                    derivatives_catalog.record_config(main_config["output_dir"], subject_id, session_id_str, analysis_name, analysis_model_config)
+                    update_incremental_group_models(main_config, analysis_models, analysis_name)
                 if not all_glm_success:
                     console.log(f"[red]Stopping pipeline for {subject_id} because a GLM step failed.[/]")
                     break
@@ -177,33 +285,8 @@ def process_subject(subject_id, args, main_config, analysis_models, progress=Non
     if progress and task_id:
         progress.update(task_id, advance=1)
 
-def run_group_analysis(args, config, analysis_models):
-    """Runs a specified group-level analysis."""
-    console.print(Panel(f"Group Analysis: [bold cyan]{args.group_model}[/]", style="bold blue"))
-
-    if not args.analysis or len(args.analysis) > 1:
-        console.log("[red]Error:[/] Please specify exactly one first-level analysis model using --analysis.")
-        return
-    analysis_name = args.analysis[0]
-
-    if not args.group_model:
-        console.log("[red]Error:[/] Please specify a group analysis model using --group_model.")
-        return
-
-    f_level_model = analysis_models.get(analysis_name)
-    if not f_level_model:
-        console.log(f"[red]Error:[/] First-level analysis '{analysis_name}' not found.")
-        return
-
-    group_model_config = next((g for g in f_level_model.get("group_analyses", []) if g["name"] == args.group_model), None)
-    if not group_model_config:
-        console.log(f"[red]Error:[/] Group analysis model '{args.group_model}' not found under '{analysis_name}'.")
-        return
-
-    output_dir = os.path.join(config["output_dir"], "group_analysis", analysis_name, args.group_model)
-    os.makedirs(output_dir, exist_ok=True)
-
-    # --- Subject and Mask Generation ---
+def select_group_subjects(config, group_model_config, verbose=True):
+    """Subjects of a group model: its custom 'subjects' list/table, or every subject of its groups."""
     all_subjects_info = config.get("subjects", [])
     subjects_to_process = []
 
@@ -213,9 +296,11 @@ def run_group_analysis(args, config, analysis_models):
 
         if isinstance(custom_subjects, list):
             subjects_ids_to_include = custom_subjects
-            console.log(f"Using custom list of {len(subjects_ids_to_include)} subjects.")
+            if verbose:
+                console.log(f"Using custom list of {len(subjects_ids_to_include)} subjects.")
         elif isinstance(custom_subjects, dict):
-            console.log(f"Using custom subject lists per group.")
+            if verbose:
+                console.log(f"Using custom subject lists per group.")
             valid_groups = group_model_config.get("groups", [])
             for group_name, subject_list in custom_subjects.items():
                 if group_name not in valid_groups:
@@ -227,17 +312,146 @@ def run_group_analysis(args, config, analysis_models):
             if sub_id in subject_id_map:
                 subjects_to_process.append(subject_id_map[sub_id])
             else:
-                console.log(f"[yellow]Warning:[/] Subject '{sub_id}' from custom list not found.")
+                if verbose:
+                    console.log(f"[yellow]Warning:[/] Subject '{sub_id}' from custom list not found.")
 
     else:
         group_model_groups = group_model_config.get("groups")
-        console.log(f"Using all subjects from group(s): {group_model_groups}")
+        if verbose:
+            console.log(f"Using all subjects from group(s): {group_model_groups}")
         subjects_to_process = [s for s in all_subjects_info if s["group"] in group_model_groups]
+    return subjects_to_process
+
+
+def get_ttest_sets(group_model_config, subjects, resolve_stats):
+    """
+    (setA, setB) of a 3dttest++ model as lists of (subject info, session, stats file). setB holds the subjects of
+    setB_groups (two-sample), or the setB_contrast of the setA subjects in the same order (paired).
+    """
+    contrast_name = group_model_config["contrast"]
+    setB_groups = group_model_config.get("setB_groups", [])
+    setB_contrast = group_model_config.get("setB_contrast")
+    setA, setB = [], []
+    for sub_info in subjects:
+        for ses_id in group_model_config.get("sessions", []):
+            if setB_contrast:
+                stats_files = [resolve_stats(sub_info, ses_id, contrast_name), resolve_stats(sub_info, ses_id, setB_contrast)]
+                if None in stats_files:
+                    continue
+                setA.append((sub_info, ses_id, stats_files[0]))
+                setB.append((sub_info, ses_id, stats_files[1]))
+                continue
+
+            stats_file = resolve_stats(sub_info, ses_id, contrast_name)
+            if stats_file is None:
+                continue
+            (setB if sub_info.get("group") in setB_groups else setA).append((sub_info, ses_id, stats_file))
+    return setA, setB
+
+
+def prepare_group_analysis(args, config, analysis_models, analysis_name, group_model_name):
+    """
+    Resolves and validates the inputs of one group model and builds its group mask. Returns the job to run
+    (command, output_dir, log file) or None if the model cannot run.
+    """
+    f_level_model = analysis_models.get(analysis_name)
+    if not f_level_model:
+        console.log(f"[red]Error:[/] First-level analysis '{analysis_name}' not found.")
+        return
+
+    group_model_config = next((g for g in f_level_model.get("group_analyses", []) if g["name"] == group_model_name), None)
+    if not group_model_config:
+        console.log(f"[red]Error:[/] Group analysis model '{group_model_name}' not found under '{analysis_name}'.")
+        return
+
+    output_dir = os.path.join(config["output_dir"], "group_analysis", analysis_name, group_model_name)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # --- Subject and Mask Generation ---
+    subjects_to_process = select_group_subjects(config, group_model_config)
 
     if not subjects_to_process:
         console.log("[red]Error:[/] No subjects to process after filtering.")
         return
     
+    # --- Resolve inputs through the derivatives catalog ---
+    # Sub-brick labels, grids and model config versions are checked before any AFNI tool starts.
+    analysis_type = group_model_config["type"]
+    catalog = derivatives_catalog.refresh(config["output_dir"], [analysis_name])
+    input_errors = []
+    input_entries = []
+
+    def resolve_stats(sub_info, ses_id, contrast_name):
+        stats_file, entry, error = derivatives_catalog.resolve(
+            catalog, config["output_dir"], sub_info["id"], ses_id, analysis_name, contrast_name
+        )
+        if entry is None:
+            console.log(f"[yellow]Warning:[/] Stats file not found for {sub_info['id']} ses-{ses_id} ({analysis_name}).")
+            return None
+        if error:
+            input_errors.append(error)
+            return None
+        input_entries.append(entry)
+        return stats_file
+
+    if analysis_type == "3dLMEr":
+        table_columns = group_model_config.get("table_columns", [])
+        if not table_columns:
+            console.log(f"[red]Error:[/] 'table_columns' is missing in config.")
+            return
+        header_columns = ["Subj"] + table_columns + ["InputFile"]
+
+        if "data_table_rows" not in group_model_config:
+            console.log(f"[red]Error:[/] 'data_table_rows' is missing in config.")
+            return
+
+        table_lines = []
+        for sub_info in subjects_to_process:
+            for ses_id in group_model_config.get("sessions", []):
+                for row_def in group_model_config["data_table_rows"]:
+                    stats_file = resolve_stats(sub_info, ses_id, row_def["contrast"])
+                    if stats_file is None:
+                        continue
+
+                    row_data = {
+                        "Subj": sub_info['id'],
+                        "session": f"ses-{ses_id}",
+                        "group": sub_info.get('group', 'NA'),
+                        "InputFile": stats_file
+                    }
+
+                    for key, value in row_def.items():
+                        if key != 'contrast':
+                            row_data[key] = value
+
+                    table_lines.append("\t".join(str(row_data.get(col_name, "NA")) for col_name in header_columns))
+
+    elif analysis_type == "3dttest++":
+        setA_label = group_model_config.get("setA_label")
+        contrast_name = group_model_config.get("contrast")
+        if not setA_label or not contrast_name:
+            console.log("[red]Error:[/] 3dttest++ requires 'setA_label' and 'contrast'.")
+            return
+
+        # Optional second set: subjects of setB_groups (two-sample), or setB_contrast of the same subjects (paired)
+        setB_contrast = group_model_config.get("setB_contrast")
+        setA, setB = get_ttest_sets(group_model_config, subjects_to_process, resolve_stats)
+        setA_files = [value for sub_info, _, stats_file in setA for value in (sub_info["id"], stats_file)]
+        setB_files = [value for sub_info, _, stats_file in setB for value in (sub_info["id"], stats_file)]
+
+    input_check_errors, input_warnings = derivatives_catalog.check_inputs(input_entries, f_level_model)
+    for warning in input_warnings:
+        console.log(f"[yellow]Warning:[/] {warning}")
+    input_errors.extend(input_check_errors)
+    if input_errors:
+        console.log(f"[red]Error:[/] {len(input_errors)} problem(s) with the inputs of '{group_model_name}':")
+        for error in input_errors:
+            console.log(f"  {error}")
+        return
+    if not input_entries:
+        console.log("[red]Error:[/] No first-level stats datasets found.")
+        return
+
     mask_files = []
     for sub_info in subjects_to_process:
         for ses_id in group_model_config.get("sessions", []):
@@ -251,72 +465,28 @@ def run_group_analysis(args, config, analysis_models):
         console.log("[red]Error:[/] No mask files found.")
         return
 
-    group_mask_path = os.path.join(output_dir, "group_mask")
-    subprocess.run([
-        "3dmask_tool",
-        "-input"] + mask_files + [
-        "-prefix", group_mask_path,
-        "-frac", "0.4",
-        "-overwrite"
-    ], check=True)
+    # Group models over the same masks share one cached mask (same result as 3dmask_tool -frac).
+    mask_cache_dir = os.path.join(config["output_dir"], "group_analysis", group_mask.CACHE_NAME)
+    cached_mask_path, reused = group_mask.build(mask_files, group_model_config.get("mask_frac", 0.4), mask_cache_dir)
+    group_mask_path = group_mask.link(cached_mask_path, os.path.join(output_dir, "group_mask"))
+    console.log(f"{'Reusing cached' if reused else 'Computed'} group mask from {len(mask_files)} subject masks.")
 
     # --- Analysis-specific logic ---
-    analysis_type = group_model_config["type"]
     script_path = os.path.abspath(os.path.join("scripts", "04_run_group_analysis.sh"))
     
     command = [
         "bash", script_path,
         "--type", analysis_type,
-        "--output_prefix", os.path.join(output_dir, f"result_{args.group_model}"),
-        "--mask", f"{group_mask_path}+tlrc",
+        "--output_prefix", os.path.join(output_dir, f"result_{group_model_name}"),
+        "--mask", group_mask_path,
     ]
 
     if analysis_type == "3dLMEr":
-        table_columns = group_model_config.get("table_columns", [])
-        if not table_columns:
-            console.log(f"[red]Error:[/] 'table_columns' is missing in config.")
-            return
-        header_columns = ["Subj"] + table_columns + ["InputFile"]
-        header = "\t".join(header_columns) + "\n"
-
         data_table_path = os.path.join(output_dir, "data_table.txt")
-        
-        if "data_table_rows" not in group_model_config:
-            console.log(f"[red]Error:[/] 'data_table_rows' is missing in config.")
-            return
-
         with open(data_table_path, "w") as f:
-            f.write(header)
-            
-            for sub_info in subjects_to_process:
-                for ses_id in group_model_config.get("sessions", []):
-                    for row_def in group_model_config["data_table_rows"]:
-                        contrast_name = row_def["contrast"]
-                        
-                        stats_file = os.path.join(
-                            config["output_dir"], sub_info["id"], f"ses-{ses_id}", "glm", analysis_name,
-                            f"{sub_info['id']}_{analysis_name}.results",
-                            f"stats.{sub_info['id']}_{analysis_name}+tlrc[{contrast_name}]"
-                        )
-                        if not os.path.exists(stats_file.split("[")[0] + ".HEAD"):
-                            console.log(f"[yellow]Warning:[/] Stats file not found: {stats_file}")
-                            continue
-                        
-                        row_data = {
-                            "Subj": sub_info['id'],
-                            "session": f"ses-{ses_id}",
-                            "group": sub_info.get('group', 'NA'),
-                            "InputFile": stats_file
-                        }
-                        
-                        for key, value in row_def.items():
-                            if key != 'contrast':
-                                row_data[key] = value
-
-                        line_parts = [str(row_data.get(col_name, "NA")) for col_name in header_columns]
-                        line = "\t".join(line_parts) + "\n"
-                        f.write(line)
-        
+            f.write("\t".join(header_columns) + "\n")
+            f.writelines(line + "\n" for line in table_lines)
+
         glt_codes = " ".join([f"-gltCode {g['label']} \"{g['sym']}\"" for g in group_model_config["glt"]])
 
         command.extend([
@@ -324,56 +494,223 @@ def run_group_analysis(args, config, analysis_models):
             "--model", group_model_config["model"],
             "--glt_codes", glt_codes
         ])
+        if group_model_config.get("backend") == "native":
+            command.extend(["--backend", "native"])
+            cube_root = os.path.join(config["output_dir"], "group_analysis", group_cube.CUBES_DIR, analysis_name)
+            if os.path.isdir(cube_root):
+                command.extend(["--cube_dir", cube_root])
+        elif args.lmer_chunks > 1:
+            command.extend(["--lmer_chunks", str(args.lmer_chunks)])
+        # 3dClustSim tables are shared by models with the same mask and ACF (rounded to acf_precision)
+        command.extend([
+            "--clustsim_cache", os.path.join(config["output_dir"], "group_analysis", clustsim_cache.CACHE_NAME),
+            "--acf_precision", str(group_model_config.get("acf_precision", 0.01))
+        ])
 
     elif analysis_type == "3dttest++":
-        setA_label = group_model_config.get("setA_label")
-        contrast_name = group_model_config.get("contrast")
-        if not setA_label or not contrast_name:
-            console.log("[red]Error:[/] 3dttest++ requires 'setA_label' and 'contrast'.")
-            return
-
-        setA_files = []
-        for sub_info in subjects_to_process:
-            for ses_id in group_model_config.get("sessions", []):
-                stats_file = os.path.join(
-                    config["output_dir"], sub_info["id"], f"ses-{ses_id}", "glm", analysis_name,
-                    f"{sub_info['id']}_{analysis_name}.results",
-                    f"stats.{sub_info['id']}_{analysis_name}+tlrc[{contrast_name}]"
-                )
-                if not os.path.exists(stats_file.split("[")[0] + ".HEAD"):
-                    console.log(f"[yellow]Warning:[/] Stats file not found: {stats_file}")
-                    continue
-                
-                setA_files.append(sub_info['id'])
-                setA_files.append(f"{stats_file}")
-
         command.extend([
             "--setA_label", setA_label,
             "--setA_files", " ".join(setA_files)
         ])
+        if setB_files:
+            command.extend(["--setB_label", group_model_config.get("setB_label", "SetB"), "--setB_files", " ".join(setB_files)])
+            if setB_contrast:
+                command.append("--paired")
+        if group_model_config.get("backend") == "native":
+            command.extend(["--backend", "native", "--permutations", str(group_model_config.get("permutations", 0))])
+            cube_root = os.path.dirname(group_cube.cube_dir(config["output_dir"], analysis_name, contrast_name))
+            if os.path.isdir(cube_root):
+                command.extend(["--cube_dir", cube_root])
+
+    command.extend(get_qc_args(args, config))
+
+    return {
+        "analysis": analysis_name,
+        "group_model": group_model_name,
+        "type": analysis_type,
+        "n_inputs": len(input_entries),
+        "command": command,
+        "output_dir": output_dir,
+        "log_file": os.path.join("logs", f"group_analysis_{analysis_name}_{group_model_name}.log"),
+    }
 
-    log_file_path = os.path.join("logs", f"group_analysis_{analysis_name}_{args.group_model}.log")
-    console.log(f"[dim]Executing group analysis. See log: {log_file_path}[/]")
-    
-    with open(log_file_path, "w") as log_file:
-        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, cwd=output_dir)
+
+def execute_group_analysis(job, jobs=None):
+    """Runs a prepared group model. `jobs` sets 3dLMEr -jobs and the OpenMP threads of the AFNI tools."""
+    command = job["command"] + (["--jobs", str(jobs)] if jobs else [])
+    os.makedirs("logs", exist_ok=True)
+    start = time.time()
+    with open(job["log_file"], "w") as log_file:
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, cwd=job["output_dir"])
         process.wait()
+    return process.returncode == 0, time.time() - start
 
-    if process.returncode == 0:
-        console.log(f"[bold green]SUCCESS:[/] Group analysis complete. Results in: {output_dir}")
+
+def run_group_analysis(args, config, analysis_models):
+    """Runs a specified group-level analysis."""
+    console.print(Panel(f"Group Analysis: [bold cyan]{args.group_model}[/]", style="bold blue"))
+
+    if not args.analysis or len(args.analysis) > 1:
+        console.log("[red]Error:[/] Please specify exactly one first-level analysis model using --analysis.")
+        return
+    analysis_name = args.analysis[0]
+
+    if not args.group_model:
+        console.log("[red]Error:[/] Please specify a group analysis model using --group_model.")
+        return
+
+    job = prepare_group_analysis(args, config, analysis_models, analysis_name, args.group_model)
+    if job is None:
+        return
+
+    console.log(f"[dim]Executing group analysis. See log: {job['log_file']}[/]")
+    success, _ = execute_group_analysis(job, args.cores)
+
+    if success:
+        console.log(f"[bold green]SUCCESS:[/] Group analysis complete. Results in: {job['output_dir']}")
     else:
-        console.log(f"[bold red]ERROR:[/] Group analysis failed. Check log: {log_file_path}")
+        console.log(f"[bold red]ERROR:[/] Group analysis failed. Check log: {job['log_file']}")
 
 
+def get_group_contrasts(analysis_config):
+    """First-level sub-brick labels used by the group models of an analysis."""
+    contrasts = []
+    for group_model_config in analysis_config.get("group_analyses", []):
+        contrasts.extend(row["contrast"] for row in group_model_config.get("data_table_rows", []))
+        contrasts.extend(group_model_config[key] for key in ["contrast", "setB_contrast"] if key in group_model_config)
+    return list(dict.fromkeys(contrasts))
+
+
+def build_group_cubes(args, config, analysis_models):
+    """Extracts every contrast used by group models into a masked group data cube (one read per dataset)."""
+    analysis_names = args.analysis or [name for name, model in analysis_models.items() if model.get("group_analyses")]
+    groups = {s["id"]: s.get("group", "NA") for s in config.get("subjects", [])}
+    for analysis_name in analysis_names:
+        if analysis_name not in analysis_models:
+            console.log(f"[red]Error:[/] First-level analysis '{analysis_name}' not found.")
+            return
+        catalog = derivatives_catalog.refresh(config["output_dir"], [analysis_name])
+        for contrast in get_group_contrasts(analysis_models[analysis_name]):
+            try:
+                path, rebuilt = group_cube.build(config["output_dir"], analysis_name, contrast, groups, catalog)
+            except ValueError as e:
+                console.log(f"[yellow]Warning:[/] {e}")
+                continue
+            console.log(f"{'[green]Built' if rebuilt else '[dim]Up to date'}:[/] {analysis_name} / {contrast} ({path})")
+
+
+def update_incremental_group_models(config, analysis_models, analysis_name):
+    """
+    Brings the running sufficient statistics and t-maps of the incremental 3dttest++ models of an analysis up to
+    date with its current stats datasets. Models that never ran in full (no group mask yet) are skipped.
+    """
+    group_models = [g for g in analysis_models.get(analysis_name, {}).get("group_analyses", [])
+                    if g.get("type") == "3dttest++" and g.get("incremental")]
+    if not group_models:
+        return
+    catalog = derivatives_catalog.refresh(config["output_dir"], [analysis_name])
+
+    def resolve_stats(sub_info, ses_id, contrast_name):
+        stats_file, entry, error = derivatives_catalog.resolve(
+            catalog, config["output_dir"], sub_info["id"], ses_id, analysis_name, contrast_name
+        )
+        return stats_file if entry is not None and not error else None
+
+    for group_model_config in group_models:
+        group_model_name = group_model_config["name"]
+        output_dir = os.path.join(config["output_dir"], "group_analysis", analysis_name, group_model_name)
+        mask_path = os.path.join(output_dir, "group_mask+tlrc")
+        if not os.path.exists(mask_path + ".HEAD"):
+            console.log(f"[dim]Skipping incremental update of '{group_model_name}' (run the group model once first)[/]")
+            continue
+
+        subjects = select_group_subjects(config, group_model_config, verbose=False)
+        setA, setB = get_ttest_sets(group_model_config, subjects, resolve_stats)
+        paired = "setB_contrast" in group_model_config
+        if paired:
+            members = [{"set": "paired", "subject": sub_info["id"], "session": ses_id, "group": sub_info.get("group", "NA"),
+                        "datasets": [stats_file, stats_file_b]}
+                       for (sub_info, ses_id, stats_file), (_, _, stats_file_b) in zip(setA, setB)]
+        else:
+            members = [{"set": set_name, "subject": sub_info["id"], "session": ses_id, "group": sub_info.get("group", "NA"),
+                        "datasets": [stats_file]}
+                       for set_name, rows in [("A", setA), ("B", setB)] for sub_info, ses_id, stats_file in rows]
+
+        prefix = os.path.join(output_dir, f"incremental_{group_model_name}")
+        path, n_members, n_added, n_removed = group_incremental.update(
+            output_dir, mask_path, members, prefix, group_model_config["setA_label"],
+            group_model_config.get("setB_label", "SetB"), paired
+        )
+        if path:
+            console.log(f"[green]Updated[/] incremental group map ({n_members} inputs, +{n_added}/-{n_removed}): {path}")
+        elif n_added or n_removed:
+            console.log(f"[dim]Incremental group map of '{group_model_name}' has too few inputs for a t-test ({n_members} inputs)[/]")
+
+
+def run_all_group_analyses(args, config, analysis_models):
+    """
+    Runs every group model of every first-level model (or of the --analysis models) concurrently. All inputs are
+    resolved and validated first; the models then share the core budget, and a status table is printed at the end.
+    """
+    analysis_names = args.analysis or list(analysis_models)
+    for analysis_name in analysis_names:
+        if analysis_name not in analysis_models:
+            console.log(f"[red]Error:[/] First-level analysis '{analysis_name}' not found.")
+            return
+    console.print(Panel(f"All Group Analyses: [bold cyan]{', '.join(analysis_names)}[/]", style="bold blue"))
+
+    results = []
+    jobs = []
+    for analysis_name in analysis_names:
+        for group_model_config in analysis_models[analysis_name].get("group_analyses", []):
+            console.rule(f"{analysis_name} / {group_model_config['name']}")
+            job = prepare_group_analysis(args, config, analysis_models, analysis_name, group_model_config["name"])
+            if job is None:
+                results.append({"analysis": analysis_name, "group_model": group_model_config["name"],
+                                "type": group_model_config.get("type", "?"), "n_inputs": 0, "jobs": 0,
+                                "status": "invalid inputs", "elapsed": 0.0, "log_file": ""})
+            else:
+                jobs.append(job)
+
+    if jobs:
+        cores = args.cores or os.cpu_count() or 1
+        concurrency = min(len(jobs), args.n_procs if args.n_procs > 1 else max(1, cores // 4))
+        jobs_per_model = max(1, cores // concurrency)
+        console.log(f"Running {len(jobs)} group models, {concurrency} at a time with {jobs_per_model} core(s) each.")
+
+        def run_job(job):
+            success, elapsed = execute_group_analysis(job, jobs_per_model)
+            console.log(f"{'[green]✓' if success else '[bold red]✖'} {job['analysis']} / {job['group_model']}[/] ({elapsed:.0f}s)")
+            return dict(job, jobs=jobs_per_model, status="done" if success else "failed", elapsed=elapsed)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results.extend(executor.map(run_job, jobs))
+
+    table = Table(title="Group analyses")
+    for column in ["Analysis", "Group model", "Type", "Inputs", "Cores", "Status", "Time", "Log"]:
+        table.add_column(column)
+    styles = {"done": "green", "failed": "bold red", "invalid inputs": "yellow"}
+    for result in results:
+        table.add_row(result["analysis"], result["group_model"], result["type"], str(result["n_inputs"]),
+                      str(result["jobs"]), f"[{styles[result['status']]}]{result['status']}[/]",
+                      f"{result['elapsed'] / 60:.1f} min", result["log_file"])
+    console.print(table)
+
 def main():
     """Main function to run the analysis pipeline."""
     parser = argparse.ArgumentParser(description="fMRI Analysis Pipeline Runner for WAR task")
     parser.add_argument("--subject", nargs='*', help="Specify subject IDs to process (e.g., sub-AL01). Overrides subject lists in configs.")
     parser.add_argument("--analysis", nargs='*', help="Specify one or more analysis models to run for 'glm', 'all', or 'group_analysis' step.")
-    parser.add_argument("--step", choices=["preprocess", "create_timings", "preprocess_anat", "preprocess_func", "glm", "all", "group_analysis"], required=True, help="The processing step to execute.")
+    parser.add_argument("--step", choices=["preprocess", "create_timings", "preprocess_anat", "preprocess_func", "glm", "all", "group_cube", "group_incremental", "group_analysis"], required=True, help="The processing step to execute.")
     parser.add_argument("--session", help="Specify the session number (e.g., 1). If not provided, all sessions for the subject(s) will be processed.")
-    parser.add_argument("--n_procs", type=int, default=1, help="Number of subjects to process in parallel.")
-    parser.add_argument("--group_model", help="Specify the group analysis model name to run (required for 'group_analysis' step).")
+    parser.add_argument("--n_procs", type=int, default=1, help="Number of subjects to process in parallel (with --group_model all: group models run concurrently, default cores // 4).")
+    parser.add_argument("--cores", type=int, help="For 'group_analysis', cores available to the group models (3dLMEr -jobs, OpenMP threads). Defaults to all cores with --group_model all.")
+    parser.add_argument("--group_model", help="Specify the group analysis model name to run (required for 'group_analysis' step). 'all' runs every group model of the --analysis models (default: all models) concurrently.")
+    parser.add_argument("--shared_baseline", action="store_true", help="For 'glm', build the motion/censor/polort design once per subject/session and reuse it for every model.")
+    parser.add_argument("--reml_slabs", type=int, default=1, help="For 'glm', split 3dREMLfit into this many z slabs run in parallel (cores are shared with --n_procs).")
+    parser.add_argument("--lmer_chunks", type=int, default=1, help="For 'group_analysis', split the group mask into this many disjoint chunks fitted by concurrent 3dLMEr processes (cores are shared with --cores).")
+    parser.add_argument("--qc", choices=["inline", "queue"], default="inline", help="Render QC images inline, or in a low-priority background queue that does not hold up the GLM/group steps.")
+    parser.add_argument("--qc_width", type=int, default=2, help="Number of QC images rendered in parallel with --qc queue.")
 
     args = parser.parse_args()
 
@@ -386,8 +723,24 @@ def main():
         console.print(f"[bold red]Error:[/] Configuration file not found. {e}")
         return
 
+    if args.step == "group_cube":
+        build_group_cubes(args, main_config, analysis_models)
+        return
+
+    if args.step == "group_incremental":
+        for analysis_name in args.analysis or list(analysis_models):
+            update_incremental_group_models(main_config, analysis_models, analysis_name)
+        return
+
     if args.step == "group_analysis":
-        run_group_analysis(args, main_config, analysis_models)
+        qc_worker = start_qc_worker(args, main_config)
+        try:
+            if args.group_model == "all":
+                run_all_group_analyses(args, main_config, analysis_models)
+            else:
+                run_group_analysis(args, main_config, analysis_models)
+        finally:
+            finish_qc_worker(qc_worker, main_config)
         return
 
     subjects_to_process_ids = []
@@ -414,43 +767,45 @@ def main():
                 return
     
     console.print(f"Processing [bold cyan]{len(subjects_to_process_ids)}[/] subjects.")
-    
-    # Using Rich Progress Bar
-    with Progress(
-        SpinnerColumn(),
-        TextColumn("[progress.description]{task.description}"),
-        BarColumn(),
-        TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
-        TimeRemainingColumn(),
-        console=console,
-    ) as progress:
+    qc_worker = start_qc_worker(args, main_config)
+    try:
+        # Using Rich Progress Bar
+        with Progress(
+            SpinnerColumn(),
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TextColumn("[progress.percentage]{task.percentage:>3.0f}%"),
+            TimeRemainingColumn(),
+            console=console,
+        ) as progress:
         
-        main_task = progress.add_task("[green]Overall Progress", total=len(subjects_to_process_ids))
+            main_task = progress.add_task("[green]Overall Progress", total=len(subjects_to_process_ids))
         
-        if args.n_procs > 1 and len(subjects_to_process_ids) > 1:
-            # We can't update rich progress easily from subprocesses without a Manager, 
-            # so for parallel processing, we might lose the granular progress bar updates per subject
-            # unless we use something like rich.progress.track for the main loop only.
-            # For simplicity in this implementation, if n_procs > 1, we just run the loop but lose the detailed
-            # inside-function progress updates, or we switch to sequential if we want pretty bars.
-            # Let's keep it sequential for the rich demo if the user didn't ask for massive parallel speed,
-            # OR we can just wrap the executor map.
+            if args.n_procs > 1 and len(subjects_to_process_ids) > 1:
+                # We can't update rich progress easily from subprocesses without a Manager, 
+                # so for parallel processing, we might lose the granular progress bar updates per subject
+                # unless we use something like rich.progress.track for the main loop only.
+                # For simplicity in this implementation, if n_procs > 1, we just run the loop but lose the detailed
+                # inside-function progress updates, or we switch to sequential if we want pretty bars.
+                # Let's keep it sequential for the rich demo if the user didn't ask for massive parallel speed,
+                # OR we can just wrap the executor map.
             
-            console.log(f"[yellow]Parallel processing with {args.n_procs} cores enabled. Detailed progress bars might be simplified.[/]")
+                console.log(f"[yellow]Parallel processing with {args.n_procs} cores enabled. Detailed progress bars might be simplified.[/]")
             
-            worker_func = partial(process_subject, args=args, main_config=main_config, analysis_models=analysis_models, progress=None, task_id=None)
+                worker_func = partial(process_subject, args=args, main_config=main_config, analysis_models=analysis_models, progress=None, task_id=None)
             
-            with ProcessPoolExecutor(max_workers=args.n_procs) as executor:
-                # We map the function and manually update the main bar as they finish
-                futures = [executor.submit(worker_func, sub_id) for sub_id in subjects_to_process_ids]
-                for future in futures:
-                    future.result() # Wait for each
-                    progress.update(main_task, advance=1)
-        else:
-            # Sequential processing allows us to pass the progress object down
-            for subject_id in subjects_to_process_ids:
-                process_subject(subject_id, args, main_config, analysis_models, progress, main_task)
-
+                with ProcessPoolExecutor(max_workers=args.n_procs) as executor:
+                    # We map the function and manually update the main bar as they finish
+                    futures = [executor.submit(worker_func, sub_id) for sub_id in subjects_to_process_ids]
+                    for future in futures:
+                        future.result() # Wait for each
+                        progress.update(main_task, advance=1)
+            else:
+                # Sequential processing allows us to pass the progress object down
+                for subject_id in subjects_to_process_ids:
+                    process_subject(subject_id, args, main_config, analysis_models, progress, main_task)
+    finally:
+        finish_qc_worker(qc_worker, main_config)
     console.print(Panel("[bold green]All processing complete[/]", style="green"))
 
 if __name__ == "__main__":
@@ -10,6 +10,7 @@ SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
 
 # Source the color utility script
 source "${SCRIPT_DIR}/utils_colors.sh"
+source "${SCRIPT_DIR}/utils_qc.sh"
 
 # Default values
 SUBJECT=""
@@ -17,6 +18,10 @@ SESSION="1"
 INPUT_DIR=""
 OUTPUT_DIR=""
 ANALYSIS_NAME=""
+BASELINE_DIR=""
+PREFITTED=0
+REML_SLABS=1
+CORES=$(nproc)
 
 # Parse command-line arguments
 while [[ "$#" -gt 0 ]]; do
@@ -26,6 +31,13 @@ while [[ "$#" -gt 0 ]]; do
         --input) INPUT_DIR="$2"; shift 2;;
         --output) OUTPUT_DIR="$2"; shift 2;;
         --analysis) ANALYSIS_NAME="$2"; shift 2;;
+        --baseline) BASELINE_DIR="$2"; shift 2;;
+        --prefitted) PREFITTED=1; shift 1;;
+        --reml_slabs) REML_SLABS="$2"; shift 2;;
+        --cores) CORES="$2"; shift 2;;
+        --qc) QC_MODE="$2"; shift 2;;
+        --qc_queue) QC_QUEUE="$2"; shift 2;;
+        --renderer) QC_RENDERER="$2"; shift 2;;
         *) log_error "Unknown option: $1"; exit 1;;
     esac
 done
@@ -50,6 +62,8 @@ STIM_FILES_RAW=$(echo "$MODEL_CONFIG" | awk '/stim_files = \[/{f=1;next} /]/{f=0
 STIM_LABELS_RAW=$(echo "$MODEL_CONFIG" | grep 'stim_labels' | sed 's/stim_labels = \[\(.*\)\]/\1/' | tr -d '"' | sed 's/ //g')
 BASIS=$(echo "$MODEL_CONFIG" | grep 'basis' | sed 's/basis = "\(.*\)"/\1/')
 STIM_TYPES=$(echo "$MODEL_CONFIG" | grep 'stim_types' | sed 's/stim_types = "\(.*\)".*/\1/')
+BACKEND=$(echo "$MODEL_CONFIG" | grep '^backend' | sed 's/backend = "\(.*\)".*/\1/')
+BACKEND=${BACKEND:-afni}
 
 IFS=',' read -r -a STIM_FILES <<< "$STIM_FILES_RAW"
 IFS=',' read -r -a STIM_LABELS <<< "$STIM_LABELS_RAW"
@@ -64,6 +78,7 @@ REGRESS_STIM_LABELS_ARGS=("-regress_stim_labels" "${STIM_LABELS[@]}")
 
 # Construct GLT arguments
 GLT_ARGS=""
+GLT_3DD_ARGS=()
 i=1
 while IFS= read -r line; do
     if [[ $line == *"sym ="* ]]; then
@@ -71,6 +86,7 @@ while IFS= read -r line; do
     elif [[ $line == *"label ="* ]]; then
         label=$(echo "$line" | sed -e 's/.*label = "\(.*\)".*/\1/')
         GLT_ARGS+="-gltsym 'SYM: ${sym}' -glt_label ${i} ${label} "
+        GLT_3DD_ARGS+=(-gltsym "SYM: ${sym}" -glt_label "${i}" "${label}")
         i=$((i+1))
     fi
 done <<< "$(echo "$MODEL_CONFIG" | grep -A 2 'glt')"
@@ -78,8 +94,8 @@ done <<< "$(echo "$MODEL_CONFIG" | grep -A 2 'glt')"
 
 print_header "Starting GLM Analysis (${ANALYSIS_NAME}) for ${SUBJECT}, ${SESSION_PREFIX}"
 
-# Clean up previous output directory
-if [ -d "$GLM_OUTPUT_DIR" ]; then
+# Clean up previous output directory (unless 03b_fit_native_glm.sh just wrote it)
+if [ "$PREFITTED" -eq 0 ] && [ -d "$GLM_OUTPUT_DIR" ]; then
     log_warn "Found existing GLM folder, deleting it: ${GLM_OUTPUT_DIR}"
     rm -rf "$GLM_OUTPUT_DIR"
 fi
@@ -94,40 +110,156 @@ if [ -n "$STIM_TYPES" ]; then
     STIM_TYPES_ARG="-regress_stim_types $STIM_TYPES"
 fi
 
-# Run afni_proc.py for the GLM
-afni_proc.py \
-    -subj_id "${SUBJECT}_${ANALYSIS_NAME}" \
-    -dsets ${PREPROC_DIR}/pb05.${SUBJECT}_preproc.r*.scale+tlrc.HEAD \
-    -blocks regress \
-    "${REGRESS_STIM_TIMES_ARGS[@]}" \
-    "${REGRESS_STIM_LABELS_ARGS[@]}" \
-    ${STIM_TYPES_ARG} \
-    -regress_basis "$BASIS" \
-    ${GLT_ARGS} \
-    -regress_opts_3dD -jobs 8 \
-    -regress_motion_file "${PREPROC_DIR}/dfile_rall.1D" \
-    -regress_motion_per_run \
-    -regress_censor_motion 0.5 \
-    -regress_censor_outliers 0.05 \
-    -regress_reml_exec \
-    -regress_no_mask \
-    -regress_compute_fitts \
-    -regress_make_ideal_sum sum_ideal.1D \
-    -regress_run_clustsim no \
-    -remove_preproc_files \
-    -execute
+# Runs 3dREMLfit on z slabs in parallel (utils/reml_slabs.py) from inside the .results directory.
+run_reml_slabs() {
+    print_subheader "3dREMLfit on ${REML_SLABS} slabs (${CORES} cores)"
+    python "${SCRIPT_DIR}/../utils/reml_slabs.py" \
+        --matrix X.xmat.1D \
+        --input "$@" \
+        --Rbuck "stats.${SUBJ_ID}_REML" \
+        --Rvar "stats.${SUBJ_ID}_REMLvar" \
+        --Rfitts "fitts.${SUBJ_ID}_REML" \
+        --Rerrts "errts.${SUBJ_ID}_REML" \
+        --slabs "$REML_SLABS" \
+        --cores "$CORES" \
+        -- -fout -tout -verb
+}
+
+SUBJ_ID="${SUBJECT}_${ANALYSIS_NAME}"
+
+# With --reml_slabs, afni_proc.py only runs 3dDeconvolve and 3dREMLfit is run here on slabs instead.
+REML_EXEC_ARG="-regress_reml_exec"
+if [ "$REML_SLABS" -gt 1 ]; then
+    REML_EXEC_ARG=""
+fi
+
+if [ "$PREFITTED" -eq 1 ]; then
+    log_info "Model already fitted in a multi-model pass (03b_fit_native_glm.sh)."
+elif [ "$BACKEND" == "native" ]; then
+    # Native backend: the model is fitted in numpy (utils/native_glm.py) against the shared baseline.
+    if [ -z "$BASELINE_DIR" ] || [ ! -f "${BASELINE_DIR}/baseline.done" ]; then
+        log_error "The native backend needs a shared baseline (--baseline). Run 03a_prepare_glm_baseline.sh first."
+        exit 1
+    fi
+    print_subheader "Fitting ${ANALYSIS_NAME} with the native GLM backend"
+    python "${SCRIPT_DIR}/../utils/native_glm.py" \
+        --subject "$SUBJECT" \
+        --session "$SESSION" \
+        --input "$INPUT_DIR" \
+        --output "$OUTPUT_DIR" \
+        --analysis "$ANALYSIS_NAME" \
+        --baseline "$BASELINE_DIR" \
+        --models_config "${SCRIPT_DIR}/../${CONFIG_FILE}"
+elif [ -n "$BASELINE_DIR" ]; then
+    # Shared-baseline mode: motion regressors, censor vector and polort come from
+    # 03a_prepare_glm_baseline.sh, so only the model-specific fit runs here.
+    if [ ! -f "${BASELINE_DIR}/baseline.done" ]; then
+        log_error "Shared baseline not found at ${BASELINE_DIR}. Run 03a_prepare_glm_baseline.sh first."
+        exit 1
+    fi
+    print_subheader "Fitting ${ANALYSIS_NAME} against shared baseline ${BASELINE_DIR}"
+
+    RESULTS_DIR="${SUBJ_ID}.results"
+    mkdir -p "$RESULTS_DIR"
+    cd "$RESULTS_DIR"
+
+    mapfile -t ORTVEC_ARGS < "${BASELINE_DIR}/ortvec_args.txt"
+    DSETS=( "${PREPROC_DIR}"/pb05.${SUBJECT}_preproc.r*.scale+tlrc.HEAD )
+
+    STIM_3DD_ARGS=()
+    k=1
+    for idx in "${!STIM_PATHS[@]}"; do
+        case "$STIM_TYPES" in
+            file) STIM_3DD_ARGS+=(-stim_file "$k" "${STIM_PATHS[$idx]}");;
+            AM1|AM2|IM) STIM_3DD_ARGS+=("-stim_times_${STIM_TYPES}" "$k" "${STIM_PATHS[$idx]}" "$BASIS");;
+            *) STIM_3DD_ARGS+=(-stim_times "$k" "${STIM_PATHS[$idx]}" "$BASIS");;
+        esac
+        STIM_3DD_ARGS+=(-stim_label "$k" "${STIM_LABELS[$idx]}")
+        k=$((k+1))
+    done
+
+    3dDeconvolve -input "${DSETS[@]}" \
+        -censor "${BASELINE_DIR}/censor_${SUBJECT}_combined_2.1D" \
+        "${ORTVEC_ARGS[@]}" \
+        -polort A -float \
+        -num_stimts "${#STIM_PATHS[@]}" \
+        "${STIM_3DD_ARGS[@]}" \
+        -jobs 8 \
+        -num_glt $((i-1)) \
+        "${GLT_3DD_ARGS[@]}" \
+        -fout -tout -x1D X.xmat.1D -xjpeg X.jpg \
+        -x1D_uncensored X.nocensor.xmat.1D \
+        -fitts "fitts.${SUBJ_ID}" \
+        -errts "errts.${SUBJ_ID}" \
+        -bucket "stats.${SUBJ_ID}"
+
+    if [ "$REML_SLABS" -gt 1 ]; then
+        run_reml_slabs "${DSETS[@]}"
+    else
+        3dREMLfit -matrix X.xmat.1D -input "${DSETS[*]}" \
+            -fout -tout -Rbuck "stats.${SUBJ_ID}_REML" -Rvar "stats.${SUBJ_ID}_REMLvar" \
+            -Rfitts "fitts.${SUBJ_ID}_REML" -Rerrts "errts.${SUBJ_ID}_REML" -verb
+    fi
+
+    REG_COLS=$(1d_tool.py -infile X.nocensor.xmat.1D -show_indices_interest)
+    3dTstat -sum -prefix sum_ideal.1D X.nocensor.xmat.1D"[$REG_COLS]"
+
+    cd "$GLM_OUTPUT_DIR"
+else
+    # Run afni_proc.py for the GLM
+    afni_proc.py \
+        -subj_id "${SUBJECT}_${ANALYSIS_NAME}" \
+        -dsets ${PREPROC_DIR}/pb05.${SUBJECT}_preproc.r*.scale+tlrc.HEAD \
+        -blocks regress \
+        "${REGRESS_STIM_TIMES_ARGS[@]}" \
+        "${REGRESS_STIM_LABELS_ARGS[@]}" \
+        ${STIM_TYPES_ARG} \
+        -regress_basis "$BASIS" \
+        ${GLT_ARGS} \
+        -regress_opts_3dD -jobs 8 \
+        -regress_motion_file "${PREPROC_DIR}/dfile_rall.1D" \
+        -regress_motion_per_run \
+        -regress_censor_motion 0.5 \
+        -regress_censor_outliers 0.05 \
+        ${REML_EXEC_ARG} \
+        -regress_no_mask \
+        -regress_compute_fitts \
+        -regress_make_ideal_sum sum_ideal.1D \
+        -regress_run_clustsim no \
+        -remove_preproc_files \
+        -execute
+
+    if [ "$REML_SLABS" -gt 1 ]; then
+        # The pb00 copies of the inputs are removed by -remove_preproc_files, so fit the pb05 originals.
+        cd "${SUBJ_ID}.results"
+        run_reml_slabs "${PREPROC_DIR}"/pb05.${SUBJECT}_preproc.r*.scale+tlrc.HEAD
+        cd "$GLM_OUTPUT_DIR"
+    fi
+fi
 
 log_success "GLM Analysis for ${SUBJECT} Complete"
 
-print_subheader "Exporting QC images using @chauffeur_afni"
+print_subheader "Exporting QC images (${QC_RENDERER} renderer, ${QC_MODE})"
 QC_DIR="QC"
 mkdir -p "$QC_DIR"
 
+ULAY="../../func_preproc/${SUBJECT}_preproc.results/anat_final.${SUBJECT}_preproc+tlrc.HEAD"
+OLAY="${SUBJECT}_${ANALYSIS_NAME}.results/stats.${SUBJECT}_${ANALYSIS_NAME}+tlrc.HEAD"
 for stim in "${STIM_LABELS[@]}"; do
+    if [ "$QC_RENDERER" == "python" ]; then
+        qc_render "${QC_DIR}/${stim}" "$OLAY" "$ULAY" \
+        python "${SCRIPT_DIR}/../utils/montage_renderer.py" \
+            --ulay "$ULAY" \
+            --olay "$OLAY" \
+            --olay_brick "${stim}#0_Coef" \
+            --thr_brick "${stim}#0_Tstat"
+        continue
+    fi
+    qc_render "${QC_DIR}/${stim}" "$OLAY" "$ULAY" \
     @chauffeur_afni                                             \
-        -ulay               "../../func_preproc/${SUBJECT}_preproc.results/anat_final.${SUBJECT}_preproc+tlrc.HEAD"      \
+        -ulay               "$ULAY"                             \
         -ulay_range         0% 130%                             \
-        -olay               "${SUBJECT}_${ANALYSIS_NAME}.results/stats.${SUBJECT}_${ANALYSIS_NAME}+tlrc.HEAD"   \
+        -olay               "$OLAY"                             \
         -box_focus_slices   AMASK_FOCUS_ULAY                    \
         -func_range         3                                   \
         -cbar               Reds_and_Blues_Inv                  \
@@ -139,7 +271,6 @@ for stim in "${STIM_LABELS[@]}"; do
         -set_dicom_xyz      -20 -8 -16                          \
         -delta_slices       6 15 10                             \
         -opacity            5                                   \
-        -prefix             "${QC_DIR}/${stim}"             \
         -set_xhairs         OFF                                 \
         -montx 3 -monty 3                                       \
         -label_mode 1 -label_size 4
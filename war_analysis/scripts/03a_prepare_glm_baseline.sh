@@ -0,0 +1,140 @@
+#!/bin/bash
+
+# --- Script: 03a_prepare_glm_baseline.sh ---
+# Description: Builds the nuisance design shared by every GLM model of a subject/session
+#              (per-run demeaned motion regressors, motion/outlier censor vector and polort baseline),
+#              so that 03_run_glm.sh --baseline only has to fit the model-specific regressors.
+
+set -e # Exit immediately if a command exits with a non-zero status.
+
+# Get the directory where the script is located
+SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
+
+# Source the color utility script
+source "${SCRIPT_DIR}/utils_colors.sh"
+
+# Default values
+SUBJECT=""
+SESSION="1"
+INPUT_DIR=""
+OUTPUT_DIR=""
+CENSOR_MOTION=0.5
+CENSOR_OUTLIERS=0.05
+FORCE=0
+
+# Parse command-line arguments
+while [[ "$#" -gt 0 ]]; do
+    case "$1" in
+        --subject) SUBJECT="$2"; shift 2;;
+        --session) SESSION="$2"; shift 2;;
+        --input) INPUT_DIR="$2"; shift 2;;
+        --output) OUTPUT_DIR="$2"; shift 2;;
+        --censor_motion) CENSOR_MOTION="$2"; shift 2;;
+        --censor_outliers) CENSOR_OUTLIERS="$2"; shift 2;;
+        --force) FORCE=1; shift 1;;
+        *) log_error "Unknown option: $1"; exit 1;;
+    esac
+done
+
+# Validate required arguments
+if [ -z "$SUBJECT" ] || [ -z "$SESSION" ] || [ -z "$OUTPUT_DIR" ]; then
+    log_error "Usage: $0 --subject <ID> --session <N> --output <dir> [--censor_motion <mm>] [--censor_outliers <frac>] [--force]"
+    exit 1
+fi
+
+SESSION_PREFIX="ses-${SESSION}"
+PREPROC_DIR="${OUTPUT_DIR}/${SUBJECT}/${SESSION_PREFIX}/func_preproc/${SUBJECT}_preproc.results"
+BASELINE_DIR="${OUTPUT_DIR}/${SUBJECT}/${SESSION_PREFIX}/glm/_shared_baseline"
+DONE_FILE="${BASELINE_DIR}/baseline.done"
+
+print_header "Preparing Shared GLM Baseline for ${SUBJECT}, ${SESSION_PREFIX}"
+
+DSETS=( "${PREPROC_DIR}"/pb05.${SUBJECT}_preproc.r*.scale+tlrc.HEAD )
+if [ ! -f "${DSETS[0]}" ]; then
+    log_error "No pb05 scale datasets found in ${PREPROC_DIR}"
+    exit 1
+fi
+MOTION_FILE="${PREPROC_DIR}/dfile_rall.1D"
+OUTCOUNT_FILE="${PREPROC_DIR}/outcount_rall.1D"
+
+# Reuse an existing baseline unless an input or a threshold changed since it was built.
+if [ "$FORCE" -eq 0 ] && [ -f "$DONE_FILE" ]; then
+    STALE=0
+    for f in "${DSETS[@]}" "$MOTION_FILE" "$OUTCOUNT_FILE"; do
+        if [ "$f" -nt "$DONE_FILE" ]; then STALE=1; fi
+    done
+    if [ "$(cat "$DONE_FILE")" != "motion=${CENSOR_MOTION} outliers=${CENSOR_OUTLIERS}" ]; then STALE=1; fi
+    if [ "$STALE" -eq 0 ]; then
+        log_success "Shared baseline is up to date: ${BASELINE_DIR}"
+        exit 0
+    fi
+fi
+
+rm -rf "$BASELINE_DIR"
+mkdir -p "$BASELINE_DIR"
+cd "$BASELINE_DIR"
+
+# --- Run lengths ---
+RUN_LENGTHS=()
+for dset in "${DSETS[@]}"; do
+    RUN_LENGTHS+=( "$(3dinfo -nt "$dset")" )
+done
+TR=$(3dinfo -tr "${DSETS[0]}")
+log_info "Runs: ${#DSETS[@]} (lengths: ${RUN_LENGTHS[*]}, TR: ${TR})"
+
+# --- Motion regressors (demeaned, one set per run) ---
+print_subheader "Motion Regressors"
+1d_tool.py -infile "$MOTION_FILE" -set_run_lengths "${RUN_LENGTHS[@]}" \
+    -demean -write motion_demean.1D
+1d_tool.py -infile motion_demean.1D -set_run_lengths "${RUN_LENGTHS[@]}" \
+    -split_into_pad_runs mot_demean
+
+# --- Censoring ---
+print_subheader "Censoring (motion > ${CENSOR_MOTION}, outliers > ${CENSOR_OUTLIERS})"
+1d_tool.py -infile "$MOTION_FILE" -set_run_lengths "${RUN_LENGTHS[@]}" \
+    -show_censor_count -censor_prev_TR \
+    -censor_motion "$CENSOR_MOTION" "motion_${SUBJECT}"
+
+if [ -f "$OUTCOUNT_FILE" ]; then
+    1deval -a "$OUTCOUNT_FILE" -expr "1-step(a-${CENSOR_OUTLIERS})" > rm.out.cen.1D
+    1deval -a "motion_${SUBJECT}_censor.1D" -b rm.out.cen.1D \
+        -expr "a*b" > "censor_${SUBJECT}_combined_2.1D"
+else
+    log_warn "Outlier counts not found at ${OUTCOUNT_FILE}. Censoring on motion only."
+    cp "motion_${SUBJECT}_censor.1D" "censor_${SUBJECT}_combined_2.1D"
+fi
+
+# --- Nuisance design (polort + motion), with and without censored rows ---
+print_subheader "Nuisance Design Matrix"
+ORTVEC_ARGS=()
+for mot_file in mot_demean.r*.1D; do
+    run_label=$(echo "$mot_file" | sed 's/mot_demean\.\(r[0-9]*\)\.1D/\1/')
+    ORTVEC_ARGS+=( -ortvec "${BASELINE_DIR}/${mot_file}" "mot_demean_${run_label}" )
+done
+printf '%s\n' "${ORTVEC_ARGS[@]}" > ortvec_args.txt
+
+3dDeconvolve -input "${DSETS[@]}" \
+    -censor "censor_${SUBJECT}_combined_2.1D" \
+    "${ORTVEC_ARGS[@]}" \
+    -polort A -float \
+    -num_stimts 0 \
+    -x1D X.nuisance.xmat.1D \
+    -x1D_uncensored X.nuisance.nocensor.xmat.1D \
+    -x1D_stop
+
+cat > baseline.json << EOF
+{
+  "subject": "${SUBJECT}",
+  "session": "${SESSION}",
+  "tr": ${TR},
+  "run_lengths": [$(IFS=,; echo "${RUN_LENGTHS[*]}")],
+  "dsets": [$(printf '"%s",' "${DSETS[@]}" | sed 's/,$//')],
+  "censor_file": "${BASELINE_DIR}/censor_${SUBJECT}_combined_2.1D",
+  "nuisance_xmat": "${BASELINE_DIR}/X.nuisance.nocensor.xmat.1D",
+  "censor_motion": ${CENSOR_MOTION},
+  "censor_outliers": ${CENSOR_OUTLIERS}
+}
+EOF
+
+echo "motion=${CENSOR_MOTION} outliers=${CENSOR_OUTLIERS}" > "$DONE_FILE"
+log_success "Shared baseline for ${SUBJECT} ready: ${BASELINE_DIR}"
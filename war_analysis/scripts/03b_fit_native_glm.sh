@@ -0,0 +1,71 @@
+#!/bin/bash
+
+# --- Script: 03b_fit_native_glm.sh ---
+# Description: Fits several native-backend GLM models of a subject/session in a single pass over the
+#              preprocessed data (utils/native_glm.py). 03_run_glm.sh --prefitted then only exports QC images.
+
+set -e # Exit immediately if a command exits with a non-zero status.
+
+# Get the directory where the script is located
+SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
+
+# Source the color utility script
+source "${SCRIPT_DIR}/utils_colors.sh"
+
+# Default values
+SUBJECT=""
+SESSION="1"
+INPUT_DIR=""
+OUTPUT_DIR=""
+ANALYSES=""
+BASELINE_DIR=""
+CONFIG_FILE="${SCRIPT_DIR}/../analysis_configs/analysis_models.toml"
+
+# Parse command-line arguments
+while [[ "$#" -gt 0 ]]; do
+    case "$1" in
+        --subject) SUBJECT="$2"; shift 2;;
+        --session) SESSION="$2"; shift 2;;
+        --input) INPUT_DIR="$2"; shift 2;;
+        --output) OUTPUT_DIR="$2"; shift 2;;
+        --analyses) ANALYSES="$2"; shift 2;;
+        --baseline) BASELINE_DIR="$2"; shift 2;;
+        *) log_error "Unknown option: $1"; exit 1;;
+    esac
+done
+
+# Validate required arguments
+if [ -z "$SUBJECT" ] || [ -z "$INPUT_DIR" ] || [ -z "$OUTPUT_DIR" ] || [ -z "$ANALYSES" ] || [ -z "$BASELINE_DIR" ]; then
+    log_error "Usage: $0 --subject <ID> --session <N> --input <dir> --output <dir> --analyses <a,b,...> --baseline <dir>"
+    exit 1
+fi
+
+if [ ! -f "${BASELINE_DIR}/baseline.done" ]; then
+    log_error "Shared baseline not found at ${BASELINE_DIR}. Run 03a_prepare_glm_baseline.sh first."
+    exit 1
+fi
+
+SESSION_PREFIX="ses-${SESSION}"
+IFS=',' read -r -a ANALYSIS_NAMES <<< "$ANALYSES"
+
+print_header "Fitting ${#ANALYSIS_NAMES[@]} native GLM models for ${SUBJECT}, ${SESSION_PREFIX}"
+
+# Clean up previous output directories
+for analysis in "${ANALYSIS_NAMES[@]}"; do
+    GLM_OUTPUT_DIR="${OUTPUT_DIR}/${SUBJECT}/${SESSION_PREFIX}/glm/${analysis}"
+    if [ -d "$GLM_OUTPUT_DIR" ]; then
+        log_warn "Found existing GLM folder, deleting it: ${GLM_OUTPUT_DIR}"
+        rm -rf "$GLM_OUTPUT_DIR"
+    fi
+done
+
+python "${SCRIPT_DIR}/../utils/native_glm.py" \
+    --subject "$SUBJECT" \
+    --session "$SESSION" \
+    --input "$INPUT_DIR" \
+    --output "$OUTPUT_DIR" \
+    --analysis "${ANALYSIS_NAMES[@]}" \
+    --baseline "$BASELINE_DIR" \
+    --models_config "$CONFIG_FILE"
+
+log_success "Native GLM models for ${SUBJECT} complete: ${ANALYSIS_NAMES[*]}"
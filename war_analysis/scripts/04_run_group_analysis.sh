@@ -10,6 +10,7 @@ SCRIPT_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
 
 # Source the color utility script
 source "${SCRIPT_DIR}/utils_colors.sh"
+source "${SCRIPT_DIR}/utils_qc.sh"
 
 # Default values
 ANALYSIS_TYPE=""
@@ -20,6 +21,16 @@ MODEL=""
 GLT_CODES=""
 SET_A_LABEL=""
 SET_A_FILES=""
+SET_B_LABEL=""
+SET_B_FILES=""
+PAIRED=0
+BACKEND="afni"
+PERMUTATIONS=0
+CUBE_DIR=""
+JOBS=""
+LMER_CHUNKS=1
+CLUSTSIM_CACHE=""
+ACF_PRECISION=0.01
 
 # Parse command-line arguments
 while [[ "$#" -gt 0 ]]; do
@@ -32,6 +43,19 @@ while [[ "$#" -gt 0 ]]; do
         --glt_codes) GLT_CODES="$2"; shift 2;; 
         --setA_label) SET_A_LABEL="$2"; shift 2;; 
         --setA_files) SET_A_FILES="$2"; shift 2;; 
+        --setB_label) SET_B_LABEL="$2"; shift 2;;
+        --setB_files) SET_B_FILES="$2"; shift 2;;
+        --paired) PAIRED=1; shift 1;;
+        --backend) BACKEND="$2"; shift 2;;
+        --permutations) PERMUTATIONS="$2"; shift 2;;
+        --cube_dir) CUBE_DIR="$2"; shift 2;;
+        --jobs) JOBS="$2"; shift 2;;
+        --lmer_chunks) LMER_CHUNKS="$2"; shift 2;;
+        --clustsim_cache) CLUSTSIM_CACHE="$2"; shift 2;;
+        --acf_precision) ACF_PRECISION="$2"; shift 2;;
+        --qc) QC_MODE="$2"; shift 2;;
+        --qc_queue) QC_QUEUE="$2"; shift 2;;
+        --renderer) QC_RENDERER="$2"; shift 2;;
         *) log_error "Unknown option: $1"; exit 1;; 
     esac
 done
@@ -54,6 +78,14 @@ fi
 print_header "Starting Group Analysis: ${OUTPUT_PREFIX}"
 log_info "Analysis Type: ${ANALYSIS_TYPE}"
 
+# Core budget of this model when several group models run concurrently (run_analysis.py --group_model all)
+JOBS_ARG=""
+if [ -n "$JOBS" ]; then
+    log_info "Cores: ${JOBS}"
+    export OMP_NUM_THREADS="$JOBS"
+    JOBS_ARG="-jobs $JOBS"
+fi
+
 # Run analysis based on type
 if [ "$ANALYSIS_TYPE" == "3dLMEr" ]; then
     if [ -z "$DATA_TABLE_FILE" ] || [ -z "$MODEL" ]; then
@@ -64,13 +96,37 @@ if [ "$ANALYSIS_TYPE" == "3dLMEr" ]; then
     log_info "Model: ${MODEL}"
     log_info "Data Table: ${DATA_TABLE_FILE}"
 
-    CMD="3dLMEr -prefix \"$OUTPUT_PREFIX\" \
-        -mask \"$MASK\" \
-        -SS_type 3 \
+    LMER_ARGS="-SS_type 3 \
         -model \"$MODEL\" \
         ${GLT_CODES} \
-        -dataTable @\"$DATA_TABLE_FILE\" \
-        -resid \"${OUTPUT_PREFIX}_resid\""
+        -dataTable @\"$DATA_TABLE_FILE\""
+
+    if [ "$BACKEND" == "native" ]; then
+        # Random-intercept models fitted by vectorized REML, with 3dLMEr's labels and residuals
+        CMD="python \"${SCRIPT_DIR}/../utils/group_lmm.py\" \
+            --prefix \"$OUTPUT_PREFIX\" \
+            --mask \"$MASK\" \
+            --resid \"${OUTPUT_PREFIX}_resid\" \
+            --model \"$MODEL\" \
+            --glt_codes '${GLT_CODES}' \
+            --data_table \"$DATA_TABLE_FILE\""
+        if [ -n "$CUBE_DIR" ]; then CMD="$CMD --cube_dir \"$CUBE_DIR\""; fi
+    elif [ "$LMER_CHUNKS" -gt 1 ]; then
+        # Disjoint sub-masks fitted concurrently, then merged into the same stats and residual datasets
+        CMD="python \"${SCRIPT_DIR}/../utils/lmer_chunks.py\" \
+            --prefix \"$OUTPUT_PREFIX\" \
+            --mask \"$MASK\" \
+            --resid \"${OUTPUT_PREFIX}_resid\" \
+            --chunks $LMER_CHUNKS \
+            --cores ${JOBS:-$(nproc)} \
+            -- ${LMER_ARGS}"
+    else
+        CMD="3dLMEr -prefix \"$OUTPUT_PREFIX\" \
+            -mask \"$MASK\" \
+            ${JOBS_ARG} \
+            ${LMER_ARGS} \
+            -resid \"${OUTPUT_PREFIX}_resid\""
+    fi
 
     log_info "Executing: $CMD"
     if [ -f "${OUTPUT_PREFIX}+tlrc.HEAD" ]; then
@@ -93,19 +149,16 @@ if [ "$ANALYSIS_TYPE" == "3dLMEr" ]; then
              # The output might have 4 values (a, b, c, FWHM). We need the first 3.
              read -r a b c fwhm <<< "$ACF_PARAMS"
              
-             log_info "Running 3dClustSim with ACF: $a $b $c"
-             3dClustSim -mask "$MASK" -acf $a $b $c -both -prefix "${OUTPUT_PREFIX}_ClustSim"
-             
+             # Models with the same mask and (rounded) ACF share one cached 3dClustSim simulation
+             log_info "Running 3dClustSim with ACF: $a $b $c (cached by mask and ACF rounded to ${ACF_PRECISION})"
+             python "${SCRIPT_DIR}/../utils/clustsim_cache.py" \
+                 --mask "$MASK" \
+                 --acf $a $b $c \
+                 --precision "$ACF_PRECISION" \
+                 --cache_dir "${CLUSTSIM_CACHE:-$(dirname "$OUTPUT_PREFIX")/_clustsim_cache}" \
+                 --prefix "${OUTPUT_PREFIX}_ClustSim"
+
              CMD_FILE="${OUTPUT_PREFIX}_ClustSim.cmd"
-             
-             # Check for generic output filename (common in some AFNI versions)
-             if [ ! -f "$CMD_FILE" ]; then
-                 OUTPUT_DIR=$(dirname "$OUTPUT_PREFIX")
-                 if [ -f "${OUTPUT_DIR}/3dClustSim.cmd" ]; then
-                     log_warn "Found generic 3dClustSim.cmd, renaming to match prefix..."
-                     mv "${OUTPUT_DIR}/3dClustSim.cmd" "${CMD_FILE}"
-                 fi
-             fi
 
              if [ -f "${CMD_FILE}" ]; then
                  log_info "Attaching ClustSim tables to output..."
@@ -133,9 +186,32 @@ elif [ "$ANALYSIS_TYPE" == "3dttest++" ]; then
         exit 1
     fi
 
-    3dttest++ -prefix "$OUTPUT_PREFIX" \
-        -mask "$MASK" \
-        -setA "$SET_A_LABEL" ${SET_A_FILES}
+    if [ "$BACKEND" == "native" ]; then
+        # Vectorized t-test over the stacked contrast, with optional max-statistic permutation inference
+        NATIVE_ARGS=()
+        if [ -n "$SET_B_FILES" ]; then
+            NATIVE_ARGS=(--setB_label "$SET_B_LABEL" --setB_files ${SET_B_FILES})
+            if [ "$PAIRED" -eq 1 ]; then NATIVE_ARGS+=(--paired); fi
+        fi
+        if [ -n "$CUBE_DIR" ]; then NATIVE_ARGS+=(--cube_dir "$CUBE_DIR"); fi
+        python "${SCRIPT_DIR}/../utils/group_ttest.py" \
+            --prefix "$OUTPUT_PREFIX" \
+            --mask "$MASK" \
+            --setA_label "$SET_A_LABEL" \
+            --setA_files ${SET_A_FILES} \
+            "${NATIVE_ARGS[@]}" \
+            --permutations "$PERMUTATIONS"
+    else
+        SET_B_ARGS=()
+        if [ -n "$SET_B_FILES" ]; then
+            SET_B_ARGS=(-setB "$SET_B_LABEL" ${SET_B_FILES})
+            if [ "$PAIRED" -eq 1 ]; then SET_B_ARGS+=(-paired); fi
+        fi
+        3dttest++ -prefix "$OUTPUT_PREFIX" \
+            -mask "$MASK" \
+            -setA "$SET_A_LABEL" ${SET_A_FILES} \
+            "${SET_B_ARGS[@]}"
+    fi
 
 else
     log_error "Unknown analysis type '${ANALYSIS_TYPE}'"
@@ -144,7 +220,7 @@ fi
 
 log_success "Group Analysis Complete. Output: ${OUTPUT_PREFIX}+tlrc"
 
-print_subheader "Generating report images with @chauffeur_afni"
+print_subheader "Generating report images (${QC_RENDERER} renderer, ${QC_MODE})"
 CHAUFFEUR_DIR="${OUTPUT_PREFIX}_images"
 mkdir -p "$CHAUFFEUR_DIR"
 
@@ -190,13 +266,11 @@ if [ -f "${OUTPUT_PREFIX}+tlrc.HEAD" ]; then
                 fi
             done
             
-            SUBBRICKS_ARG=()
+            OLAY_LABEL="$STAT_LABEL" # Fallback: Use stat for both
             if [ "$HAS_INTEN" -eq 1 ]; then
-                 SUBBRICKS_ARG=(-set_subbricks -1 "$INTEN_LABEL" "$STAT_LABEL")
-            else
-                 # Fallback: Use stat for both
-                 SUBBRICKS_ARG=(-set_subbricks -1 "$STAT_LABEL" "$STAT_LABEL")
+                 OLAY_LABEL="$INTEN_LABEL"
             fi
+            SUBBRICKS_ARG=(-set_subbricks -1 "$OLAY_LABEL" "$STAT_LABEL")
 
             SAFE_NAME=$(echo "$INTEN_LABEL" | tr ' :' '__')
             # Fallback if INTEN_LABEL was empty or just spaces
@@ -205,6 +279,19 @@ if [ -f "${OUTPUT_PREFIX}+tlrc.HEAD" ]; then
             log_info "Generating image for: $SAFE_NAME ($STAT_LABEL)"
             
             set +e # Don't exit on single image failure
+            if [ "$QC_RENDERER" == "python" ]; then
+                qc_render "${CHAUFFEUR_DIR}/${SAFE_NAME}" "${OUTPUT_PREFIX}+tlrc.HEAD" "$MNI_TEMPLATE" \
+                python "${SCRIPT_DIR}/../utils/montage_renderer.py" \
+                    --ulay "$MNI_TEMPLATE" \
+                    --olay "${OUTPUT_PREFIX}+tlrc" \
+                    --olay_brick "$OLAY_LABEL" \
+                    --thr_brick "$STAT_LABEL" \
+                    --clusterize 2 35 \
+                    --zerocolor white
+                set -e
+                continue
+            fi
+            qc_render "${CHAUFFEUR_DIR}/${SAFE_NAME}" "${OUTPUT_PREFIX}+tlrc.HEAD" "$MNI_TEMPLATE" \
             @chauffeur_afni \
                 -ulay               "$MNI_TEMPLATE" \
                 -ulay_range         0% 130% \
@@ -222,7 +309,6 @@ if [ -f "${OUTPUT_PREFIX}+tlrc.HEAD" ]; then
                 -set_dicom_xyz -20 -8 -16 \
                 -delta_slices 6 15 10 \
                 -clusterize "-NN 2 -clust_nvox 35" \
-                -prefix             "${CHAUFFEUR_DIR}/${SAFE_NAME}" \
                 -set_xhairs         OFF \
                 -label_mode         1 \
                 -label_size         3 \
@@ -0,0 +1,29 @@
+#!/bin/bash
+
+# --- Script: utils_qc.sh ---
+# Description: QC image rendering helper shared by the GLM and group scripts.
+#              With QC_MODE=queue the render command is added to the low-priority queue in QC_QUEUE
+#              (utils/qc_queue.py) instead of running inline. QC_RENDERER selects @chauffeur_afni ("afni")
+#              or utils/montage_renderer.py ("python") in the scripts that use it.
+
+UTILS_QC_DIR=$( cd -- "$( dirname -- "${BASH_SOURCE[0]}" )" &> /dev/null && pwd )
+QC_MODE="${QC_MODE:-inline}"
+QC_QUEUE="${QC_QUEUE:-}"
+QC_RENDERER="${QC_RENDERER:-afni}"
+
+# Usage: qc_render <output prefix> <overlay dataset> <underlay dataset> <render command without -prefix...>
+qc_render() {
+    local prefix="$1"
+    local olay="$2"
+    local ulay="$3"
+    shift 3
+    if [ "$QC_MODE" == "queue" ] && [ -n "$QC_QUEUE" ]; then
+        python "${UTILS_QC_DIR}/../utils/qc_queue.py" enqueue \
+            --queue "$QC_QUEUE" \
+            --prefix "$prefix" \
+            --inputs "$olay" "$ulay" \
+            -- "$@"
+    else
+        "$@" -prefix "$prefix"
+    fi
+}
@@ -0,0 +1,400 @@
+"""
+Minimal reader/writer for AFNI HEAD/BRIK datasets (and uncompressed NIfTI through nibabel, if installed).
+
+Datasets are exposed as (attributes, data) where data is a memory-mapped (n_sub_bricks, n_voxels) array,
+voxels in AFNI order (x fastest, then y, then z). Paths take AFNI sub-brick selectors, so only the requested
+sub-bricks are mapped and read:
+
+    attrs, data = load_dataset("stats.sub-MD21_by_block+tlrc[neg_blck#0_Coef,neg_blck#0_Tstat]")
+    attrs, data = load_dataset("pb05.sub-MD21.r01.scale+tlrc[0..$(2)]")
+"""
+
+import gzip
+import os
+import re
+import sys
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import nibabel as nib
+except ImportError:
+    nib = None
+
+BRICK_DTYPES = {0: np.uint8, 1: np.int16, 3: np.float32, 5: np.complex64}
+VIEWS = {0: "orig", 1: "acpc", 2: "tlrc"}
+
+# AFNI statistic codes used in BRICK_STATAUX
+STAT_CODES = {"fico": 2, "fitt": 3, "fift": 4, "fizt": 5, "fict": 6}
+
+GEOMETRY_ATTRIBUTES = ["DATASET_DIMENSIONS", "ORIENT_SPECIFIC", "ORIGIN", "DELTA",
+                       "IJK_TO_DICOM", "IJK_TO_DICOM_REAL", "TEMPLATE_SPACE"]
+
+ATTRIBUTE_PATTERN = re.compile(r"type\s*=\s*(\S+)\s*\n\s*name\s*=\s*(\S+)\s*\n\s*count\s*=\s*(\d+)\s*\n")
+SELECTOR_PATTERN = re.compile(r"^(.*?)(?:\[([^\]]*)\])?$")
+RANGE_PATTERN = re.compile(r"(\d+|\$)(?:\.\.(\d+|\$)(?:\((\d+)\))?)?")
+
+# Per-sub-brick attributes, subset together with the data when a selector is given
+BRICK_ATTRIBUTES = ["BRICK_TYPES", "BRICK_FLOAT_FACS", "BRICK_STATS"]
+
+
+def split_selector(path):
+    """Splits 'stats+tlrc[neg_blck#0_Coef]' into ('stats+tlrc', 'neg_blck#0_Coef'). The selector is None if absent."""
+    match = SELECTOR_PATTERN.match(path)
+    return match.group(1), match.group(2)
+
+
+def dataset_paths(path):
+    """Returns (head_path, brik_path) for 'x+tlrc', 'x+tlrc.', 'x+tlrc.HEAD' or 'x+tlrc.BRIK'."""
+    base = re.sub(r"\.(HEAD|BRIK(\.gz)?)?$", "", path)
+    return base + ".HEAD", base + ".BRIK"
+
+
+def is_nifti(path):
+    path = split_selector(path)[0]
+    return path.endswith(".nii") or path.endswith(".nii.gz")
+
+
+def read_head(path):
+    """Parses a .HEAD file into {name: value}. Numeric attributes are lists, strings are str."""
+    head_path, _ = dataset_paths(split_selector(path)[0])
+    with open(head_path, "r", errors="replace") as f:
+        text = f.read()
+
+    attrs = {}
+    matches = list(ATTRIBUTE_PATTERN.finditer(text))
+    for n, match in enumerate(matches):
+        attr_type, name, count = match.group(1), match.group(2), int(match.group(3))
+        end = matches[n + 1].start() if n + 1 < len(matches) else len(text)
+        body = text[match.end():end]
+        if attr_type == "string-attribute":
+            start = body.index("'") + 1
+            value = body[start:start + count]
+            attrs[name] = value[:-1] if value.endswith("~") else value
+        elif attr_type == "integer-attribute":
+            attrs[name] = [int(v) for v in body.split()[:count]]
+        else:
+            attrs[name] = [float(v) for v in body.split()[:count]]
+    return attrs
+
+
+def dims(attrs):
+    return tuple(attrs["DATASET_DIMENSIONS"][:3])
+
+
+def n_voxels(attrs):
+    nx, ny, nz = dims(attrs)
+    return nx * ny * nz
+
+
+def n_bricks(attrs):
+    return attrs["DATASET_RANK"][1]
+
+
+def brick_labels(attrs):
+    labels = attrs.get("BRICK_LABS", "").split("~")
+    return [labels[i] if i < len(labels) and labels[i] else f"#{i}" for i in range(n_bricks(attrs))]
+
+
+def view(attrs):
+    return VIEWS.get(attrs.get("SCENE_DATA", [2])[0], "tlrc")
+
+
+def brick_stats(attrs):
+    """Parses BRICK_STATAUX into {sub-brick index: (stat name, params)}, e.g. {2: ("fitt", [120.0])}."""
+    names = {code: name for name, code in STAT_CODES.items()}
+    stataux = attrs.get("BRICK_STATAUX", [])
+    stats, i = {}, 0
+    while i + 2 < len(stataux):
+        index, code, n_params = int(stataux[i]), int(stataux[i + 1]), int(stataux[i + 2])
+        stats[index] = (names.get(code, str(code)), list(stataux[i + 3:i + 3 + n_params]))
+        i += 3 + n_params
+    return stats
+
+
+def ijk_to_xyz(attrs, ijk):
+    """Maps (N, 3) (i, j, k) indices of a non-oblique dataset to DICOM (RAI) coordinates."""
+    ijk = np.atleast_2d(ijk)
+    xyz = np.empty(ijk.shape, dtype=float)
+    for axis in range(3):
+        world = attrs["ORIENT_SPECIFIC"][axis] // 2
+        xyz[:, world] = attrs["ORIGIN"][axis] + attrs["DELTA"][axis] * ijk[:, axis]
+    return xyz
+
+
+def xyz_to_ijk(attrs, xyz):
+    """Maps (N, 3) DICOM (RAI) coordinates to fractional (i, j, k) indices of a non-oblique dataset."""
+    xyz = np.atleast_2d(xyz)
+    ijk = np.empty(xyz.shape, dtype=float)
+    for axis in range(3):
+        world = attrs["ORIENT_SPECIFIC"][axis] // 2
+        ijk[:, axis] = (xyz[:, world] - attrs["ORIGIN"][axis]) / attrs["DELTA"][axis]
+    return ijk
+
+
+def select_bricks(attrs, selector):
+    """
+    Resolves a sub-brick selector to a list of indices. Accepts labels, indices, 'a..b' and 'a..b(step)' ranges
+    and '$' (last sub-brick), separated by commas, e.g. 'Full_Fstat,neg_blck#0_Coef' or '1..$(2)'.
+    """
+    nvals = n_bricks(attrs)
+    if selector is None:
+        return list(range(nvals))
+    labels = brick_labels(attrs)
+    indices = []
+    for item in selector.split(","):
+        item = item.strip()
+        if item in labels:
+            indices.append(labels.index(item))
+            continue
+        match = RANGE_PATTERN.fullmatch(item)
+        if match is None:
+            raise KeyError(f"No sub-brick labeled '{item}' (available: {', '.join(labels)})")
+        first, last, step = [nvals - 1 if v == "$" else int(v) if v else None for v in match.groups()]
+        last = first if last is None else last
+        indices.extend(range(first, last + 1, step or 1) if first <= last else range(first, last - 1, -(step or 1)))
+    out_of_range = [i for i in indices if not 0 <= i < nvals]
+    if out_of_range:
+        raise IndexError(f"Sub-brick(s) {out_of_range} out of range for a dataset with {nvals} sub-bricks")
+    return indices
+
+
+def select_attrs(attrs, indices):
+    """Returns a copy of attrs describing only the sub-bricks in `indices` (labels, types, scales, stataux)."""
+    attrs = dict(attrs)
+    labels = brick_labels(attrs)
+    for name in BRICK_ATTRIBUTES:
+        if name in attrs:
+            width = 2 if name == "BRICK_STATS" else 1
+            attrs[name] = [v for i in indices for v in attrs[name][i * width:(i + 1) * width]]
+    attrs["BRICK_LABS"] = "~".join(labels[i] for i in indices)
+    stats = brick_stats(attrs)
+    attrs.pop("BRICK_STATAUX", None)
+    stataux = []
+    for new_index, old_index in enumerate(indices):
+        if old_index in stats:
+            name, params = stats[old_index]
+            code = STAT_CODES[name] if name in STAT_CODES else int(name)
+            stataux += [new_index, code, len(params)] + list(params)
+    if stataux:
+        attrs["BRICK_STATAUX"] = [float(v) for v in stataux]
+    attrs["DATASET_RANK"] = [attrs["DATASET_RANK"][0], len(indices)] + attrs["DATASET_RANK"][2:]
+    return attrs
+
+
+def brick_dtypes(attrs):
+    byteorder = "<" if attrs.get("BYTEORDER_STRING", "LSB_FIRST").startswith("LSB") else ">"
+    types = attrs.get("BRICK_TYPES", [3] * n_bricks(attrs))
+    return [np.dtype(BRICK_DTYPES[t]).newbyteorder(byteorder) for t in types]
+
+
+def brick_factors(attrs):
+    """BRICK_FLOAT_FACS with 0 (unscaled) mapped to 1."""
+    facs = attrs.get("BRICK_FLOAT_FACS") or [0.0] * n_bricks(attrs)
+    return [f if f else 1.0 for f in facs]
+
+
+def brick_memmaps(path, mode="r"):
+    """
+    Returns (attrs, list of unscaled sub-brick arrays). Each sub-brick is its own memmap at its byte offset in the
+    BRIK, so sub-bricks of different types are supported and mapping a sub-brick does not read it.
+    """
+    path = split_selector(path)[0]
+    attrs = read_head(path)
+    _, brik_path = dataset_paths(path)
+    dtypes = brick_dtypes(attrs)
+    nvox = n_voxels(attrs)
+    offsets = np.concatenate([[0], np.cumsum([dtype.itemsize * nvox for dtype in dtypes])]).astype(int)
+
+    if os.path.exists(brik_path):
+        bricks = [np.memmap(brik_path, dtype=dtype, mode=mode, offset=int(offset), shape=(nvox,))
+                  for dtype, offset in zip(dtypes, offsets)]
+    elif os.path.exists(brik_path + ".gz"):
+        print(f"Warning: {brik_path}.gz is compressed and will be loaded into memory.")
+        with gzip.open(brik_path + ".gz", "rb") as f:
+            buffer = f.read()
+        bricks = [np.frombuffer(buffer, dtype=dtype, count=nvox, offset=int(offset))
+                  for dtype, offset in zip(dtypes, offsets)]
+    else:
+        raise FileNotFoundError(f"BRIK file not found for {path}")
+    return attrs, bricks
+
+
+class Bricks:
+    """
+    Lazy (n_sub_bricks, n_voxels) array over per-sub-brick memmaps, for datasets with scaled (BRICK_FLOAT_FACS) or
+    mixed-type sub-bricks. Indexing reads and scales only the requested sub-bricks and voxels, as float32.
+    """
+
+    def __init__(self, bricks, factors):
+        self.bricks = bricks
+        self.factors = factors
+        self.shape = (len(bricks), len(bricks[0]) if bricks else 0)
+        self.ndim = 2
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read(self, index, voxels=slice(None)):
+        values = self.bricks[index][voxels]
+        return np.multiply(values, self.factors[index], dtype=np.float32)
+
+    def __getitem__(self, key):
+        rows, voxels = key if isinstance(key, tuple) else (key, slice(None))
+        if isinstance(rows, (int, np.integer)):
+            return self.read(int(rows), voxels)
+        indices = range(len(self))[rows] if isinstance(rows, slice) else list(rows)
+        return np.stack([self.read(i, voxels) for i in indices]) if len(indices) else np.empty((0, 0), np.float32)
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        return data if dtype is None else data.astype(dtype)
+
+
+def load_dataset(path, mode="r"):
+    """
+    Returns (attrs, data) for a dataset path with an optional sub-brick selector. data is a (n_sub_bricks, n_voxels)
+    memmap when the selected sub-bricks are unscaled, share one type and are contiguous in the BRIK (zero-copy),
+    otherwise a lazy Bricks array. With a selector, attrs only describe the selected sub-bricks.
+    """
+    path, selector = split_selector(path)
+    if is_nifti(path):
+        attrs, data = load_nifti(path)
+        indices = select_bricks(attrs, selector)
+        return (select_attrs(attrs, indices), data[indices]) if selector is not None else (attrs, data)
+
+    attrs, bricks = brick_memmaps(path, mode)
+    indices = select_bricks(attrs, selector)
+    dtypes = brick_dtypes(attrs)
+    factors = brick_factors(attrs)
+    if selector is not None:
+        attrs = select_attrs(attrs, indices)
+
+    contiguous = indices == list(range(indices[0], indices[0] + len(indices))) if indices else False
+    if contiguous and len({dtypes[i] for i in indices}) == 1 and all(factors[i] == 1.0 for i in indices):
+        first = bricks[indices[0]]
+        if isinstance(first, np.memmap):
+            data = np.memmap(first.filename, dtype=first.dtype, mode=mode, offset=first.offset,
+                             shape=(len(indices), len(first)))
+        else:
+            data = np.stack([bricks[i] for i in indices])
+        return attrs, data
+    return attrs, Bricks([bricks[i] for i in indices], [factors[i] for i in indices])
+
+
+def nifti_attrs(img):
+    """Builds AFNI geometry attributes (DICOM/RAI convention) from a non-oblique NIfTI affine."""
+    affine = img.affine
+    shape = img.shape
+    orient, origin, delta = [], [], []
+    for axis in range(3):
+        column = affine[:3, axis]
+        world = int(np.argmax(np.abs(column)))
+        flip = -1.0 if world < 2 else 1.0  # RAS -> DICOM (RAI)
+        step = column[world] * flip
+        orient.append({0: 0 if step > 0 else 1, 1: 3 if step > 0 else 2, 2: 4 if step > 0 else 5}[world])
+        origin.append(float(affine[world, 3] * flip))
+        delta.append(float(step))
+    nvals = shape[3] if len(shape) > 3 else 1
+    return {
+        "DATASET_DIMENSIONS": list(shape[:3]) + [0, 0],
+        "DATASET_RANK": [3, nvals, 0, 0, 0, 0, 0, 0],
+        "ORIENT_SPECIFIC": orient,
+        "ORIGIN": origin,
+        "DELTA": delta,
+        "SCENE_DATA": [2, 0, 0],
+        "BRICK_TYPES": [3] * nvals,
+    }
+
+
+def load_nifti(path):
+    if nib is None:
+        raise ImportError("nibabel is required to read NIfTI datasets (pip install nibabel)")
+    img = nib.load(path, mmap=True)
+    data = np.asanyarray(img.dataobj)
+    if data.ndim == 3:
+        data = data[..., None]
+    # NIfTI arrays are (x, y, z, t) with x fastest on disk, so this is a view for uncompressed files.
+    data = data.reshape(-1, data.shape[-1], order="F").T
+    return nifti_attrs(img), data
+
+
+def format_attribute(name, value):
+    if isinstance(value, str):
+        return f"\ntype = string-attribute\nname = {name}\ncount = {len(value) + 1}\n'{value}~\n"
+    if all(isinstance(v, (int, np.integer)) for v in value):
+        attr_type, values = "integer-attribute", [str(int(v)) for v in value]
+    else:
+        attr_type, values = "float-attribute", [f"{float(v):.9g}" for v in value]
+    lines = [" " + " ".join(values[i:i + 5]) for i in range(0, len(values), 5)]
+    return f"\ntype = {attr_type}\nname = {name}\ncount = {len(values)}\n" + "\n".join(lines) + "\n"
+
+
+def output_path(prefix, template_attrs):
+    """Appends the template's view (+tlrc) to a prefix that has none."""
+    if re.search(r"\+(orig|acpc|tlrc)$", prefix):
+        return prefix
+    return f"{prefix}+{view(template_attrs)}"
+
+
+def write_head(prefix, template_attrs, labels, stataux=None, history=""):
+    """Writes <prefix>.HEAD for a float32 bucket with the geometry of template_attrs."""
+    head_path, _ = dataset_paths(prefix)
+    nvals = len(labels)
+    view_code = template_attrs.get("SCENE_DATA", [2])[0]
+    attrs = {name: template_attrs[name] for name in GEOMETRY_ATTRIBUTES if name in template_attrs}
+    attrs.update({
+        "TYPESTRING": "3DIM_HEAD_FUNC",
+        "SCENE_DATA": [view_code, 11, 1],
+        "DATASET_RANK": [3, nvals, 0, 0, 0, 0, 0, 0],
+        "BRICK_TYPES": [3] * nvals,
+        "BRICK_FLOAT_FACS": [0.0] * nvals,
+        "BRICK_LABS": "~".join(labels),
+        "BYTEORDER_STRING": "LSB_FIRST" if sys.byteorder == "little" else "MSB_FIRST",
+    })
+    attrs.update(new_idcode())
+    if stataux:
+        attrs["BRICK_STATAUX"] = [float(v) for v in stataux]
+    if history:
+        attrs["HISTORY_NOTE"] = history.replace("\n", "\\n")
+    return write_attributes(head_path, attrs)
+
+
+def write_attributes(path, attrs):
+    """Writes an attribute dict (as returned by read_head) to <path>.HEAD."""
+    head_path, _ = dataset_paths(path)
+    with open(head_path, "w") as f:
+        for name, value in attrs.items():
+            f.write(format_attribute(name, value))
+    return head_path
+
+
+def new_idcode():
+    return {
+        "IDCODE_STRING": "PYA_" + uuid.uuid4().hex[:22].upper(),
+        "IDCODE_DATE": datetime.now().strftime("%a %b %d %H:%M:%S %Y"),
+    }
+
+
+def create_dataset(prefix, template_attrs, labels, stataux=None, history=""):
+    """Creates a float32 bucket on disk and returns (path, writable memmap of shape (n_labels, n_voxels))."""
+    path = output_path(prefix, template_attrs)
+    write_head(path, template_attrs, labels, stataux, history)
+    _, brik_path = dataset_paths(path)
+    data = np.memmap(brik_path, dtype=np.float32, mode="w+", shape=(len(labels), n_voxels(template_attrs)))
+    return path, data
+
+
+def write_dataset(prefix, data, template_attrs, labels, stataux=None, history=""):
+    """Writes a (n_labels, n_voxels) array as a float32 AFNI bucket. Returns the dataset path (with view)."""
+    path, out = create_dataset(prefix, template_attrs, labels, stataux, history)
+    out[:] = np.asarray(data, dtype=np.float32).reshape(out.shape)
+    out.flush()
+    return path
+
+
+def stataux_entry(index, code, params=()):
+    return [index, STAT_CODES[code], len(params)] + list(params)
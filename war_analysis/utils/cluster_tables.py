@@ -0,0 +1,221 @@
+"""
+Cluster tables and cluster maps of group results.
+
+Every statistic sub-brick (t, z, F, chi-square in BRICK_STATAUX) of every group result is thresholded at a voxelwise
+p-value, and its connected components are labeled (NN1/NN2/NN3; t and z bisided, with each sign clustered
+separately). Clusters smaller than the 3dClustSim size threshold attached to the dataset (AFNI_CLUSTSIM_* attributes,
+interpolated at --pthr and --alpha) are dropped, or smaller than --min_voxels when given. For each result
+<prefix>+tlrc, the group model directory receives:
+
+    <prefix>_clusters.tsv       one row per cluster: size, peak and centroid (DICOM RAI mm), peak statistic, peak and
+                                mean effect (the sub-brick before the statistic), and the threshold used
+    <prefix>_clust_map+tlrc     one sub-brick per statistic, voxels numbered by cluster (1 = largest)
+
+All group models of an analysis (default: all analyses) are processed in parallel:
+
+    python cluster_tables.py --output <output_dir> --analysis by_block --pthr 0.001 --alpha 0.05 --nn 1
+"""
+
+import argparse
+import glob
+import html
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+
+import afni_io
+from montage_renderer import p_to_stat, suprathreshold
+
+COLUMNS = ["contrast", "sign", "cluster", "n_voxels", "volume_mm3", "peak_x", "peak_y", "peak_z", "peak_stat",
+           "peak_effect", "mean_effect", "centroid_x", "centroid_y", "centroid_z", "pthr", "alpha", "min_voxels",
+           "threshold_source"]
+# Statistics thresholded on both tails (each sign clustered separately) and on the upper tail only.
+BISIDED_STATS = ["fitt", "fizt"]
+
+
+def clustsim_table(attrs, nn, sidedness):
+    """(pthr, athr, (n_pthr, n_athr) minimum cluster sizes) of an attached 3dClustSim table, or None."""
+    text = attrs.get(f"AFNI_CLUSTSIM_NN{nn}_{sidedness}")
+    if not text:
+        return None
+    text = html.unescape(text)
+    pthr = re.search(r'pthr\s*=\s*"([^"]+)"', text)
+    athr = re.search(r'athr\s*=\s*"([^"]+)"', text)
+    body = re.search(r">([^<]*)</", text)
+    if not (pthr and athr and body):
+        return None
+    pthr = np.array([float(v) for v in pthr.group(1).replace(",", " ").split()])
+    athr = np.array([float(v) for v in athr.group(1).replace(",", " ").split()])
+    sizes = np.array(body.group(1).split(), dtype=float).reshape(len(pthr), len(athr))
+    return pthr, athr, sizes
+
+
+def clustsim_threshold(table, pthr, alpha):
+    """Minimum cluster size at (pthr, alpha), interpolated in log10(p) as AFNI does, rounded up."""
+    table_p, table_alpha, sizes = table
+    column = int(np.argmin(np.abs(table_alpha - alpha)))
+    order = np.argsort(table_p)
+    size = np.interp(np.log10(pthr), np.log10(table_p[order]), sizes[order, column])
+    return int(np.ceil(size))
+
+
+def effect_brick(stats, index):
+    """The effect sub-brick reported with a statistic: the non-statistic sub-brick right before it, if any."""
+    if stats[index][0] in BISIDED_STATS and index > 0 and index - 1 not in stats:
+        return index - 1
+    return None
+
+
+def label_clusters(values, nn):
+    """Connected components of a boolean (nz, ny, nx) volume. Returns (labels, sizes indexed by label)."""
+    labels, _ = ndimage.label(values, ndimage.generate_binary_structure(3, nn))
+    return labels, np.bincount(labels.ravel())
+
+
+def find_clusters(attrs, stat, effect, stat_code, nn, pthr, alpha, min_voxels):
+    """Returns (cluster rows, (nz, ny, nx) map of cluster numbers, size threshold) of one statistic sub-brick."""
+    pside = "bisided" if stat_code in BISIDED_STATS else "right"
+    threshold = p_to_stat(attrs, 0, pthr, pside)
+    above = suprathreshold(stat, threshold, pside)
+    if min_voxels is None:
+        table = clustsim_table(attrs, nn, "bisided" if pside == "bisided" else "1sided")
+        min_voxels = clustsim_threshold(table, pthr, alpha) if table else 1
+        source = "3dClustSim" if table else "none"
+    else:
+        source = "min_voxels"
+
+    # Each sign gets its own labels; the two label ranges are combined by offsetting the negative ones.
+    labels = np.zeros(stat.shape, dtype=np.int64)
+    signs = {}
+    offset = 0
+    for sign, selected in ([(1, stat > 0), (-1, stat < 0)] if pside == "bisided" else [(1, np.ones_like(above))]):
+        sign_labels, sizes = label_clusters(above & selected, nn)
+        keep = np.flatnonzero(sizes >= min_voxels)
+        keep = keep[keep > 0]
+        remap = np.zeros(len(sizes), dtype=np.int64)
+        remap[keep] = offset + np.arange(1, len(keep) + 1)
+        labels += remap[sign_labels]
+        signs.update({offset + n + 1: sign for n in range(len(keep))})
+        offset += len(keep)
+    if not offset:
+        return [], np.zeros(stat.shape, dtype=np.float32), (min_voxels, source)
+
+    # Per-cluster sizes, centroids, effects and peaks in a few bincount passes over the suprathreshold voxels.
+    flat = labels.ravel()
+    voxels = np.flatnonzero(flat)
+    cluster = flat[voxels]
+    n_clusters = offset + 1
+    size = np.bincount(cluster, minlength=n_clusters)
+    nz, ny, nx = stat.shape
+    k, j, i = np.unravel_index(voxels, (nz, ny, nx))
+    ijk = np.stack([i, j, k], axis=1).astype(float)
+    centroid = np.stack([np.bincount(cluster, weights=ijk[:, axis], minlength=n_clusters) for axis in range(3)], axis=1)
+    centroid = afni_io.ijk_to_xyz(attrs, centroid[1:] / size[1:, None])
+    magnitude = np.abs(stat.ravel()[voxels])
+    order = np.lexsort((-magnitude, cluster))
+    first = np.searchsorted(cluster[order], np.arange(1, n_clusters))
+    peak = voxels[order[first]]
+    pk, pj, pi = np.unravel_index(peak, (nz, ny, nx))
+    peak_xyz = afni_io.ijk_to_xyz(attrs, np.stack([pi, pj, pk], axis=1))
+    if effect is not None:
+        mean_effect = np.bincount(cluster, weights=effect.ravel()[voxels], minlength=n_clusters)[1:] / size[1:]
+        peak_effect = effect.ravel()[peak]
+    else:
+        mean_effect = peak_effect = np.full(n_clusters - 1, np.nan)
+
+    # Clusters are numbered by decreasing size across both signs, as 3dClusterize does.
+    ranking = np.argsort(-size[1:], kind="stable")
+    number = np.empty(n_clusters, dtype=np.int64)
+    number[0] = 0
+    number[1 + ranking] = np.arange(1, n_clusters)
+    delta = np.abs(np.prod(attrs["DELTA"]))
+    rows = []
+    for n in ranking:
+        rows.append({"sign": "+" if signs[n + 1] > 0 else "-", "cluster": int(number[n + 1]), "n_voxels": int(size[n + 1]),
+                     "volume_mm3": float(size[n + 1] * delta),
+                     "peak_x": peak_xyz[n, 0], "peak_y": peak_xyz[n, 1], "peak_z": peak_xyz[n, 2],
+                     "peak_stat": float(stat.ravel()[peak[n]]), "peak_effect": float(peak_effect[n]),
+                     "mean_effect": float(mean_effect[n]),
+                     "centroid_x": centroid[n, 0], "centroid_y": centroid[n, 1], "centroid_z": centroid[n, 2]})
+    return rows, number[labels].astype(np.float32), (min_voxels, source)
+
+
+def process_result(path, nn, pthr, alpha, min_voxels):
+    """Writes the cluster table and map of one group result. Returns (path, number of statistics, clusters)."""
+    attrs = afni_io.read_head(path)
+    stats = afni_io.brick_stats(attrs)
+    labels = afni_io.brick_labels(attrs)
+    nx, ny, nz = afni_io.dims(attrs)
+    # Only the statistic and effect sub-bricks are read, through the memory-mapped BRIK.
+    needed = sorted(set(stats) | {effect_brick(stats, index) for index in stats} - {None})
+    if not needed:
+        return path, 0, 0
+    _, data = afni_io.load_dataset(f"{path}[{','.join(str(index) for index in needed)}]")
+    position = {index: n for n, index in enumerate(needed)}
+
+    rows, maps, map_labels = [], [], []
+    for index in sorted(stats):
+        stat = np.asarray(data[position[index]], dtype=np.float32).reshape(nz, ny, nx)
+        effect_index = effect_brick(stats, index)
+        effect = None if effect_index is None else np.asarray(data[position[effect_index]], dtype=np.float32).reshape(nz, ny, nx)
+        # The attrs of a one-brick selection carry this statistic as sub-brick 0 (p-to-stat conversion).
+        brick_attrs = afni_io.select_attrs(attrs, [index])
+        brick_attrs.update({name: attrs[name] for name in attrs if name.startswith("AFNI_CLUSTSIM_")})
+        clusters, cluster_map, (size_threshold, source) = find_clusters(brick_attrs, stat, effect, stats[index][0],
+                                                                        nn, pthr, alpha, min_voxels)
+        for row in clusters:
+            row.update(contrast=labels[index], pthr=pthr, alpha=alpha if source == "3dClustSim" else np.nan,
+                       min_voxels=size_threshold, threshold_source=source)
+        rows.extend(clusters)
+        maps.append(cluster_map.ravel())
+        map_labels.append(labels[index])
+
+    prefix = re.sub(r"\+\w+(\.HEAD)?$", "", path)
+    pd.DataFrame(rows, columns=COLUMNS).to_csv(f"{prefix}_clusters.tsv", sep="\t", index=False, float_format="%.6g")
+    map_path = afni_io.output_path(f"{prefix}_clust_map", attrs)
+    for part in afni_io.dataset_paths(map_path):
+        if os.path.exists(part):
+            os.remove(part)
+    afni_io.write_dataset(f"{prefix}_clust_map", np.array(maps), attrs, map_labels,
+                          history=f"[cluster_tables.py] NN{nn} p < {pthr:g}")
+    return path, len(map_labels), len(rows)
+
+
+def find_results(output_dir, analyses=None):
+    """Group results (result_<model>+view) of the analyses, without residuals and cluster outputs."""
+    paths = []
+    for analysis in analyses or ["*"]:
+        pattern = os.path.join(output_dir, "group_analysis", analysis, "*", "result_*+*.HEAD")
+        paths.extend(path for path in glob.glob(pattern)
+                     if not re.search(r"_(resid|clust_map)\+\w+\.HEAD$", path) and "/_" not in os.path.relpath(path, output_dir))
+    return sorted(path[:-len(".HEAD")] for path in paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster tables and cluster maps of every group result.")
+    parser.add_argument("--output", help="Pipeline output_dir (processes its group_analysis results).")
+    parser.add_argument("--analysis", nargs="+", help="First-level analyses whose group models to process (default: all).")
+    parser.add_argument("--datasets", nargs="+", help="Explicit group result datasets instead of --output.")
+    parser.add_argument("--pthr", type=float, default=0.001, help="Voxelwise p-value threshold.")
+    parser.add_argument("--alpha", type=float, default=0.05, help="Cluster-level alpha of the 3dClustSim table.")
+    parser.add_argument("--nn", type=int, choices=[1, 2, 3], default=1, help="Neighbourhood: faces (1), edges (2), corners (3).")
+    parser.add_argument("--min_voxels", type=int, help="Fixed minimum cluster size instead of the attached 3dClustSim table.")
+    parser.add_argument("--n_procs", type=int, default=None, help="Results processed in parallel (default: all cores).")
+    args = parser.parse_args()
+
+    datasets = args.datasets or (find_results(args.output, args.analysis) if args.output else None)
+    if not datasets:
+        parser.error("no group results found (give --output or --datasets)")
+    worker = partial(process_result, nn=args.nn, pthr=args.pthr, alpha=args.alpha, min_voxels=args.min_voxels)
+    with ProcessPoolExecutor(max_workers=args.n_procs) as executor:
+        for path, n_stats, n_clusters in executor.map(worker, datasets):
+            print(f"{path}: {n_clusters} clusters in {n_stats} statistic sub-bricks")
+
+
+if __name__ == "__main__":
+    main()
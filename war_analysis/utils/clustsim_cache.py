@@ -0,0 +1,115 @@
+"""
+Cached 3dClustSim tables, keyed by the group mask and the ACF parameters.
+
+Group models over the same mask with near-identical residual smoothness get the same cluster tables, so each
+(mask content hash, ACF a/b/c rounded to --precision) combination is simulated once and stored in
+<output_dir>/group_analysis/_clustsim_cache/<key>/. The ACF is rounded to the conservative side (b and c up, which
+can only enlarge the cluster thresholds) and the simulation uses the rounded values, so a cached table is exactly
+the table of its key. The cached tables and .cmd file are copied to <prefix>.* with the .cmd rewritten to point at
+them, ready for the usual 3drefit:
+
+    python clustsim_cache.py --mask group_mask+tlrc --acf 0.52 3.91 11.2 --precision 0.01 \\
+        --cache_dir <output_dir>/group_analysis/_clustsim_cache --prefix result_mdma_vs_control_s1_ClustSim
+"""
+
+import argparse
+import fcntl
+import glob
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import uuid
+
+import group_mask
+
+CACHE_NAME = "_clustsim_cache"
+CACHE_PREFIX = "ClustSim"
+CLUSTSIM_OPTIONS = ["-both"]
+
+
+def round_acf(a, b, c, precision):
+    """a to the nearest step, b and c up to the next step (wider smoothness, conservative thresholds)."""
+    decimals = max(0, -math.floor(math.log10(precision)))
+
+    def up(value):
+        return round(math.ceil(value / precision - 1e-9) * precision, decimals)
+
+    return round(round(a / precision) * precision, decimals), up(b), up(c)
+
+
+def cache_key(mask_path, acf):
+    digest = hashlib.sha256(group_mask.dataset_hash(mask_path).encode())
+    digest.update(" ".join(f"{value:g}" for value in acf).encode())
+    digest.update(" ".join(CLUSTSIM_OPTIONS).encode())
+    return digest.hexdigest()[:24]
+
+
+def simulate(mask_path, acf, path):
+    """Runs 3dClustSim into a temporary directory next to `path` and renames it into place."""
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    os.makedirs(tmp_path)
+    cmd = ["3dClustSim", "-mask", os.path.abspath(mask_path), "-acf", *(f"{value:g}" for value in acf),
+           *CLUSTSIM_OPTIONS, "-prefix", CACHE_PREFIX]
+    print(f"Running {' '.join(cmd)}", flush=True)
+    subprocess.run(cmd, cwd=tmp_path, check=True)
+    # Some AFNI versions write the 3drefit command to 3dClustSim.cmd instead of <prefix>.cmd
+    generic_cmd = os.path.join(tmp_path, "3dClustSim.cmd")
+    if os.path.exists(generic_cmd):
+        os.replace(generic_cmd, os.path.join(tmp_path, f"{CACHE_PREFIX}.cmd"))
+    if not os.path.exists(os.path.join(tmp_path, f"{CACHE_PREFIX}.cmd")):
+        shutil.rmtree(tmp_path)
+        raise RuntimeError("3dClustSim did not write a .cmd file")
+    with open(os.path.join(tmp_path, "key.json"), "w") as f:
+        json.dump({"mask": os.path.abspath(mask_path), "acf": acf, "options": CLUSTSIM_OPTIONS}, f, indent=2)
+    os.rename(tmp_path, path)
+
+
+def build(mask_path, acf, precision, cache_dir):
+    """Returns (cache entry directory, rounded ACF, reused), simulating the entry on the first request."""
+    acf = list(round_acf(*acf, precision))
+    path = os.path.join(cache_dir, cache_key(mask_path, acf))
+    os.makedirs(cache_dir, exist_ok=True)
+    # Models finishing together wait for the one simulation of their key instead of repeating it.
+    with open(path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        reused = os.path.isdir(path)
+        if not reused:
+            simulate(mask_path, acf, path)
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return path, acf, reused
+
+
+def export(path, prefix):
+    """Copies the cached tables to <prefix>.* and writes <prefix>.cmd referring to them. Returns the .cmd path."""
+    prefix = os.path.abspath(prefix)
+    for source in glob.glob(os.path.join(path, f"{CACHE_PREFIX}.*")):
+        if not source.endswith(".cmd"):
+            shutil.copy2(source, prefix + os.path.basename(source)[len(CACHE_PREFIX):])
+    with open(os.path.join(path, f"{CACHE_PREFIX}.cmd")) as f:
+        command = f.read()
+    command = re.sub(rf"(?<![\w/.]){CACHE_PREFIX}\.", lambda _: f"{prefix}.", command)
+    with open(prefix + ".cmd", "w") as f:
+        f.write(command)
+    return prefix + ".cmd"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="3dClustSim tables cached by group mask and rounded ACF parameters.")
+    parser.add_argument("--mask", required=True, help="Group mask.")
+    parser.add_argument("--acf", nargs=3, type=float, required=True, metavar=("A", "B", "C"), help="3dFWHMx -acf parameters.")
+    parser.add_argument("--precision", type=float, default=0.01, help="Rounding step of the ACF parameters in the cache key.")
+    parser.add_argument("--cache_dir", required=True, help="Directory of cached 3dClustSim tables.")
+    parser.add_argument("--prefix", required=True, help="Prefix of the exported tables and .cmd file.")
+    args = parser.parse_args()
+
+    path, acf, reused = build(args.mask, args.acf, args.precision, args.cache_dir)
+    print(f"{'Reused' if reused else 'Simulated'} 3dClustSim tables for ACF {' '.join(f'{v:g}' for v in acf)}: {path}")
+    print(f"Wrote {export(path, args.prefix)}")
+
+
+if __name__ == "__main__":
+    main()
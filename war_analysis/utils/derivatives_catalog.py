@@ -0,0 +1,198 @@
+"""
+Catalog of the first-level stats datasets in output_dir, used to resolve and validate group analysis inputs.
+
+<output_dir>/derivatives_catalog.json holds one entry per stats dataset (keyed by its path relative to output_dir)
+with the subject, session, analysis, sub-brick labels, dims, view, template space and the hash of the model config
+that produced it (model_config.json, written next to the results by run_analysis.py after each GLM). Refreshing only
+re-reads the HEAD files whose size or mtime changed, so it stays cheap on a full derivatives tree:
+
+    python derivatives_catalog.py --output <output_dir> --analysis by_block
+    python derivatives_catalog.py --output <output_dir> --analysis by_block --check 'neg_blck#0_Coef' 'neg-neut_blck_GLT#0_Coef'
+"""
+
+import argparse
+import difflib
+import glob
+import hashlib
+import json
+import os
+import uuid
+
+import afni_io
+
+CATALOG_VERSION = 1
+CATALOG_NAME = "derivatives_catalog.json"
+CONFIG_NAME = "model_config.json"
+
+
+def config_hash(model_config):
+    """Stable hash of a first-level model config (an analysis_models.toml entry), ignoring its group analyses."""
+    first_level = {key: value for key, value in model_config.items() if key != "group_analyses"}
+    return hashlib.sha256(json.dumps(first_level, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def results_dir(output_dir, subject, session, analysis):
+    return os.path.join(output_dir, subject, f"ses-{session}", "glm", analysis, f"{subject}_{analysis}.results")
+
+
+def stats_key(subject, session, analysis, view="tlrc"):
+    """Catalog key (HEAD path relative to output_dir) of the main stats bucket of a model."""
+    return os.path.join(subject, f"ses-{session}", "glm", analysis, f"{subject}_{analysis}.results",
+                        f"stats.{subject}_{analysis}+{view}.HEAD")
+
+
+def record_config(output_dir, subject, session, analysis, model_config):
+    """Stores the producing model config next to the results of a finished GLM."""
+    path = results_dir(output_dir, subject, session, analysis)
+    if not os.path.isdir(path):
+        return None
+    with open(os.path.join(path, CONFIG_NAME), "w") as f:
+        json.dump({"analysis": analysis, "config_hash": config_hash(model_config), "config": model_config},
+                  f, indent=2, default=str)
+    return path
+
+
+def load(output_dir):
+    path = os.path.join(output_dir, CATALOG_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            catalog = json.load(f)
+        if catalog.get("version") == CATALOG_VERSION:
+            return catalog
+    return {"version": CATALOG_VERSION, "datasets": {}}
+
+
+def save(output_dir, catalog):
+    # Write then rename, so a concurrent reader never sees a partial catalog.
+    path = os.path.join(output_dir, CATALOG_NAME)
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(catalog, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def file_signature(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def describe(output_dir, key):
+    """Catalog entry of one stats dataset, read from its HEAD and the model_config.json next to it."""
+    head_path = os.path.join(output_dir, key)
+    subject, session, _, analysis = key.split(os.sep)[:4]
+    attrs = afni_io.read_head(head_path)
+    config_path = os.path.join(os.path.dirname(head_path), CONFIG_NAME)
+    producing_hash = None
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            producing_hash = json.load(f).get("config_hash")
+    return {
+        "subject": subject,
+        "session": session.replace("ses-", ""),
+        "analysis": analysis,
+        "labels": afni_io.brick_labels(attrs),
+        "dims": list(afni_io.dims(attrs)),
+        "view": afni_io.view(attrs),
+        "space": attrs.get("TEMPLATE_SPACE", ""),
+        "config_hash": producing_hash,
+        "head": file_signature(head_path),
+        "config": file_signature(config_path),
+    }
+
+
+def refresh(output_dir, analyses=None):
+    """Adds new and changed stats datasets of `analyses` (default: all) to the catalog and drops deleted ones."""
+    catalog = load(output_dir)
+    datasets = catalog["datasets"]
+    scanned = set(analyses) if analyses else None
+    found = set()
+    changed = 0
+    for analysis in analyses or ["*"]:
+        pattern = os.path.join(output_dir, "sub-*", "ses-*", "glm", analysis, "*.results", "stats.*+*.HEAD")
+        for head_path in glob.glob(pattern):
+            key = os.path.relpath(head_path, output_dir)
+            found.add(key)
+            entry = datasets.get(key)
+            config_path = os.path.join(os.path.dirname(head_path), CONFIG_NAME)
+            if (entry and entry["head"] == file_signature(head_path)
+                    and entry["config"] == file_signature(config_path)):
+                continue
+            datasets[key] = describe(output_dir, key)
+            changed += 1
+
+    removed = [key for key, entry in datasets.items()
+               if key not in found and (scanned is None or entry["analysis"] in scanned)]
+    for key in removed:
+        del datasets[key]
+    if changed or removed:
+        save(output_dir, catalog)
+    return catalog
+
+
+def resolve(catalog, output_dir, subject, session, analysis, label):
+    """
+    Resolves the `label` sub-brick of a model's stats bucket. Returns (path with selector, entry, error): path and
+    entry are None when the dataset is not in the catalog, error describes a missing label (with close matches).
+    """
+    key = stats_key(subject, session, analysis)
+    entry = catalog["datasets"].get(key)
+    if entry is None:
+        return None, None, None
+    path = os.path.join(output_dir, key[:-len(".HEAD")]) + f"[{label}]"
+    if label not in entry["labels"]:
+        suggestions = difflib.get_close_matches(label, entry["labels"], n=3)
+        hint = f" Did you mean: {', '.join(suggestions)}?" if suggestions else ""
+        return path, entry, f"{subject} ses-{session}: no sub-brick labeled '{label}' in {os.path.basename(key)}.{hint}"
+    return path, entry, None
+
+
+def check_inputs(entries, model_config=None):
+    """
+    Cross-checks the resolved inputs of a group analysis. Returns (errors, warnings): grids or template spaces that
+    differ between inputs are errors, datasets produced by another version of the model config are warnings.
+    """
+    errors, warnings = [], []
+    entries = list({(e["subject"], e["session"]): e for e in entries}.values())
+    if not entries:
+        return errors, warnings
+    for field in ["dims", "space", "view"]:
+        values = {}
+        for entry in entries:
+            values.setdefault(str(entry[field]), []).append(f"{entry['subject']} ses-{entry['session']}")
+        if len(values) > 1:
+            detail = "; ".join(f"{value}: {', '.join(who[:5])}{' ...' if len(who) > 5 else ''}"
+                               for value, who in values.items())
+            errors.append(f"Inputs differ in {field} ({detail})")
+    if model_config is not None:
+        current = config_hash(model_config)
+        stale = [f"{e['subject']} ses-{e['session']}" for e in entries if e["config_hash"] not in (None, current)]
+        if stale:
+            warnings.append(f"{len(stale)} input(s) were fitted with a different version of the model config: "
+                            f"{', '.join(stale[:10])}{' ...' if len(stale) > 10 else ''}")
+    return errors, warnings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh and query the catalog of first-level stats datasets.")
+    parser.add_argument("--output", required=True, help="Pipeline output_dir.")
+    parser.add_argument("--analysis", nargs="*", help="Only refresh these analyses (default: all).")
+    parser.add_argument("--check", nargs="*", help="Sub-brick labels every dataset of --analysis must contain.")
+    args = parser.parse_args()
+
+    catalog = refresh(args.output, args.analysis)
+    datasets = [e for e in catalog["datasets"].values() if not args.analysis or e["analysis"] in args.analysis]
+    print(f"{len(datasets)} stats datasets cataloged in {os.path.join(args.output, CATALOG_NAME)}")
+    missing = 0
+    for label in args.check or []:
+        for entry in datasets:
+            if label not in entry["labels"]:
+                print(f"  {entry['subject']} ses-{entry['session']} {entry['analysis']}: missing '{label}'")
+                missing += 1
+    if missing:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
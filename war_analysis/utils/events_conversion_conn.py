@@ -1,132 +1,151 @@
-import pandas as pd
-from pathlib import Path
+import argparse
 import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
-lags = {
-    "ses-1": {
-        "sub-AL18": {"run-1": 28, "run-2": 28},
-        "sub-AL19": {"run-1": 28, "run-2": 28},
-        "sub-AL20": {"run-1": 28, "run-2": 28},
-        "sub-AL21": {"run-1": 28, "run-2": 28},
-        "sub-AL22": {"run-1": 28, "run-2": 28},
-        "sub-AL23": {"run-1": 28, "run-2": 28},
-        "sub-AL24": {"run-1": 28, "run-2": 28},
-        "sub-AL25": {"run-1": 28, "run-2": 28},
-        "sub-AL26": {"run-1": 28, "run-2": 28},
-        "sub-AL27": {"run-1": 28, "run-2": 28},
-        "sub-AL28": {"run-1": 28, "run-2": 28},
-        "sub-AL41": {"run-1": 0, "run-2": 0},
-        "sub-AL48": {"run-1": 0, "run-2": 0},
-        "sub-AL49": {"run-1": 0, "run-2": 0},
-        "sub-AL50": {"run-1": 0, "run-2": 0},
-        "sub-AL51": {"run-1": 0, "run-2": 0},
-        "sub-AL52": {"run-1": 0, "run-2": 0},
-        "sub-AL53": {"run-1": 0, "run-2": 0},
-        "sub-AL55": {"run-1": 0, "run-2": 0},
-        "sub-AL58": {"run-1": 0, "run-2": 0},
-        "sub-AL59": {"run-1": 0, "run-2": 0},
-        "sub-AL60": {"run-1": 0, "run-2": 0},
-        "sub-AL61": {"run-1": 0, "run-2": 0},
-        "sub-AL62": {"run-1": 0, "run-2": 0},
-        "sub-AL65": {"run-1": 0, "run-2": 0},
-        "sub-AL70": {"run-1": 0, "run-2": 0},
-        "sub-AL71": {"run-1": 0, "run-2": 0},
-        "sub-MD18": {"run-1": 28, "run-2": 28},
-        "sub-MD21": {"run-1": 28, "run-2": 28},
-        "sub-MD22": {"run-1": 28, "run-2": 28},
-        "sub-MD23": {"run-1": 28, "run-2": 28},
-        "sub-MD24": {"run-1": 28, "run-2": 28},
-        "sub-MD25": {"run-1": 28, "run-2": 28},
-        "sub-MD27": {"run-1": 28, "run-2": 28},
-        "sub-MD28": {"run-1": 28, "run-2": 28},
-        "sub-MD30": {"run-1": 0, "run-2": 0},
-        "sub-MD35": {"run-1": 0, "run-2": 0},
-        "sub-MD38": {"run-1": 0, "run-2": 17},
-        "sub-MD41": {"run-1": 0, "run-2": 0},
-        "sub-MD42": {"run-1": 0, "run-2": 36},
-    },
-    "ses-2": {
-        "sub-MD18": {"run-1": 28, "run-2": 28},
-        "sub-MD23": {"run-1": 28, "run-2": 28},
-        "sub-MD24": {"run-1": 28, "run-2": 28},
-        "sub-MD25": {"run-1": 0, "run-2": 21},
-        "sub-MD27": {"run-1": 0, "run-2": 23},
-        "sub-MD28": {"run-1": 0, "run-2": 19},
-        "sub-MD30": {"run-1": 0, "run-2": 0},
-    }
-}
-
-for ses in ["ses-1"]:
-
-    base_path = Path(f"./log_files_raw/ayelet")
+import numpy as np
+import pandas as pd
+import toml
+
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analysis_configs", "main_config.toml")
+
+# Lookup table from Biopac code to trial_type. Codes outside the table map to None and are dropped.
+TRIAL_TYPE_LOOKUP = np.full(100, None, dtype=object)
+for offset, emotion in [(30, "Negative"), (50, "Neutral"), (70, "Positive")]:
+    for image in range(1, 5):
+        TRIAL_TYPE_LOOKUP[offset + image] = f"{emotion}_Image_{image}"
+TRIAL_TYPE_LOOKUP[[22, 24]] = "Rest"
+
+# The first image of each block also marks the start of a 22s block event.
+BLOCK_LOOKUP = np.full(100, None, dtype=object)
+BLOCK_LOOKUP[31] = "Negative_Block"
+BLOCK_LOOKUP[51] = "Neutral_Block"
+BLOCK_LOOKUP[71] = "Positive_Block"
+BLOCK_DURATION = 22
+
+
+def build_lag_index(config_path):
+    """
+    Indexes lag_block_1/2 from main_config.toml as {(session, subject): {run: lag}}: the [[subjects]] sessions,
+    then the [[event_lags]] sessions that are converted but not processed by the pipeline.
+    """
+    main_config = toml.load(config_path)
+    lag_index = {}
+    for subject_config in main_config.get("subjects", []) + main_config.get("event_lags", []):
+        for session_config in subject_config.get("sessions", []):
+            key = (f"ses-{session_config['id']}", subject_config["id"])
+            lag_index[key] = {
+                "run-1": session_config.get("lag_block_1", 0),
+                "run-2": session_config.get("lag_block_2", 0),
+            }
+    return lag_index
+
+
+def lookup(table, codes):
+    """Vectorized code -> label lookup. Out-of-range codes map to None."""
+    codes = np.asarray(codes)
+    valid = (codes >= 0) & (codes < len(table))
+    labels = np.full(len(codes), None, dtype=object)
+    labels[valid] = table[codes[valid].astype(int)]
+    return labels
+
+
+def parse_log_name(file_path):
+    file_name_split = file_path.name.split("_")
+    subject = f"sub-{file_name_split[3][2:]}"
+    run = f"run-{file_name_split[5]}"
+    return subject, run
+
+
+def get_output_path(subject, ses, run, scans_dir):
+    output_filename = f"{subject}_{ses}_task-war_{run}_events.tsv"
+    func_dir = os.path.join(scans_dir, subject, ses, "func")
+    if os.path.exists(func_dir):
+        return os.path.join(func_dir, output_filename)
+    return output_filename
+
+
+def convert_log_file(file_path, lag, output_path):
+    df = pd.read_csv(file_path)
+    biopac = df["Biopac"].to_numpy()
+
+    trial_types = lookup(TRIAL_TYPE_LOOKUP, biopac)
+    block_types = lookup(BLOCK_LOOKUP, biopac)
+
+    onset = (df["Time"].to_numpy() - lag).round(2)
+    duration = df["Duration"].to_numpy().round(2)
+
+    # Keep mapped events that start after the lag
+    keep = (trial_types != None) & (onset >= 0)  # noqa: E711
+    block_keep = keep & (block_types != None)  # noqa: E711
+
+    events = pd.DataFrame({
+        "onset": np.concatenate([onset[keep], onset[block_keep]]),
+        "duration": np.concatenate([duration[keep], np.full(block_keep.sum(), BLOCK_DURATION)]),
+        "trial_type": np.concatenate([trial_types[keep], block_types[block_keep]]),
+    })
+    events = events.sort_values(by="onset", kind="stable")
+
+    print("Saving to:", output_path)
+    events.to_csv(output_path, sep="\t", index=False)
+    return output_path
+
+
+def is_up_to_date(file_path, output_path):
+    return os.path.exists(output_path) and os.path.getmtime(output_path) >= os.path.getmtime(file_path)
+
+
+def convert_job(job):
+    file_path, lag, output_path = job
+    try:
+        return convert_log_file(file_path, lag, output_path)
+    except Exception as e:
+        print(f"Failed to convert {file_path}. Error: {e}")
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert raw WAR log files into BIDS events TSV files.")
+    parser.add_argument("--input", default="./log_files_raw/ayelet", help="Directory searched recursively for WAR log files.")
+    parser.add_argument("--scans_dir", default="./scans", help="BIDS scans directory. Events are saved into <scans_dir>/<subject>/<session>/func when it exists.")
+    parser.add_argument("--session", nargs="*", default=["ses-1"], help="Session(s) to convert, e.g. ses-1 ses-2.")
+    parser.add_argument("--config", default=DEFAULT_CONFIG, help="Path to main_config.toml with the per-session lag_block_1/2 values.")
+    parser.add_argument("--n_procs", type=int, default=os.cpu_count(), help="Number of log files to convert in parallel.")
+    parser.add_argument("--incremental", action="store_true", help="Only convert logs newer than their output TSV.")
+    args = parser.parse_args()
+
+    lag_index = build_lag_index(args.config)
     file_pattern = "*WAR_LogFile*.csv"
-
-    matching_files = list(base_path.rglob(file_pattern))
-
-    for file_path in matching_files:
-        file_name_split = file_path.name.split("_")
-        subject = f"sub-{file_name_split[3][2:]}"
-        run = f"run-{file_name_split[5]}"
-
-        df = pd.read_csv(file_path)
-
-        # Define function to determine trial_type based on Biopac code
-        def get_trial_type(biopac):
-            if 31 <= biopac <= 34:
-                return f"Negative_Image_{biopac - 30}"
-            elif 51 <= biopac <= 54:
-                return f"Neutral_Image_{biopac - 50}"
-            elif 71 <= biopac <= 74:
-                return f"Positive_Image_{biopac - 70}"
-            elif biopac in [22, 24]:
-                return "Rest"
-            else:
-                return None
-
-        # Apply mapping and filter out unmapped rows
-        df['trial_type'] = df['Biopac'].apply(get_trial_type)
-        df = df.dropna(subset=['trial_type'])
-
-        # Adjust onset based on subject lag
-        # Default to 0 if subject not in lag dictionary
-        subject_lag = lags[ses].get(subject, {}).get(run, 0)
-        df['onset'] = df['Time'] - subject_lag
-
-        # Filter out onsets below 0 and round to 2 decimal points
-        df = df[df['onset'] >= 0]
-        df['onset'] = df['onset'].round(2)
-
-        # Rename Duration column and round duration
-        df = df.rename(columns={'Duration': 'duration'})
-        df['duration'] = df['duration'].round(2)
-
-        # Create duplicate entries for Block events
-        block_definitions = {
-            31: 'Negative_Block',
-            51: 'Neutral_Block',
-            71: 'Positive_Block'
-        }
-
-        new_block_rows = []
-        for biopac_trigger, block_name in block_definitions.items():
-            # Select rows matching the trigger
-            block_instances = df[df['Biopac'] == biopac_trigger].copy()
-            if not block_instances.empty:
-                block_instances['trial_type'] = block_name
-                block_instances['duration'] = 22
-                new_block_rows.append(block_instances)
-
-        # Append block rows if any exist
-        if new_block_rows:
-            df = pd.concat([df] + new_block_rows, ignore_index=True)
-
-        # Select final columns and sort by onset
-        df = df[['onset', 'duration', 'trial_type']].sort_values(by='onset')
-
-        # Save to TSV
-        output_filename = f"{subject}_{ses}_task-war_{run}_events.tsv"
-        if os.path.exists(f"./scans/{subject}/{ses}/func"):
-            output_filename = f"./scans/{subject}/{ses}/func/{output_filename}"
-        print("Saving to:", output_filename)
-        df.to_csv(output_filename, sep='\t', index=False)
-        
\ No newline at end of file
+    matching_files = sorted(Path(args.input).rglob(file_pattern))
+
+    jobs = []
+    missing = set()
+    for ses in args.session:
+        for file_path in matching_files:
+            subject, run = parse_log_name(file_path)
+            # A session without lags in the config is not converted: a wrong lag silently shifts every onset
+            if (ses, subject) not in lag_index:
+                missing.add((ses, subject))
+                continue
+            lag = lag_index[(ses, subject)][run]
+            output_path = get_output_path(subject, ses, run, args.scans_dir)
+            if args.incremental and is_up_to_date(file_path, output_path):
+                print(f"Skipping {file_path.name} (up to date)")
+                continue
+            jobs.append((file_path, lag, output_path))
+
+    for ses, subject in sorted(missing):
+        print(f"Warning: {subject} {ses} has no lag_block_1/2 in {args.config} ([[subjects]] or [[event_lags]]); its logs were not converted.")
+    print(f"Converting {len(jobs)} of {len(matching_files) * len(args.session)} log files...")
+    if args.n_procs > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=args.n_procs) as executor:
+            results = list(executor.map(convert_job, jobs))
+    else:
+        results = [convert_job(job) for job in jobs]
+
+    failed = sum(1 for r in results if r is None)
+    print(f"Done. {len(results) - failed} converted, {failed} failed.")
+
+
+if __name__ == "__main__":
+    main()
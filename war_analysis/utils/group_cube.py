@@ -0,0 +1,176 @@
+"""
+Masked group data cubes: one first-level contrast of an analysis across all subjects and sessions in one file.
+
+Each (analysis, contrast) is extracted once into <output_dir>/group_analysis/_cubes/<analysis>/<contrast>/:
+
+    cube.npy      float32 (n_voxels, n_columns), voxels where any subject has data, one column per subject-session
+    voxels.npy    flat (AFNI order) voxel index of every cube row
+    columns.tsv   column, subject, session, group, dataset and the HEAD size/mtime it was read from
+    meta.json     analysis, contrast and the grid geometry (to write results back as datasets)
+
+Group engines, ROI tools and QC memory-map the cube instead of reopening every subject's stats dataset. A cube is
+only rebuilt when its set of datasets or one of their HEAD files changed:
+
+    python group_cube.py --output <output_dir> --analysis by_block --contrast 'neg_blck#0_Coef' 'pos_blck#0_Coef'
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+
+import afni_io
+import derivatives_catalog
+
+CUBES_DIR = "_cubes"
+COLUMNS = ["column", "subject", "session", "group", "dataset", "head_size", "head_mtime_ns"]
+
+
+def safe_name(label):
+    return re.sub(r"[^\w.-]", "_", label)
+
+
+def cube_dir(output_dir, analysis, contrast):
+    return os.path.join(output_dir, "group_analysis", CUBES_DIR, analysis, safe_name(contrast))
+
+
+def cube_columns(catalog, output_dir, analysis, contrast, groups=None):
+    """One row per cataloged stats dataset of the analysis that has the contrast, sorted by subject and session."""
+    rows = []
+    for key, entry in sorted(catalog["datasets"].items()):
+        if entry["analysis"] != analysis or key != derivatives_catalog.stats_key(entry["subject"], entry["session"], analysis):
+            continue
+        if contrast not in entry["labels"]:
+            continue
+        head_size, head_mtime_ns = entry["head"]
+        rows.append({"subject": entry["subject"], "session": entry["session"],
+                     "group": (groups or {}).get(entry["subject"], "NA"),
+                     "dataset": os.path.join(output_dir, key[:-len(".HEAD")]),
+                     "head_size": head_size, "head_mtime_ns": head_mtime_ns})
+    columns = pd.DataFrame(rows, columns=COLUMNS[1:])
+    columns.insert(0, "column", np.arange(len(columns)))
+    return columns
+
+
+def is_current(path, columns):
+    """True if the cube in `path` was built from exactly these datasets and HEAD signatures."""
+    tsv = os.path.join(path, "columns.tsv")
+    if not os.path.exists(tsv) or not os.path.exists(os.path.join(path, "cube.npy")):
+        return False
+    existing = pd.read_csv(tsv, sep="\t", dtype={"session": str}, keep_default_na=False)
+    keys = ["subject", "session", "dataset", "head_size", "head_mtime_ns"]
+    return existing[keys].astype(str).equals(columns[keys].astype(str))
+
+
+def build(output_dir, analysis, contrast, groups=None, catalog=None, force=False):
+    """Builds (or keeps) the cube of one contrast. Returns (path, rebuilt)."""
+    catalog = catalog or derivatives_catalog.refresh(output_dir, [analysis])
+    columns = cube_columns(catalog, output_dir, analysis, contrast, groups)
+    path = cube_dir(output_dir, analysis, contrast)
+    if columns.empty:
+        raise ValueError(f"No stats datasets of '{analysis}' contain '{contrast}'")
+    if not force and is_current(path, columns):
+        tsv = os.path.join(path, "columns.tsv")
+        if groups and not pd.read_csv(tsv, sep="\t", keep_default_na=False)["group"].astype(str).equals(columns["group"].astype(str)):
+            columns.to_csv(tsv, sep="\t", index=False)  # Only the group labels changed
+        return path, False
+
+    # Written to a temporary directory and swapped in, so readers never see a partial cube.
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    os.makedirs(tmp_path)
+
+    # One pass over the datasets into a scratch memmap, then keep the voxels where any dataset has data.
+    attrs = afni_io.read_head(columns["dataset"][0])
+    stack = np.memmap(os.path.join(tmp_path, "stack.tmp"), dtype=np.float32, mode="w+",
+                      shape=(len(columns), afni_io.n_voxels(attrs)))
+    any_data = np.zeros(stack.shape[1], dtype=bool)
+    for n, dataset in enumerate(columns["dataset"]):
+        brick_attrs, data = afni_io.load_dataset(f"{dataset}[{contrast}]")
+        if afni_io.dims(brick_attrs) != afni_io.dims(attrs):
+            raise ValueError(f"{dataset}: grid differs from {columns['dataset'][0]}")
+        stack[n] = np.asarray(data[0])
+        any_data |= stack[n] != 0
+    voxels = np.flatnonzero(any_data).astype(np.int32)
+
+    cube = np.lib.format.open_memmap(os.path.join(tmp_path, "cube.npy"), mode="w+", dtype=np.float32,
+                                     shape=(len(voxels), len(columns)))
+    for n in range(len(columns)):
+        cube[:, n] = stack[n, voxels]
+    cube.flush()
+    del stack, cube
+    os.remove(os.path.join(tmp_path, "stack.tmp"))
+    np.save(os.path.join(tmp_path, "voxels.npy"), voxels)
+    columns.to_csv(os.path.join(tmp_path, "columns.tsv"), sep="\t", index=False)
+    geometry = {name: attrs[name] for name in afni_io.GEOMETRY_ATTRIBUTES + ["SCENE_DATA"] if name in attrs}
+    with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+        json.dump({"analysis": analysis, "contrast": contrast, "n_voxels": int(len(voxels)),
+                   "n_columns": int(len(columns)), "geometry": geometry}, f, indent=2)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+    return path, True
+
+
+def load(path, mmap_mode="r"):
+    """Returns (meta, columns DataFrame, voxels, memory-mapped (n_voxels, n_columns) cube)."""
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    columns = pd.read_csv(os.path.join(path, "columns.tsv"), sep="\t", dtype={"session": str}, keep_default_na=False)
+    return (meta, columns, np.load(os.path.join(path, "voxels.npy")),
+            np.load(os.path.join(path, "cube.npy"), mmap_mode=mmap_mode))
+
+
+def read_datasets(cube_root, datasets, voxels):
+    """
+    (n_datasets, len(voxels)) float32 matrix of 'dataset[contrast]' inputs read from the cubes in cube_root (one
+    analysis), or None if any input is missing from its cube or its HEAD changed since the cube was built.
+    """
+    cubes = {}
+    out = np.zeros((len(datasets), len(voxels)), dtype=np.float32)
+    for n, path in enumerate(datasets):
+        dataset, contrast = afni_io.split_selector(path)
+        if contrast is None:
+            return None
+        if contrast not in cubes:
+            directory = os.path.join(cube_root, safe_name(contrast))
+            if not os.path.exists(os.path.join(directory, "meta.json")):
+                return None
+            meta, columns, cube_voxels, cube = load(directory)
+            position = np.full(int(np.prod(meta["geometry"]["DATASET_DIMENSIONS"][:3])), -1, dtype=np.int64)
+            position[cube_voxels] = np.arange(len(cube_voxels))
+            rows = position[voxels]
+            inside = rows >= 0
+            # The requested voxels of all columns, read in one sequential pass over the cube
+            cubes[contrast] = (columns.set_index("dataset"), np.asarray(cube[rows[inside]]), inside)
+        columns, block, inside = cubes[contrast]
+        dataset = re.sub(r"\.(HEAD|BRIK)$", "", dataset)
+        if dataset not in columns.index:
+            return None
+        column = columns.loc[dataset]
+        if derivatives_catalog.file_signature(dataset + ".HEAD") != [int(column["head_size"]), int(column["head_mtime_ns"])]:
+            return None
+        out[n, inside] = block[:, int(column["column"])]
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract first-level contrasts into masked group data cubes.")
+    parser.add_argument("--output", required=True, help="Pipeline output_dir.")
+    parser.add_argument("--analysis", required=True, help="First-level analysis.")
+    parser.add_argument("--contrast", nargs="+", required=True, help="Sub-brick labels to extract.")
+    parser.add_argument("--force", action="store_true", help="Rebuild even if the cubes are current.")
+    args = parser.parse_args()
+
+    catalog = derivatives_catalog.refresh(args.output, [args.analysis])
+    for contrast in args.contrast:
+        path, rebuilt = build(args.output, args.analysis, contrast, catalog=catalog, force=args.force)
+        print(f"{'Built' if rebuilt else 'Up to date'}: {path}")
+
+
+if __name__ == "__main__":
+    main()
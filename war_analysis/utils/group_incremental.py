@@ -0,0 +1,231 @@
+"""
+Incremental group t-maps from running sufficient statistics.
+
+For a 3dttest++ group model (incremental = true), the per-voxel sufficient statistics of its inputs (n, sum and sum
+of squares over the group mask) are kept per set, group and session in <model_dir>/_incremental/. Each input
+("member": one subject-session of a set, or one subject-session difference for paired models) also keeps its masked
+vector, so adding, changing or removing a subject updates the sums in O(voxels) instead of re-reading the cohort.
+The t-maps (same labels as group_ttest.py, without permutations) are then rewritten from the sums:
+
+    python group_incremental.py --model_dir <output_dir>/group_analysis/by_block/mdma_s1_neg_vs_neut
+
+prints the cells of a model's state. run_analysis.py updates the incremental models of an analysis after every
+successful GLM; the full group run (permutations, 3dClustSim) remains the reference result.
+"""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+
+import afni_io
+import derivatives_catalog
+import group_mask
+
+STATE_DIR = "_incremental"
+
+
+def member_id(member):
+    return f"{member['set']}:{member['subject']}:ses-{member['session']}"
+
+
+def cell_key(member):
+    return f"{member['set']}/{member['group']}/ses-{member['session']}"
+
+
+def member_signature(member):
+    """Inputs and HEAD signatures of a member, to detect re-run GLMs."""
+    return [[path, derivatives_catalog.file_signature(afni_io.dataset_paths(afni_io.split_selector(path)[0])[0])]
+            for path in member["datasets"]]
+
+
+def member_values(member, voxels):
+    """Masked float64 vector of a member: its sub-brick, or the difference of two sub-bricks (paired)."""
+    values = []
+    for path in member["datasets"]:
+        _, data = afni_io.load_dataset(path)
+        values.append(np.asarray(data[0], dtype=np.float64)[voxels])
+    return values[0] - values[1] if len(values) == 2 else values[0]
+
+
+@contextmanager
+def locked(state_dir):
+    """Serializes updates of one model (subjects finishing in parallel processes update the same state)."""
+    os.makedirs(state_dir, exist_ok=True)
+    with open(os.path.join(state_dir, ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_state(state_dir, mask_hash, n_voxels):
+    """Returns (state, sums); a missing state or a different mask starts from empty sums."""
+    state_path = os.path.join(state_dir, "state.json")
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        if state["mask"] == mask_hash:
+            sums = np.load(os.path.join(state_dir, "sums.npz"))
+            return state, {"sum": sums["sum"], "sumsq": sums["sumsq"]}
+    for name in os.listdir(state_dir):
+        if name.endswith(".npy"):
+            os.remove(os.path.join(state_dir, name))
+    return {"mask": mask_hash, "cells": [], "n": [], "members": {}}, {"sum": np.zeros((0, n_voxels)),
+                                                                       "sumsq": np.zeros((0, n_voxels))}
+
+
+def save_state(state_dir, state, sums):
+    tmp_path = os.path.join(state_dir, f"sums.{uuid.uuid4().hex[:8]}.npz")
+    np.savez(tmp_path, **sums)
+    os.replace(tmp_path, os.path.join(state_dir, "sums.npz"))
+    tmp_path = os.path.join(state_dir, f"state.{uuid.uuid4().hex[:8]}.json")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp_path, os.path.join(state_dir, "state.json"))
+
+
+def update(model_dir, mask_path, members, prefix, setA_label, setB_label="SetB", paired=False):
+    """
+    Brings the sufficient statistics of a model to `members` (dicts with set, subject, session, group and datasets)
+    and rewrites its t-maps (write_map) when they changed or are missing, before releasing the lock, so a concurrent
+    update never overwrites them with older sums. Returns (map path or None when not rewritten, number of members,
+    number added, number removed).
+    """
+    state_dir = os.path.join(model_dir, STATE_DIR)
+    mask_attrs, mask = afni_io.load_dataset(mask_path)
+    voxels = np.flatnonzero(np.asarray(mask[0]) != 0)
+    with locked(state_dir):
+        state, sums = load_state(state_dir, group_mask.dataset_hash(mask_path), len(voxels))
+        wanted = {member_id(member): dict(member, cell=cell_key(member), inputs=member_signature(member))
+                  for member in members}
+
+        def add(cell, values, sign):
+            if cell not in state["cells"]:
+                state["cells"].append(cell)
+                state["n"].append(0)
+                for name in sums:
+                    sums[name] = np.vstack([sums[name], np.zeros(len(voxels))])
+            row = state["cells"].index(cell)
+            state["n"][row] += sign
+            sums["sum"][row] += sign * values
+            sums["sumsq"][row] += sign * values ** 2
+
+        removed = [key for key, done in state["members"].items()
+                   if key not in wanted or done["inputs"] != wanted[key]["inputs"] or done["cell"] != wanted[key]["cell"]]
+        for key in removed:
+            done = state["members"].pop(key)
+            values_path = os.path.join(state_dir, done["file"])
+            add(done["cell"], np.load(values_path), -1)
+            os.remove(values_path)
+
+        added = [key for key in wanted if key not in state["members"]]
+        for key in added:
+            member = wanted[key]
+            values = member_values(member, voxels)
+            member["file"] = hashlib.sha256(key.encode()).hexdigest()[:16] + ".npy"
+            np.save(os.path.join(state_dir, member["file"]), values)
+            add(member["cell"], values, 1)
+            state["members"][key] = {name: member[name] for name in ["set", "subject", "session", "group", "cell", "inputs", "file"]}
+
+        if removed or added:
+            save_state(state_dir, state, sums)
+        path = None
+        if removed or added or not os.path.exists(afni_io.output_path(prefix, mask_attrs) + ".HEAD"):
+            path = write_map(model_dir, mask_path, prefix, state, sums, setA_label, setB_label, paired)
+    return path, len(state["members"]), len(added), len(removed)
+
+
+def set_moments(state, sums, set_name):
+    """(n, mean, variance with ddof=1) of one set, pooled over its group/session cells."""
+    rows = [row for row, cell in enumerate(state["cells"]) if cell.split("/")[0] == set_name]
+    n = sum(state["n"][row] for row in rows)
+    total = sums["sum"][rows].sum(axis=0)
+    total_sq = sums["sumsq"][rows].sum(axis=0)
+    mean = total / max(n, 1)
+    var = np.maximum(total_sq - n * mean ** 2, 0) / max(n - 1, 1)
+    return n, mean, var
+
+
+def one_sample_t(n, mean, var):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(var > 0, mean / np.sqrt(var / n), 0.0)
+
+
+def write_map(model_dir, mask_path, prefix, state, sums, setA_label, setB_label="SetB", paired=False):
+    """
+    Writes the t-maps of the current sums (labels as in group_ttest.py) and returns the dataset path. A test without
+    degrees of freedom yet (a set of one) keeps its mean but has no Tstat; without any Tstat, the map is removed
+    and None is returned.
+    """
+    mask_attrs, mask = afni_io.load_dataset(mask_path)
+    voxels = np.flatnonzero(np.asarray(mask[0]) != 0)
+    results, labels, stataux = [], [], []
+
+    def add(label, mean, t, dof):
+        if dof < 1:
+            labels.append(f"{label}_mean")
+            results.append(mean)
+            return
+        labels.extend([f"{label}_mean", f"{label}_Tstat"])
+        stataux.extend(afni_io.stataux_entry(len(results) + 1, "fitt", (dof,)))
+        results.extend([mean, t])
+
+    if paired:
+        n, mean, var = set_moments(state, sums, "paired")
+        add(f"{setA_label}-{setB_label}", mean, one_sample_t(n, mean, var), n - 1)
+    else:
+        nA, meanA, varA = set_moments(state, sums, "A")
+        nB, meanB, varB = set_moments(state, sums, "B")
+        if nA and nB:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                pooled = ((nA - 1) * varA + (nB - 1) * varB) / max(nA + nB - 2, 1)
+                t = np.where(pooled > 0, (meanA - meanB) / np.sqrt(pooled * (1 / nA + 1 / nB)), 0.0)
+            add(f"{setA_label}-{setB_label}", meanA - meanB, t, nA + nB - 2)
+            add(setA_label, meanA, one_sample_t(nA, meanA, varA), nA - 1)
+            add(setB_label, meanB, one_sample_t(nB, meanB, varB), nB - 1)
+        elif nA:
+            add(setA_label, meanA, one_sample_t(nA, meanA, varA), nA - 1)
+
+    path = afni_io.output_path(prefix, mask_attrs)
+    if not stataux:
+        for part in afni_io.dataset_paths(path):
+            if os.path.exists(part):
+                os.remove(part)
+        return None
+
+    out = np.zeros((len(results), afni_io.n_voxels(mask_attrs)), dtype=np.float32)
+    out[:, voxels] = np.array(results, dtype=np.float32)
+    history = f"[group_incremental.py] {len(state['members'])} inputs from running sufficient statistics"
+    # Written under a temporary prefix and renamed BRIK first, so readers never see a HEAD without its data.
+    tmp_path = afni_io.write_dataset(os.path.join(os.path.dirname(prefix), f".{os.path.basename(prefix)}.{uuid.uuid4().hex[:8]}"),
+                                     out, mask_attrs, labels, stataux, history)
+    for tmp_part, part in zip(reversed(afni_io.dataset_paths(tmp_path)), reversed(afni_io.dataset_paths(path))):
+        os.replace(tmp_part, part)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the running sufficient statistics of an incremental group model.")
+    parser.add_argument("--model_dir", required=True, help="Group model output directory.")
+    args = parser.parse_args()
+
+    state_path = os.path.join(args.model_dir, STATE_DIR, "state.json")
+    if not os.path.exists(state_path):
+        print(f"No incremental state in {args.model_dir}")
+        return
+    with open(state_path) as f:
+        state = json.load(f)
+    for cell, n in zip(state["cells"], state["n"]):
+        print(f"{cell:40s} n = {n}")
+    print(f"{len(state['members'])} inputs")
+
+
+if __name__ == "__main__":
+    main()
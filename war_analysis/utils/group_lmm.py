@@ -0,0 +1,320 @@
+"""
+Native voxelwise random-intercept mixed models (backend = "native" for 3dLMEr group models).
+
+Fits `y = X b + u_Subj + e` at every mask voxel by REML, for models of categorical factors with one random intercept
+per subject (e.g. group*stimulus+(1|Subj), session*stimulus+(1|Subj)). Factors use sum-to-zero coding, as 3dLMEr.
+
+Each subject's rows split into their mean (variance s2 * (1 + lambda * n_i), lambda = random-intercept variance /
+residual variance) and within-subject deviations (variance s2), so for a given lambda the REML fit of every voxel only
+needs the per-subject means and a few cross products shared by all voxels. lambda is profiled on a grid for all voxels
+at once, refined per voxel by parabolic interpolation, and the final fits are batched over voxel chunks. Balanced
+and unbalanced designs (subjects missing rows) are handled alike.
+
+The output matches the 3dLMEr labels: '<term> Chi-sq' (type III Wald chi-square) for every model term, then '<label>'
+and '<label> Z' for every GLT (weights over factor levels; unlisted factors are averaged), plus the conditional
+residuals (-resid) for 3dFWHMx/3dClustSim:
+
+    python group_lmm.py --prefix result_mdma_vs_control_s1 --mask group_mask+tlrc \\
+        --resid result_mdma_vs_control_s1_resid --model 'group*stimulus+(1|Subj)' \\
+        --glt_codes "-gltCode neg_mdma_gt_control 'group : 1*MDMA -1*Control stimulus : 1*neg'" \\
+        --data_table data_table.txt
+
+Z statistics use the containment degrees of freedom: within-subject contrasts get the within-subject residual
+degrees of freedom, contrasts involving between-subject effects the (smaller) between-subject ones.
+"""
+
+import argparse
+import itertools
+import os
+import re
+import shlex
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+import afni_io
+import group_ttest
+
+# Variance ratios (random intercept / residual) profiled for every voxel before the per-voxel refinement.
+LAMBDA_GRID = np.concatenate([[0.0], np.logspace(-3, 3, 25)])
+REFINE_ROUNDS = 3
+
+
+def parse_model(model):
+    """Fixed-effect terms of 'a*b+c+(1|Subj)' as tuples of factor names, in 3dLMEr/R order."""
+    model = model.replace(" ", "")
+    random = re.findall(r"\(([^)]*)\)", model)
+    if random != ["1|Subj"]:
+        raise ValueError(f"Only random-intercept models with (1|Subj) are supported, got {random}")
+    fixed = re.sub(r"\+?\([^)]*\)", "", model).strip("+")
+    terms = []
+    for part in fixed.split("+"):
+        factors = part.split("*")
+        if len(factors) > 1:
+            # a*b expands to a, b and a:b (and all higher-order interactions)
+            for size in range(1, len(factors) + 1):
+                terms.extend(combo for combo in itertools.combinations(factors, size))
+        else:
+            terms.append(tuple(part.split(":")))
+    terms = list(dict.fromkeys(terms))
+    return sorted(terms, key=len)
+
+
+def parse_glts(glt_codes):
+    """Parses "-gltCode label 'f1 : 1*a -1*b f2 : 1*c' ..." into [(label, {factor: {level: weight}})]."""
+    tokens = shlex.split(glt_codes or "")
+    glts = []
+    for n in range(0, len(tokens), 3):
+        if tokens[n] != "-gltCode" or n + 2 >= len(tokens):
+            raise ValueError(f"Cannot parse GLT codes near: {' '.join(tokens[n:n + 3])}")
+        weights = {}
+        for factor, spec in re.findall(r"(\S+)\s*:\s*((?:[+-]?\d*\.?\d+\*\S+\s*)+)", tokens[n + 2]):
+            weights[factor] = {level: float(w) for w, level in re.findall(r"([+-]?\d*\.?\d+)\*(\S+)", spec)}
+        glts.append((tokens[n + 1], weights))
+    return glts
+
+
+def sum_coding(levels):
+    """(n_levels, n_levels - 1) sum-to-zero contrast matrix (R contr.sum)."""
+    coding = np.zeros((len(levels), len(levels) - 1))
+    coding[:-1] = np.eye(len(levels) - 1)
+    coding[-1] = -1
+    return coding
+
+
+def design_rows(terms, levels, cells):
+    """Design matrix rows for a DataFrame of factor levels: intercept, then the columns of every term."""
+    columns = [np.ones((len(cells), 1))]
+    for term in terms:
+        block = np.ones((len(cells), 1))
+        for factor in term:
+            coded = sum_coding(levels[factor])[[levels[factor].index(v) for v in cells[factor]]]
+            block = (block[:, :, None] * coded[:, None, :]).reshape(len(cells), -1)
+        columns.append(block)
+    return np.hstack(columns)
+
+
+def term_columns(terms, levels):
+    """Slices of the design columns of every term."""
+    slices, start = {}, 1
+    for term in terms:
+        width = int(np.prod([len(levels[factor]) - 1 for factor in term]))
+        slices[term] = slice(start, start + width)
+        start += width
+    return slices
+
+
+def glt_vector(weights, factors, terms, levels):
+    """Contrast over the fixed effects: weighted cell means, averaging over the factors the GLT does not list."""
+    for factor, level_weights in weights.items():
+        if factor not in levels:
+            raise ValueError(f"GLT factor '{factor}' is not in the model")
+        unknown = set(level_weights) - set(levels[factor])
+        if unknown:
+            raise ValueError(f"GLT levels {sorted(unknown)} of '{factor}' are not in the data table")
+    cells = pd.DataFrame(list(itertools.product(*(levels[f] for f in factors))), columns=factors)
+    cell_weights = np.ones(len(cells))
+    for factor in factors:
+        if factor in weights:
+            cell_weights *= cells[factor].map(lambda v: weights[factor].get(v, 0.0)).to_numpy()
+        else:
+            cell_weights /= len(levels[factor])
+    return cell_weights @ design_rows(terms, levels, cells)
+
+
+class Design:
+    """The subject-mean / within-subject decomposition of a random-intercept design."""
+
+    def __init__(self, X, subjects):
+        self.X = X
+        self.subject_index, self.subject_ids = pd.factorize(pd.Series(subjects))
+        self.n_subjects = len(self.subject_ids)
+        self.counts = np.bincount(self.subject_index).astype(float)
+        self.averaging = np.zeros((self.n_subjects, len(self.subject_index)))
+        self.averaging[self.subject_index, np.arange(len(self.subject_index))] = 1 / self.counts[self.subject_index]
+        self.n, self.p = X.shape
+        if np.linalg.matrix_rank(X) < self.p:
+            raise ValueError("The fixed-effect design is rank deficient (empty cells in the data table?)")
+        self.X_mean = self.subject_means(X)
+        self.X_within = X - self.X_mean[self.subject_index]
+        self.C_within = self.X_within.T @ self.X_within
+        # Per-subject outer products of the mean rows: A(lambda) = C_within + sum_i w_i B_i
+        self.B = self.X_mean[:, :, None] * self.X_mean[:, None, :]
+        # Containment degrees of freedom of the two strata
+        self.between_columns = np.abs(self.X_within).max(axis=0) < 1e-9
+        self.df_between = self.n_subjects - np.linalg.matrix_rank(self.X_mean)
+        self.df_within = self.n - self.n_subjects - np.linalg.matrix_rank(self.X_within)
+
+    def subject_means(self, Y):
+        return self.averaging @ Y
+
+    def weights(self, lam):
+        """n_i / (1 + lambda n_i): precision weight of every subject-mean row (lam broadcasts over voxels)."""
+        return self.counts / (1 + np.multiply.outer(lam, self.counts))
+
+
+def reml_criterion(design, lam, stats_within, Y_mean):
+    """-2 REML log-likelihood (up to a constant) at per-voxel lambdas, with sigma^2 profiled out."""
+    yy_within, Xy_within = stats_within
+    w = design.weights(lam)  # (n_voxels, n_subjects)
+    A = design.C_within[None] + np.tensordot(w, design.B, axes=1)
+    b = Xy_within.T + (w * Y_mean.T) @ design.X_mean
+    Q = yy_within + np.einsum("vs,sv->v", w, Y_mean ** 2) - np.einsum("vp,vp->v", b, np.linalg.solve(A, b[..., None])[..., 0])
+    n_p = design.n - design.p
+    return (np.log1p(np.multiply.outer(lam, design.counts)).sum(axis=1) + np.linalg.slogdet(A)[1]
+            + n_p * np.log(np.maximum(Q, 1e-30) / n_p))
+
+
+def fit_chunk(design, Y, contrasts, terms):
+    """REML fits of the (n_rows, n_voxels) chunk Y. Returns (term chi-squares, GLT estimates and t, residuals)."""
+    Y = Y.astype(np.float64)
+    Y_mean = design.subject_means(Y)
+    Y_within = Y - Y_mean[design.subject_index]
+    stats_within = ((Y_within ** 2).sum(axis=0), design.X_within.T @ Y_within)
+    n_voxels = Y.shape[1]
+
+    # Profile lambda on the grid, then refine each voxel in log(lambda) by parabolas through its best point and two
+    # neighbours, shrinking the bracket at every round
+    profile = np.array([reml_criterion(design, np.full(n_voxels, lam), stats_within, Y_mean) for lam in LAMBDA_GRID])
+    best = np.argmin(profile, axis=0)
+    lam = LAMBDA_GRID[best]
+    refine = np.flatnonzero(best > 0)
+    if len(refine):
+        x = np.log(lam[refine])
+        f1 = profile[best[refine], refine]
+        step = np.log(LAMBDA_GRID[2] / LAMBDA_GRID[1])
+        sub_stats = (stats_within[0][refine], stats_within[1][:, refine])
+        for _ in range(REFINE_ROUNDS):
+            f0, f2 = (reml_criterion(design, np.exp(x + k * step), sub_stats, Y_mean[:, refine]) for k in (-1, 1))
+            curvature = f0 - 2 * f1 + f2
+            with np.errstate(divide="ignore", invalid="ignore"):
+                shift = np.where(curvature > 0, 0.5 * step * (f0 - f2) / curvature, np.where(f0 < f2, -step, step))
+            x = x + np.clip(shift, -step, step)
+            f1 = reml_criterion(design, np.exp(x), sub_stats, Y_mean[:, refine])
+            step /= 4
+        lam[refine] = np.exp(np.clip(x, np.log(LAMBDA_GRID[1]), np.log(LAMBDA_GRID[-1])))
+
+    # Final generalized least squares fit of every voxel at its own lambda, as batched p x p solves
+    w = design.weights(lam)  # (n_voxels, n_subjects)
+    A = design.C_within[None] + np.tensordot(w, design.B, axes=1)
+    b = stats_within[1].T + (w * Y_mean.T) @ design.X_mean
+    A_inv = np.linalg.inv(A)
+    beta = np.einsum("vpq,vq->vp", A_inv, b)
+    Q = stats_within[0] + np.einsum("vs,sv->v", w, Y_mean ** 2) - np.einsum("vp,vp->v", b, beta)
+    sigma2 = np.maximum(Q, 0) / (design.n - design.p)
+    cov = sigma2[:, None, None] * A_inv
+
+    chisq = []
+    for term, columns in terms:
+        beta_t = beta[:, columns]
+        cov_t = cov[:, columns, columns]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            valid = sigma2 > 0
+            value = np.zeros(len(beta))
+            value[valid] = np.einsum("vp,vp->v", beta_t[valid], np.linalg.solve(cov_t[valid], beta_t[valid][..., None])[..., 0])
+        chisq.append(value)
+    glts = []
+    for L, df in contrasts:
+        estimate = beta @ L
+        se = np.sqrt(np.maximum(np.einsum("p,vpq,q->v", L, cov, L), 0))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(se > 0, estimate / se, 0.0)
+        z = np.sign(t) * stats.norm.isf(np.clip(stats.t.sf(np.abs(t), df), 1e-300, 0.5))
+        glts.append((estimate, z))
+
+    # Conditional residuals: y - X b - u_i, with the BLUP u_i = lambda n_i / (1 + lambda n_i) * mean_i(y - X b)
+    fitted = design.X @ beta.T
+    shrink = (np.multiply.outer(lam, design.counts) / (1 + np.multiply.outer(lam, design.counts))).T
+    u = shrink * design.subject_means(Y - fitted)
+    residuals = Y - fitted - u[design.subject_index]
+    return chisq, glts, residuals
+
+
+def read_data_table(path):
+    table = pd.read_csv(path, sep=r"\s+", dtype=str, keep_default_na=False)
+    for column in ["Subj", "InputFile"]:
+        if column not in table:
+            raise ValueError(f"{path}: missing '{column}' column")
+    return table
+
+
+def run(args):
+    terms = parse_model(args.model)
+    table = read_data_table(args.data_table)
+    factors = list(dict.fromkeys(factor for term in terms for factor in term))
+    missing = [factor for factor in factors if factor not in table]
+    if missing:
+        raise ValueError(f"Model factors {missing} are not columns of {args.data_table}")
+    levels = {factor: sorted(table[factor].unique()) for factor in factors}
+    for factor, factor_levels in levels.items():
+        if len(factor_levels) < 2:
+            raise ValueError(f"Factor '{factor}' has a single level ({factor_levels[0]}); drop it from the model")
+
+    design = Design(design_rows(terms, levels, table), table["Subj"].to_numpy())
+    slices = term_columns(terms, levels)
+    contrasts, glt_labels = [], []
+    for label, weights in parse_glts(args.glt_codes):
+        L = glt_vector(weights, factors, terms, levels)
+        between = np.any((np.abs(L) > 1e-12) & design.between_columns & (np.arange(design.p) > 0))
+        contrasts.append((L, design.df_between if between else design.df_within))
+        glt_labels.append(label)
+
+    mask_attrs, mask = afni_io.load_dataset(args.mask)
+    voxels = np.flatnonzero(np.asarray(mask[0]) != 0)
+    Y = group_ttest.load_set(list(table["InputFile"]), voxels, args.cube_dir)
+    print(f"{len(table)} rows, {design.n_subjects} subjects, {design.p} fixed effects, {len(voxels)} voxels")
+
+    n_out = len(terms) + 2 * len(contrasts)
+    results = np.zeros((n_out, len(voxels)), dtype=np.float32)
+    residuals = np.zeros((len(table), len(voxels)), dtype=np.float32) if args.resid else None
+    term_slices = [(term, slices[term]) for term in terms]
+    for start in range(0, len(voxels), args.chunk):
+        stop = min(start + args.chunk, len(voxels))
+        chisq, glts, chunk_residuals = fit_chunk(design, Y[:, start:stop], contrasts, term_slices)
+        results[:len(terms), start:stop] = chisq
+        for n, (estimate, z) in enumerate(glts):
+            results[len(terms) + 2 * n, start:stop] = estimate
+            results[len(terms) + 2 * n + 1, start:stop] = z
+        if residuals is not None:
+            residuals[:, start:stop] = chunk_residuals
+
+    labels, stataux = [], []
+    for n, term in enumerate(terms):
+        labels.append(f"{':'.join(term)} Chi-sq")
+        stataux.extend(afni_io.stataux_entry(n, "fict", (slices[term].stop - slices[term].start,)))
+    for label in glt_labels:
+        labels.extend([label, f"{label} Z"])
+        stataux.extend(afni_io.stataux_entry(len(labels) - 1, "fizt"))
+
+    out = np.zeros((n_out, afni_io.n_voxels(mask_attrs)), dtype=np.float32)
+    out[:, voxels] = results
+    history = f"[group_lmm.py] {args.model}, {design.n_subjects} subjects, {len(table)} rows"
+    path = afni_io.write_dataset(args.prefix, out, mask_attrs, labels, stataux, history)
+    if residuals is not None:
+        out = np.zeros((len(table), afni_io.n_voxels(mask_attrs)), dtype=np.float32)
+        out[:, voxels] = residuals
+        afni_io.write_dataset(args.resid, out, mask_attrs, [f"resid{n}" for n in range(len(table))], history=history)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Voxelwise random-intercept mixed models (3dLMEr-compatible outputs).")
+    parser.add_argument("--prefix", required=True, help="Output dataset prefix.")
+    parser.add_argument("--mask", required=True, help="Group mask.")
+    parser.add_argument("--model", required=True, help="3dLMEr model formula with a (1|Subj) random intercept.")
+    parser.add_argument("--data_table", required=True, help="3dLMEr data table (Subj, factor columns, InputFile).")
+    parser.add_argument("--glt_codes", default="", help="3dLMEr -gltCode options as one string.")
+    parser.add_argument("--resid", help="Prefix of the residual dataset.")
+    parser.add_argument("--chunk", type=int, default=5000, help="Voxels fitted per batch.")
+    parser.add_argument("--cube_dir", help="Group data cubes of the first-level analysis (group_cube.py), used when current.")
+    args = parser.parse_args()
+
+    if os.path.exists(afni_io.dataset_paths(afni_io.output_path(args.prefix, afni_io.read_head(args.mask)))[0]):
+        print(f"Output dataset {args.prefix} already exists. Skipping.")
+        return
+    print(f"Wrote {run(args)}")
+
+
+if __name__ == "__main__":
+    main()
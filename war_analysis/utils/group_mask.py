@@ -0,0 +1,118 @@
+"""
+Group masks computed from the subjects' EPI/anat masks, equivalent to `3dmask_tool -input ... -frac F`.
+
+Voxels are counted over the memory-mapped masks with numpy, and each result is cached under a key made of the
+sorted content hashes of the contributing masks and the fraction, so every group model over the same subjects and
+sessions reuses the same mask:
+
+    python group_mask.py --inputs sub-*/ses-1/func_preproc/*.results/mask_epi_anat.*+tlrc.HEAD --frac 0.4 \\
+        --cache_dir <output_dir>/group_analysis/_mask_cache --prefix group_mask
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+import afni_io
+
+CACHE_NAME = "_mask_cache"
+
+
+def dataset_hash(path):
+    """SHA-256 of the HEAD and BRIK of a dataset."""
+    digest = hashlib.sha256()
+    for part in afni_io.dataset_paths(path):
+        if not os.path.exists(part) and os.path.exists(part + ".gz"):
+            part += ".gz"
+        with open(part, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def mask_key(mask_files, frac):
+    digest = hashlib.sha256(f"frac={frac:g}".encode())
+    for file_hash in sorted(dataset_hash(path) for path in mask_files):
+        digest.update(file_hash.encode())
+    return digest.hexdigest()[:24]
+
+
+def count_masks(mask_files):
+    """Returns (template attrs, number of masks that include each voxel)."""
+    template = None
+    counts = None
+    for path in mask_files:
+        attrs, data = afni_io.load_dataset(path)
+        if template is None:
+            template, counts = attrs, np.zeros(afni_io.n_voxels(attrs), dtype=np.int32)
+        elif afni_io.dims(attrs) != afni_io.dims(template):
+            raise ValueError(f"{path}: grid {afni_io.dims(attrs)} differs from {afni_io.dims(template)}")
+        counts += np.asarray(data[0]) != 0
+    return template, counts
+
+
+def compute_mask(mask_files, frac):
+    """Voxels that are nonzero in at least frac of the masks (frac >= 1 is an absolute count, as in 3dmask_tool)."""
+    template, counts = count_masks(mask_files)
+    needed = frac if frac >= 1 else math.ceil(frac * len(mask_files) - 1e-9)
+    return template, (counts >= max(1, needed)).astype(np.float32)
+
+
+def build(mask_files, frac, cache_dir):
+    """Returns the path of the cached group mask of mask_files, computing it on the first request."""
+    if not mask_files:
+        raise ValueError("No masks to combine")
+    os.makedirs(cache_dir, exist_ok=True)
+    key = mask_key(mask_files, frac)
+    template_attrs = afni_io.read_head(mask_files[0])
+    path = afni_io.output_path(os.path.join(cache_dir, f"group_mask_{key}"), template_attrs)
+    if os.path.exists(afni_io.dataset_paths(path)[0]):
+        return path, True
+
+    template, mask = compute_mask(mask_files, frac)
+    # Written under a temporary prefix, then renamed BRIK first, so a visible HEAD always has its data.
+    tmp_path = afni_io.write_dataset(os.path.join(cache_dir, f".group_mask_{key}.{uuid.uuid4().hex[:8]}"),
+                                     mask[None], template, ["group_mask"],
+                                     history=f"[group_mask.py] {len(mask_files)} masks, frac {frac:g}")
+    with open(os.path.join(cache_dir, f"group_mask_{key}.json"), "w") as f:
+        json.dump({"frac": frac, "n_voxels": int(mask.sum()), "inputs": sorted(mask_files)}, f, indent=2)
+    for tmp_part, part in zip(reversed(afni_io.dataset_paths(tmp_path)), reversed(afni_io.dataset_paths(path))):
+        os.replace(tmp_part, part)
+    return path, False
+
+
+def link(path, prefix):
+    """Makes <prefix>+view (HEAD/BRIK) point at a cached mask and returns the linked dataset path."""
+    linked = afni_io.output_path(prefix, afni_io.read_head(path))
+    for source, target in zip(afni_io.dataset_paths(path), afni_io.dataset_paths(linked)):
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            os.symlink(os.path.relpath(source, os.path.dirname(os.path.abspath(target))), target)
+        except OSError:
+            shutil.copy2(source, target)
+    return linked
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build (or reuse) a cached group mask from subject masks.")
+    parser.add_argument("--inputs", nargs="+", required=True, help="Subject mask datasets.")
+    parser.add_argument("--frac", type=float, default=0.4, help="Fraction (or count, if >= 1) of masks a voxel needs.")
+    parser.add_argument("--cache_dir", required=True, help="Directory of cached group masks.")
+    parser.add_argument("--prefix", help="Optional prefix linked to the cached mask.")
+    args = parser.parse_args()
+
+    path, cached = build(args.inputs, args.frac, args.cache_dir)
+    print(f"{'Reused' if cached else 'Computed'} group mask {path}")
+    if args.prefix:
+        print(f"Linked {link(path, args.prefix)}")
+
+
+if __name__ == "__main__":
+    main()
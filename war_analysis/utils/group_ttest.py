@@ -0,0 +1,192 @@
+"""
+Native group t-tests with permutation inference (backend = "native" for 3dttest++ group models).
+
+Stacks one contrast sub-brick per subject into a masked (n_subjects, n_voxels) float32 matrix, reading only that
+sub-brick of each stats dataset, and computes one-sample, two-sample (pooled variance) or paired t-tests in one
+vectorized pass. The outputs follow 3dttest++ (SetA_mean, SetA_Tstat, ...). With --permutations N, sign flips
+(one-sample, paired) or label permutations (two-sample) are evaluated in batches, and the maximum |t| of each
+permutation forms the null distribution of the family-wise corrected p-values (<label>_pFWE):
+
+    python group_ttest.py --prefix result_mdma_s1 --mask group_mask+tlrc \\
+        --setA_label MDMA --setA_files sub-MD21 stats.sub-MD21_by_block+tlrc'[neg_blck#0_Coef]' ... \\
+        --permutations 5000
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+import afni_io
+import group_cube
+
+
+def parse_set(files):
+    """Splits a 3dttest++ style 'subject dataset subject dataset ...' list into (subjects, datasets)."""
+    if len(files) % 2:
+        raise ValueError("Set files must be 'subject dataset' pairs")
+    return files[0::2], files[1::2]
+
+
+def load_set(datasets, voxels, cube_root=None):
+    """
+    (n_subjects, n_voxels) float32 matrix of one sub-brick per dataset, restricted to the mask voxels. Read from the
+    group data cubes in cube_root when they hold every dataset, otherwise from the datasets themselves.
+    """
+    if cube_root:
+        Y = group_cube.read_datasets(cube_root, datasets, voxels)
+        if Y is not None:
+            return Y
+    Y = np.empty((len(datasets), len(voxels)), dtype=np.float32)
+    for n, path in enumerate(datasets):
+        _, data = afni_io.load_dataset(path)
+        if data.shape[0] != 1:
+            raise ValueError(f"{path}: select exactly one sub-brick (got {data.shape[0]})")
+        Y[n] = np.asarray(data[0])[voxels]
+    return Y
+
+
+def one_sample(Y):
+    """Returns (mean, t) over the rows of Y."""
+    n = Y.shape[0]
+    mean = Y.mean(axis=0, dtype=np.float64)
+    sd = Y.std(axis=0, ddof=1, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(sd > 0, mean / (sd / np.sqrt(n)), 0.0)
+    return mean, t
+
+
+def two_sample(A, B):
+    """Returns (mean difference, pooled-variance t) of A - B."""
+    nA, nB = A.shape[0], B.shape[0]
+    diff = A.mean(axis=0, dtype=np.float64) - B.mean(axis=0, dtype=np.float64)
+    pooled = ((nA - 1) * A.var(axis=0, ddof=1, dtype=np.float64) + (nB - 1) * B.var(axis=0, ddof=1, dtype=np.float64)) / (nA + nB - 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(pooled > 0, diff / np.sqrt(pooled * (1 / nA + 1 / nB)), 0.0)
+    return diff, t
+
+
+def batch_size(n_arrays, n_voxels, max_memory_mb):
+    """Permutations per batch so that n_arrays float64 (batch, n_voxels) work arrays fit in max_memory_mb."""
+    return max(1, int(max_memory_mb * 2 ** 20 / (8 * n_arrays * max(n_voxels, 1))))
+
+
+def sign_flip_null(Y, n_permutations, rng, max_memory_mb=1024):
+    """Maximum |t| of one-sample t-tests under random sign flips of the subjects (rows of Y)."""
+    n = Y.shape[0]
+    Y = Y.astype(np.float64)
+    sumsq = (Y ** 2).sum(axis=0)
+    max_t = np.empty(n_permutations)
+    step = batch_size(4, Y.shape[1], max_memory_mb)
+    for start in range(0, n_permutations, step):
+        signs = rng.choice([-1.0, 1.0], size=(min(step, n_permutations - start), n))
+        mean = signs @ Y / n
+        var = np.maximum(sumsq - n * mean ** 2, 0) / (n - 1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(var > 0, mean / np.sqrt(var / n), 0.0)
+        max_t[start:start + len(signs)] = np.abs(t).max(axis=1)
+    return max_t
+
+
+def label_permutation_null(A, B, n_permutations, rng, max_memory_mb=1024):
+    """Maximum |t| of pooled two-sample t-tests under random relabeling of the subjects of A and B."""
+    nA, nB = A.shape[0], B.shape[0]
+    n = nA + nB
+    Z = np.concatenate([A, B]).astype(np.float64)
+    total, total_sq = Z.sum(axis=0), (Z ** 2).sum(axis=0)
+    max_t = np.empty(n_permutations)
+    step = batch_size(9, Z.shape[1], max_memory_mb)
+    for start in range(0, n_permutations, step):
+        size = min(step, n_permutations - start)
+        G = np.zeros((size, n))
+        order = np.argsort(rng.random((size, n)), axis=1)[:, :nA]
+        np.put_along_axis(G, order, 1.0, axis=1)
+        sumA, sqA = G @ Z, G @ Z ** 2
+        sumB, sqB = total - sumA, total_sq - sqA
+        meanA, meanB = sumA / nA, sumB / nB
+        pooled = np.maximum((sqA - nA * meanA ** 2) + (sqB - nB * meanB ** 2), 0) / (n - 2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(pooled > 0, (meanA - meanB) / np.sqrt(pooled * (1 / nA + 1 / nB)), 0.0)
+        max_t[start:start + size] = np.abs(t).max(axis=1)
+    return max_t
+
+
+def fwe_p(t, max_null):
+    """Family-wise corrected p-values of |t| against the max-statistic null."""
+    null = np.sort(max_null)
+    exceed = len(null) - np.searchsorted(null, np.abs(t), side="left")
+    return (1 + exceed) / (1 + len(null))
+
+
+def run(args):
+    mask_attrs, mask = afni_io.load_dataset(args.mask)
+    voxels = np.flatnonzero(np.asarray(mask[0]) != 0)
+    rng = np.random.default_rng(args.seed)
+
+    subjects_a, datasets_a = parse_set(args.setA_files)
+    A = load_set(datasets_a, voxels, args.cube_dir)
+    results, labels, stataux = [], [], []
+
+    def add(label, mean, t, dof):
+        labels.extend([f"{label}_mean", f"{label}_Tstat"])
+        stataux.extend(afni_io.stataux_entry(len(results) + 1, "fitt", (dof,)))
+        results.extend([mean, t])
+
+    if args.setB_files:
+        subjects_b, datasets_b = parse_set(args.setB_files)
+        B = load_set(datasets_b, voxels, args.cube_dir)
+        if args.paired:
+            if subjects_a != subjects_b:
+                raise ValueError("Paired test: setA and setB must list the same subjects in the same order")
+            label = f"{args.setA_label}-{args.setB_label}"
+            D = A - B
+            mean, t = one_sample(D)
+            add(label, mean, t, len(D) - 1)
+            null = sign_flip_null(D, args.permutations, rng, args.max_memory_mb) if args.permutations else None
+        else:
+            label = f"{args.setA_label}-{args.setB_label}"
+            diff, t = two_sample(A, B)
+            add(label, diff, t, len(A) + len(B) - 2)
+            null = label_permutation_null(A, B, args.permutations, rng, args.max_memory_mb) if args.permutations else None
+        for set_label, Y in [(args.setA_label, A), (args.setB_label, B)]:
+            add(set_label, *one_sample(Y), len(Y) - 1)
+    else:
+        label = args.setA_label
+        mean, t = one_sample(A)
+        add(label, mean, t, len(A) - 1)
+        null = sign_flip_null(A, args.permutations, rng, args.max_memory_mb) if args.permutations else None
+
+    if null is not None:
+        labels.append(f"{label}_pFWE")
+        results.append(fwe_p(results[1], null))
+        np.savetxt(afni_io.split_selector(args.prefix)[0] + "_maxnull.1D", null, fmt="%.6f")
+
+    out = np.zeros((len(results), afni_io.n_voxels(mask_attrs)), dtype=np.float32)
+    out[:, voxels] = np.array(results, dtype=np.float32)
+    history = f"[group_ttest.py] {len(A)} setA subjects" + (f", {args.permutations} permutations" if null is not None else "")
+    return afni_io.write_dataset(args.prefix, out, mask_attrs, labels, stataux, history)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vectorized one-sample/two-sample/paired t-tests with permutation inference.")
+    parser.add_argument("--prefix", required=True, help="Output dataset prefix.")
+    parser.add_argument("--mask", required=True, help="Group mask.")
+    parser.add_argument("--setA_label", required=True)
+    parser.add_argument("--setA_files", nargs="+", required=True, help="'subject dataset[sub-brick]' pairs.")
+    parser.add_argument("--setB_label", default="SetB")
+    parser.add_argument("--setB_files", nargs="+", help="Second set: two-sample test, or paired with --paired.")
+    parser.add_argument("--paired", action="store_true", help="Paired test of setA - setB (same subjects).")
+    parser.add_argument("--permutations", type=int, default=0, help="Number of sign-flip/label permutations (0: none).")
+    parser.add_argument("--max_memory_mb", type=int, default=1024, help="Memory for one batch of permutations.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cube_dir", help="Group data cubes of the first-level analysis (group_cube.py), used when current.")
+    args = parser.parse_args()
+
+    if os.path.exists(afni_io.dataset_paths(afni_io.output_path(args.prefix, afni_io.read_head(args.mask)))[0]):
+        print(f"Output dataset {args.prefix} already exists. Skipping.")
+        return
+    print(f"Wrote {run(args)}")
+
+
+if __name__ == "__main__":
+    main()
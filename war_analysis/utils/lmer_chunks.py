@@ -0,0 +1,119 @@
+"""
+Voxel-chunked parallel 3dLMEr.
+
+Partitions the group mask into K disjoint sub-masks (interleaved mask voxels, so every chunk gets a similar share of
+the brain), runs 3dLMEr on each sub-mask concurrently within a core budget (-jobs per process = cores // chunks),
+and merges the chunk outputs back into one stats dataset and one residual dataset with the labels and statistics of
+a whole-mask run:
+
+    python lmer_chunks.py --prefix result_mdma_vs_control_s1 --mask group_mask+tlrc \\
+        --resid result_mdma_vs_control_s1_resid --chunks 4 --cores 16 -- \\
+        -SS_type 3 -model 'group*stimulus+(1|Subj)' -gltCode neg_mdma_gt_control '...' -dataTable @data_table.txt
+
+3dLMEr fits every voxel independently, so the merged result equals a single 3dLMEr run over the whole mask.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import afni_io
+
+# Per-chunk attributes that AFNI recomputes on load.
+DROPPED_ATTRIBUTES = ["BRICK_STATS"]
+
+
+def chunk_masks(mask, n_chunks):
+    """Splits the nonzero voxels of a mask into n_chunks disjoint, interleaved sub-masks."""
+    voxels = np.flatnonzero(np.asarray(mask) != 0)
+    n_chunks = max(1, min(n_chunks, len(voxels)))
+    masks = np.zeros((n_chunks, len(mask)), dtype=np.float32)
+    for k in range(n_chunks):
+        masks[k, voxels[k::n_chunks]] = 1
+    return masks
+
+
+def run_chunk(k, mask_path, args, work_dir, jobs):
+    cmd = ["3dLMEr", "-prefix", f"chunk{k}", "-mask", mask_path, "-jobs", str(jobs)]
+    if args.resid:
+        cmd += ["-resid", f"chunk{k}_resid"]
+    cmd += args.lmer_args
+    print(f"  Chunk {k}: 3dLMEr with {jobs} job(s)", flush=True)
+    env = dict(os.environ, OMP_NUM_THREADS="1")
+    with open(os.path.join(work_dir, f"chunk{k}.log"), "w") as log_file:
+        result = subprocess.run(cmd, cwd=work_dir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+    if result.returncode != 0:
+        raise RuntimeError(f"3dLMEr failed on chunk {k}, see {os.path.join(work_dir, f'chunk{k}.log')}")
+    return k
+
+
+def merge_chunks(chunk_paths, masks, prefix, mask_attrs):
+    """Takes every voxel from the chunk whose sub-mask contains it. Voxels outside the mask are zero."""
+    attrs = afni_io.read_head(chunk_paths[0])
+    labels = afni_io.brick_labels(attrs)
+    for path in chunk_paths[1:]:
+        if afni_io.brick_labels(afni_io.read_head(path)) != labels:
+            raise ValueError(f"{path}: sub-brick labels differ from {chunk_paths[0]}")
+    for name in DROPPED_ATTRIBUTES:
+        attrs.pop(name, None)
+    attrs.update({name: mask_attrs[name] for name in afni_io.GEOMETRY_ATTRIBUTES if name in mask_attrs})
+    attrs.update({"BRICK_TYPES": [3] * len(labels), "BRICK_FLOAT_FACS": [0.0] * len(labels)})
+    attrs.update(afni_io.new_idcode())
+    if "HISTORY_NOTE" in attrs:
+        attrs["HISTORY_NOTE"] += f"\\n[lmer_chunks.py] merged {len(chunk_paths)} voxel chunks"
+
+    path = afni_io.output_path(prefix, mask_attrs)
+    afni_io.write_attributes(path, attrs)
+    _, brik_path = afni_io.dataset_paths(path)
+    out = np.memmap(brik_path, dtype=np.float32, mode="w+", shape=(len(labels), afni_io.n_voxels(mask_attrs)))
+    out[:] = 0
+    for chunk_path, chunk_mask in zip(chunk_paths, masks):
+        voxels = np.flatnonzero(chunk_mask)
+        _, data = afni_io.load_dataset(chunk_path)
+        out[:, voxels] = np.asarray(data[:, voxels], dtype=np.float32)
+    out.flush()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run 3dLMEr on disjoint sub-masks in parallel and merge the outputs.")
+    parser.add_argument("--prefix", required=True, help="Prefix of the merged stats dataset.")
+    parser.add_argument("--mask", required=True, help="Group mask to partition.")
+    parser.add_argument("--resid", help="Prefix of the merged residual dataset (3dLMEr -resid).")
+    parser.add_argument("--chunks", type=int, default=4, help="Number of sub-masks run concurrently.")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="Total cores available to all chunks.")
+    parser.add_argument("--work_dir", help="Scratch directory. Defaults to a temporary directory next to the outputs.")
+    parser.add_argument("lmer_args", nargs="*", help="Other 3dLMEr options, after '--' (without -prefix/-mask/-resid/-jobs).")
+    args = parser.parse_args()
+
+    mask_attrs, mask = afni_io.load_dataset(args.mask)
+    masks = chunk_masks(mask[0], args.chunks)
+    jobs = max(1, args.cores // len(masks))
+    print(f"3dLMEr on {len(masks)} chunks of {int(masks[0].sum())} voxels with {jobs} job(s) each")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="lmer_chunks_", dir=os.path.dirname(os.path.abspath(args.prefix)))
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        mask_paths = [os.path.abspath(afni_io.write_dataset(os.path.join(work_dir, f"chunk{k}_mask"), chunk[None],
+                                                            mask_attrs, ["mask"]))
+                      for k, chunk in enumerate(masks)]
+        with ThreadPoolExecutor(max_workers=len(masks)) as executor:
+            list(executor.map(lambda k: run_chunk(k, mask_paths[k], args, work_dir, jobs), range(len(masks))))
+
+        view = afni_io.view(mask_attrs)
+        outputs = [(args.prefix, "chunk{}")] + ([(args.resid, "chunk{}_resid")] if args.resid else [])
+        for prefix, chunk_prefix in outputs:
+            chunk_paths = [os.path.join(work_dir, f"{chunk_prefix.format(k)}+{view}") for k in range(len(masks))]
+            print(f"Wrote {merge_chunks(chunk_paths, masks, prefix, mask_attrs)}")
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
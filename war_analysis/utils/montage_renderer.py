@@ -0,0 +1,307 @@
+"""
+Headless slice montage renderer.
+
+Replaces the @chauffeur_afni QC calls: reads the underlay and the overlay/threshold sub-bricks through afni_io
+memory maps, thresholds the overlay at a p-value converted to the statistic of the threshold sub-brick
+(BRICK_STATAUX), and writes one montage per view as <prefix>.axi.png, <prefix>.cor.png and <prefix>.sag.png,
+the names @chauffeur_afni produces and export_results.create_glm_results_pdf groups by.
+
+Defaults follow the GLM QC settings of 03_run_glm.sh:
+
+    python montage_renderer.py --ulay anat_final+tlrc --olay stats+tlrc \\
+        --olay_brick 'neg_blck#0_Coef' --thr_brick 'neg_blck#0_Tstat' --prefix QC/neg_blck
+
+Many montages can be rendered in one call with --batch jobs.json (a list of objects with the same keys as the
+command-line options), in parallel across --n_procs processes.
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw
+from scipy import ndimage, stats
+
+import afni_io
+
+VIEWS = {"sag": 0, "cor": 1, "axi": 2}  # DICOM axis held fixed in each view
+
+# Color stops (value in [-1, 1], RGB in [0, 1])
+CBARS = {
+    "Reds_and_Blues_Inv": [(-1.0, (0.6, 0.9, 1.0)), (-0.5, (0.0, 0.35, 1.0)), (0.0, (0.0, 0.0, 0.5)),
+                           (0.0, (0.5, 0.0, 0.0)), (0.5, (1.0, 0.0, 0.0)), (1.0, (1.0, 1.0, 0.0))],
+    "Reds_and_Blues": [(-1.0, (1.0, 1.0, 0.0)), (-0.5, (1.0, 0.0, 0.0)), (0.0, (0.5, 0.0, 0.0)),
+                       (0.0, (0.0, 0.0, 0.5)), (0.5, (0.0, 0.35, 1.0)), (1.0, (0.6, 0.9, 1.0))],
+}
+COLORS = {"white": (255, 255, 255), "black": (0, 0, 0)}
+
+DEFAULTS = {
+    "p": 0.05,
+    "pside": "bisided",
+    "func_range": 3.0,
+    "cbar": "Reds_and_Blues_Inv",
+    "opacity": 5,
+    "alpha": True,
+    "boxed": True,
+    "center": [-20.0, -8.0, -16.0],
+    "delta_slices": [6, 15, 10],
+    "montage": [3, 3],
+    "ulay_range": ["0%", "130%"],
+    "clusterize": None,
+    "zerocolor": None,
+    "label": True,
+    "format": "png",
+}
+
+
+@lru_cache(maxsize=4)
+def load_volume(path, brick=0):
+    """
+    Returns (attrs, (nz, ny, nx) volume) of one sub-brick, given by index or label. Only that sub-brick is read, and
+    attrs describe it alone (its statistic is sub-brick 0 of BRICK_STATAUX). Cached per process.
+    """
+    attrs, data = afni_io.load_dataset(f"{afni_io.split_selector(path)[0]}[{brick}]")
+    nx, ny, nz = afni_io.dims(attrs)
+    return attrs, np.asarray(data[0], dtype=np.float32).reshape(nz, ny, nx)
+
+
+def p_to_stat(attrs, index, p, pside):
+    """Converts a p-value into the threshold of sub-brick `index` using its BRICK_STATAUX entry."""
+    stat = afni_io.brick_stats(attrs).get(index)
+    if stat is None:
+        raise ValueError(f"Sub-brick {index} has no statistic parameters; cannot convert p={p} to a threshold")
+    name, params = stat
+    tail = p / 2 if pside == "bisided" else p
+    if name == "fitt":
+        return stats.t.isf(tail, params[0])
+    if name == "fizt":
+        return stats.norm.isf(tail)
+    if name == "fift":
+        return stats.f.isf(p, params[0], params[1])
+    if name == "fict":
+        return stats.chi2.isf(p, params[0])
+    raise ValueError(f"Unsupported statistic '{name}' for p-to-stat conversion")
+
+
+def colorize(values, cbar):
+    """Maps values in [-1, 1] to RGB (0-255) by linear interpolation between the colorbar stops."""
+    stops = CBARS[cbar]
+    rgb = np.zeros(values.shape + (3,))
+    negative = values < 0
+    for side, selected in ((stops[:3], negative), (stops[3:], ~negative)):
+        positions = [s[0] for s in side]
+        for channel in range(3):
+            rgb[selected, channel] = np.interp(values[selected], positions, [s[1][channel] for s in side])
+    return rgb * 255
+
+
+def suprathreshold(thr, threshold, pside):
+    if pside == "bisided":
+        return np.abs(thr) >= threshold
+    if pside == "left":
+        return thr <= -threshold
+    return thr >= threshold
+
+
+def clusterize(olay, mask, nn, min_voxels, pside):
+    """Keeps suprathreshold clusters of at least min_voxels (NN1/2/3 connectivity, signs clustered separately)."""
+    structure = ndimage.generate_binary_structure(3, nn)
+    keep = np.zeros_like(mask)
+    signs = [olay > 0, olay < 0] if pside == "bisided" else [np.ones_like(mask)]
+    for sign in signs:
+        labels, n = ndimage.label(mask & sign, structure)
+        sizes = np.bincount(labels.ravel())
+        large = np.flatnonzero(sizes >= min_voxels)
+        keep |= np.isin(labels, large[large > 0])
+    return keep
+
+
+def ulay_limits(ulay, ulay_range):
+    """Percent values up to 100% are percentiles of the nonzero underlay; above 100% they scale its 98th percentile."""
+    nonzero = ulay[ulay != 0]
+    if not nonzero.size:
+        return 0.0, 1.0
+    limits = []
+    for value in ulay_range:
+        value = str(value)
+        if value.endswith("%"):
+            percent = float(value[:-1])
+            limits.append(np.percentile(nonzero, percent) if percent <= 100
+                          else np.percentile(nonzero, 98) * percent / 100)
+        else:
+            limits.append(float(value))
+    return limits[0], max(limits[1], limits[0] + 1e-6)
+
+
+def world_bounds(attrs, volume):
+    """DICOM bounding box of the nonzero voxels of a volume (used to focus the panels on the brain)."""
+    k, j, i = np.nonzero(volume)
+    if not len(i):
+        k, j, i = [np.array([0, n - 1]) for n in volume.shape]
+    corners = np.array([[i.min(), j.min(), k.min()], [i.max(), j.max(), k.max()]], dtype=float)
+    xyz = np.zeros((2, 3))
+    for axis in range(3):
+        world = attrs["ORIENT_SPECIFIC"][axis] // 2
+        xyz[:, world] = attrs["ORIGIN"][axis] + attrs["DELTA"][axis] * corners[:, axis]
+    return xyz.min(axis=0), xyz.max(axis=0)
+
+
+def sample(attrs, volume, xyz):
+    """Nearest-neighbour sample of a (nz, ny, nx) volume at (N, 3) DICOM coordinates. Outside the grid is 0."""
+    ijk = np.rint(afni_io.xyz_to_ijk(attrs, xyz)).astype(int)
+    nx, ny, nz = afni_io.dims(attrs)
+    inside = (ijk >= 0).all(axis=1) & (ijk < [nx, ny, nz]).all(axis=1)
+    values = np.zeros(len(xyz), dtype=volume.dtype)
+    values[inside] = volume[ijk[inside, 2], ijk[inside, 1], ijk[inside, 0]]
+    return values
+
+
+def slice_grid(view_axis, position, low, high, step):
+    """DICOM coordinates of a display plane, oriented as in the AFNI viewer (radiological, superior/anterior up)."""
+    axes = {"axi": (0, 1), "cor": (0, 2), "sag": (1, 2)}
+    name = next(n for n, a in VIEWS.items() if a == view_axis)
+    col_axis, row_axis = axes[name]
+    cols = np.arange(low[col_axis], high[col_axis] + step, step)
+    rows = np.arange(low[row_axis], high[row_axis] + step, step)
+    if row_axis == 2:
+        rows = rows[::-1]  # superior at the top
+    grid = np.zeros((len(rows), len(cols), 3))
+    grid[..., col_axis] = cols[None, :]
+    grid[..., row_axis] = rows[:, None]
+    grid[..., view_axis] = position
+    return grid.reshape(-1, 3), (len(rows), len(cols))
+
+
+def render_panel(job, scene, view_axis, position):
+    ulay_attrs, ulay, olay_attrs, olay, thr, keep, threshold, (umin, umax), (low, high), step = scene
+    xyz, shape = slice_grid(view_axis, position, low, high, step)
+    u = sample(ulay_attrs, ulay, xyz).reshape(shape)
+    rgb = np.repeat((np.clip((u - umin) / (umax - umin), 0, 1) * 255)[..., None], 3, axis=2)
+    if job["zerocolor"]:
+        rgb[u == 0] = COLORS.get(job["zerocolor"], (255, 255, 255))
+
+    o = sample(olay_attrs, olay, xyz).reshape(shape)
+    t = sample(olay_attrs, thr, xyz).reshape(shape)
+    supra = sample(olay_attrs, keep.astype(np.uint8), xyz).reshape(shape).astype(bool)
+
+    opacity = job["opacity"] / 9
+    if job["alpha"]:
+        # Subthreshold voxels fade in quadratically with |stat| / threshold, as AFNI's alpha mode
+        alpha = np.where(supra, 1.0, np.clip(np.abs(t) / threshold, 0, 1) ** 2) * opacity
+        alpha[o == 0] = 0
+    else:
+        alpha = supra * opacity
+    color = colorize(np.clip(o / job["func_range"], -1, 1), job["cbar"])
+    rgb = rgb * (1 - alpha[..., None]) + color * alpha[..., None]
+
+    if job["boxed"]:
+        edge = supra & ~ndimage.binary_erosion(supra)
+        rgb[edge] = 0
+    return rgb.astype(np.uint8)
+
+
+def montage_image(panels, columns, rows, positions, view_name, label):
+    h, w = panels[0].shape[:2]
+    canvas = Image.new("RGB", (columns * w + columns - 1, rows * h + rows - 1), (0, 0, 0))
+    draw = ImageDraw.Draw(canvas)
+    axis_name = {"axi": "z", "cor": "y", "sag": "x"}[view_name]
+    for n, panel in enumerate(panels):
+        x, y = (n % columns) * (w + 1), (n // columns) * (h + 1)
+        canvas.paste(Image.fromarray(panel), (x, y))
+        if label:
+            draw.text((x + 3, y + 2), f"{axis_name}={positions[n]:g}", fill=(255, 255, 255))
+    return canvas
+
+
+def render(job):
+    """Renders the axial, coronal and sagittal montages of one job. Returns the written file paths."""
+    job = dict(DEFAULTS, **{k: v for k, v in job.items() if v is not None})
+    ulay_attrs, ulay = load_volume(job["ulay"], 0)
+    olay_attrs, olay = load_volume(job["olay"], job["olay_brick"])
+    thr_attrs, thr = load_volume(job["olay"], job["thr_brick"])
+
+    threshold = p_to_stat(thr_attrs, 0, job["p"], job["pside"])
+    keep = suprathreshold(thr, threshold, job["pside"])
+    if job["clusterize"]:
+        nn, min_voxels = job["clusterize"]
+        keep = clusterize(olay, keep, int(nn), int(min_voxels), job["pside"])
+
+    step = float(min(np.abs(ulay_attrs["DELTA"])))
+    bounds = world_bounds(ulay_attrs, ulay)
+    scene = (ulay_attrs, ulay, olay_attrs, olay, thr, keep, threshold, ulay_limits(ulay, job["ulay_range"]), bounds, step)
+
+    columns, rows = job["montage"]
+    n_panels = columns * rows
+    outputs = []
+    os.makedirs(os.path.dirname(os.path.abspath(job["prefix"])), exist_ok=True)
+    for view_name, view_axis in VIEWS.items():
+        spacing = job["delta_slices"][view_axis] * step
+        positions = [job["center"][view_axis] + (n - n_panels // 2) * spacing for n in range(n_panels)]
+        panels = [render_panel(job, scene, view_axis, position) for position in positions]
+        path = f"{job['prefix']}.{view_name}.{job['format']}"
+        montage_image(panels, columns, rows, positions, view_name, job["label"]).save(path)
+        outputs.append(path)
+    return outputs
+
+
+def render_safe(job):
+    try:
+        return render(job)
+    except Exception as e:
+        print(f"Failed to render {job.get('prefix')}: {e}")
+        return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render QC slice montages without the AFNI GUI.")
+    parser.add_argument("--ulay", help="Underlay dataset (e.g. anat_final.<subj>+tlrc or the MNI template).")
+    parser.add_argument("--olay", help="Overlay (stats) dataset.")
+    parser.add_argument("--olay_brick", help="Overlay sub-brick label or index (colors).")
+    parser.add_argument("--thr_brick", help="Threshold sub-brick label or index (statistic).")
+    parser.add_argument("--prefix", "-prefix", help="Output prefix; writes <prefix>.axi/.cor/.sag.<format>.")
+    parser.add_argument("--p", type=float, help="p-value threshold (default 0.05).")
+    parser.add_argument("--pside", choices=["bisided", "left", "right"], help="Sidedness of the threshold (default bisided).")
+    parser.add_argument("--func_range", type=float, help="Overlay value at the ends of the colorbar (default 3).")
+    parser.add_argument("--cbar", choices=list(CBARS), help="Colorbar (default Reds_and_Blues_Inv).")
+    parser.add_argument("--opacity", type=int, help="Overlay opacity, 1-9 (default 5).")
+    parser.add_argument("--no_alpha", dest="alpha", action="store_false", default=None, help="Hide subthreshold voxels instead of fading them.")
+    parser.add_argument("--no_boxed", dest="boxed", action="store_false", default=None, help="Do not outline suprathreshold regions.")
+    parser.add_argument("--center", type=float, nargs=3, help="Montage center in DICOM x y z (default -20 -8 -16).")
+    parser.add_argument("--delta_slices", type=int, nargs=3, help="Underlay slices between panels for sag cor axi (default 6 15 10).")
+    parser.add_argument("--montage", type=int, nargs=2, help="Montage columns and rows (default 3 3).")
+    parser.add_argument("--ulay_range", nargs=2, help="Underlay range, values or percents (default 0%% 130%%).")
+    parser.add_argument("--clusterize", type=int, nargs=2, metavar=("NN", "NVOX"), help="Only show clusters of at least NVOX voxels (NN 1/2/3).")
+    parser.add_argument("--zerocolor", choices=list(COLORS), help="Color of zero-valued underlay voxels.")
+    parser.add_argument("--no_label", dest="label", action="store_false", default=None, help="Do not print slice coordinates.")
+    parser.add_argument("--format", choices=["png", "jpg"], help="Image format (default png).")
+    parser.add_argument("--batch", help="JSON file with a list of jobs (same keys as the options above).")
+    parser.add_argument("--n_procs", type=int, default=os.cpu_count(), help="Processes used for --batch.")
+    args = parser.parse_args()
+
+    if args.batch:
+        with open(args.batch) as f:
+            jobs = json.load(f)
+        # Jobs sharing an underlay/overlay run in the same process to reuse the loaded volumes.
+        jobs.sort(key=lambda j: (j.get("ulay"), j.get("olay")))
+        chunksize = max(1, len(jobs) // (4 * max(1, args.n_procs)))
+        with ProcessPoolExecutor(max_workers=args.n_procs) as executor:
+            results = list(executor.map(render_safe, jobs, chunksize=chunksize))
+        failed = sum(1 for r in results if not r)
+        print(f"Rendered {len(jobs) - failed} of {len(jobs)} montages.")
+        if failed:
+            raise SystemExit(1)
+        return
+
+    job = {k: v for k, v in vars(args).items() if k not in ("batch", "n_procs")}
+    missing = [k for k in ("ulay", "olay", "olay_brick", "thr_brick", "prefix") if not job[k]]
+    if missing:
+        parser.error(f"missing required options: {', '.join('--' + k for k in missing)}")
+    for path in render(job):
+        print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,374 @@
+"""
+Native voxelwise GLM backend.
+
+Fits a first-level model from analysis_models.toml directly in numpy, as an alternative to the afni_proc.py
+regress block. The nuisance design (polort + per-run motion) and censor vector come from the shared baseline
+built by 03a_prepare_glm_baseline.sh, the pb05 datasets are read through memory maps in bounded voxel chunks,
+and the outputs use the same sub-brick labels as 3dDeconvolve (-fout -tout):
+
+    stats.<subject>_<analysis>+tlrc       OLS fit (3dDeconvolve equivalent)
+    stats.<subject>_<analysis>_REML+tlrc  AR(1) prewhitened fit (3dREMLfit equivalent, noise_model = "ar1")
+
+3dREMLfit estimates an ARMA(1,1) noise model per voxel; this backend uses AR(1) with the coefficient
+quantized to a grid so that voxels sharing a coefficient share one whitened design.
+"""
+
+import argparse
+import json
+import os
+import re
+
+import numpy as np
+import toml
+
+import afni_io
+
+DEFAULT_MODELS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "analysis_configs", "analysis_models.toml")
+
+AR1_STEP = 0.02
+AR1_MAX = 0.8
+FINE_DT = 0.01
+
+
+# --- Timing and basis functions ---
+
+def read_stim_times(path):
+    """Reads an AFNI stim times file into one list of (onset, amplitudes) per run."""
+    runs = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            events = []
+            for token in line.split():
+                if token.startswith("*"):
+                    continue
+                token = token.split(":")[0]
+                onset, *amps = re.split(r"[*,]", token)
+                events.append((float(onset), [float(a) for a in amps if a]))
+            runs.append(events)
+    return runs
+
+
+def parse_basis(basis):
+    match = re.match(r"^\s*(\w+)\s*(?:\((.*)\))?\s*$", basis)
+    if not match:
+        raise ValueError(f"Cannot parse basis function '{basis}'")
+    params = [float(p) for p in match.group(2).split(",")] if match.group(2) else []
+    return match.group(1).upper(), params
+
+
+def basis_response(basis):
+    """Returns H(t), the response to one event for a single-regressor AFNI basis (GAM, BLOCK)."""
+    name, params = parse_basis(basis)
+    if name == "GAM":
+        b, c = params[:2] if len(params) >= 2 else (8.6, 0.547)
+        duration = params[2] if len(params) > 2 else 0.0
+        peak = None if duration else 1.0
+
+        def kernel(t):
+            t = np.maximum(t, 0.0)
+            return np.where(t > 0, (t / (b * c)) ** b * np.exp(b - t / c), 0.0)
+        length = b * c * 6 + duration
+    elif name == "BLOCK":
+        if not params:
+            raise ValueError("BLOCK basis requires a duration, e.g. BLOCK(22,1)")
+        duration = params[0]
+        peak = params[1] if len(params) > 1 and params[1] > 0 else None
+
+        def kernel(t):
+            t = np.maximum(t, 0.0)
+            return t ** 4 * np.exp(-t) / (4 ** 4 * np.exp(-4))
+        length = duration + 15.0
+    else:
+        raise ValueError(f"Basis '{basis}' is not supported by the native backend. Use backend = \"afni\".")
+
+    if not duration:
+        return kernel
+
+    # Convolve the kernel with a boxcar of the given duration on a fine grid
+    grid = np.arange(0.0, length + FINE_DT, FINE_DT)
+    cumulative = np.concatenate([[0.0], np.cumsum(kernel(grid[:-1] + FINE_DT / 2) * FINE_DT)])
+    response = cumulative - np.interp(grid - duration, grid, cumulative, left=0.0)
+    if peak is not None:
+        response *= peak / response.max()
+
+    def block(t):
+        return np.interp(t, grid, response, left=0.0, right=0.0)
+    return block
+
+
+def stim_regressor(stim_path, basis, stim_type, run_lengths, tr):
+    """Builds the regressor of one stimulus over all runs (uncensored rows)."""
+    if stim_type == "file":
+        values = np.loadtxt(stim_path, comments="#").ravel()
+        if len(values) != sum(run_lengths):
+            raise ValueError(f"{stim_path}: {len(values)} values for {sum(run_lengths)} time points")
+        return values
+    if stim_type not in ("", "times", "AM1"):
+        raise ValueError(f"stim_types = '{stim_type}' is not supported by the native backend.")
+
+    response = basis_response(basis)
+    runs = read_stim_times(stim_path)
+    columns = []
+    for run, n_time in enumerate(run_lengths):
+        t = np.arange(n_time) * tr
+        column = np.zeros(n_time)
+        for onset, amps in (runs[run] if run < len(runs) else []):
+            amplitude = amps[0] if stim_type == "AM1" and amps else 1.0
+            column += amplitude * response(t - onset)
+        columns.append(column)
+    return np.concatenate(columns)
+
+
+# --- Design ---
+
+def read_xmat(path):
+    matrix = np.loadtxt(path, comments="#", ndmin=2)
+    return matrix
+
+
+def parse_gltsym(sym, labels):
+    """Converts a symbolic GLT such as 'neg_blck - 0.5*neut_blck' into weights over the stim labels."""
+    sym = re.sub(r"^\s*SYM:\s*", "", sym)
+    weights = np.zeros(len(labels))
+    for sign, coef, label in re.findall(r"([+-]?)\s*(\d*\.?\d+\s*\*)?\s*([A-Za-z_][\w.]*)", sym):
+        if label not in labels:
+            raise ValueError(f"GLT '{sym}': unknown stimulus label '{label}'")
+        value = float(coef.rstrip("*").strip()) if coef else 1.0
+        weights[labels.index(label)] += -value if sign == "-" else value
+    return weights
+
+
+def load_baseline(baseline_dir):
+    with open(os.path.join(baseline_dir, "baseline.json")) as f:
+        baseline = json.load(f)
+    baseline["nuisance"] = read_xmat(baseline["nuisance_xmat"])
+    baseline["censor"] = np.loadtxt(baseline["censor_file"], comments="#").ravel() > 0
+    return baseline
+
+
+def build_design(model_config, timing_dir, baseline):
+    """Returns the stimulus columns, their labels and the GLT weights of a model on the shared baseline."""
+    run_lengths, tr = baseline["run_lengths"], baseline["tr"]
+    labels = list(model_config["stim_labels"])
+    stim_type = model_config.get("stim_types", "")
+    stims = np.column_stack([
+        stim_regressor(os.path.join(timing_dir, stim_file), model_config.get("basis", ""), stim_type, run_lengths, tr)
+        for stim_file in model_config["stim_files"]
+    ])
+    glts = [(g["label"], parse_gltsym(g["sym"], labels)) for g in model_config.get("glt", [])]
+    return {"stims": stims, "labels": labels, "glts": glts}
+
+
+def output_labels(design, dof, n_stims):
+    """Sub-brick labels and BRICK_STATAUX in 3dDeconvolve -fout -tout order."""
+    labels = ["Full_Fstat"]
+    stataux = afni_io.stataux_entry(0, "fift", (n_stims, dof))
+    # 3dDeconvolve names the F-stat after the coefficient without its '#0' (e.g. neg-neut_GLT_Fstat for a GLT)
+    coef_names = [f"{label}#0" for label in design["labels"]] + [f"{g}_GLT#0" for g, _ in design["glts"]]
+    for coef_name in coef_names:
+        index = len(labels)
+        labels += [f"{coef_name}_Coef", f"{coef_name}_Tstat", f"{coef_name[:-len('#0')]}_Fstat"]
+        stataux += afni_io.stataux_entry(index + 1, "fitt", (dof,))
+        stataux += afni_io.stataux_entry(index + 2, "fift", (1, dof))
+    return labels, stataux
+
+
+# --- Fitting ---
+# Every model shares the nuisance columns, so the data are projected onto the orthogonal complement of the
+# nuisance space once per chunk and each model only solves for its stimulus columns (Frisch-Waugh-Lovell).
+
+def nuisance_basis(X0):
+    """Orthonormal basis of the nuisance column space (collinear columns dropped)."""
+    U, s, _ = np.linalg.svd(X0, full_matrices=False)
+    return U[:, s > s.max() * max(X0.shape) * np.finfo(float).eps]
+
+
+def residualize(A, Q):
+    return A - Q @ (Q.T @ A)
+
+
+def make_solver(S, Q):
+    """Pseudo-inverse of the stimulus columns S after projecting out the nuisance basis Q."""
+    S = residualize(S, Q)
+    pinv = np.linalg.pinv(S)
+    return {"S": S, "pinv": pinv, "xtxi": pinv @ pinv.T}
+
+
+def fit(Yr, rss0, solver, contrasts, dof):
+    """
+    OLS fit of the nuisance-residualized data Yr (time x voxels), whose sum of squares rss0 is the residual of
+    the nuisance-only model. Returns stats sub-bricks (n_bricks x voxels) in output_labels order and residuals.
+    """
+    B = solver["pinv"] @ Yr
+    residuals = Yr - solver["S"] @ B
+    rss = np.sum(residuals ** 2, axis=0)
+    sigma2 = rss / dof
+    n_stims = solver["S"].shape[1]
+
+    bricks = [np.divide((rss0 - rss) / n_stims, sigma2, out=np.zeros_like(rss), where=sigma2 > 0)]
+    for c in contrasts:
+        coef = c @ B
+        se = np.sqrt(sigma2 * (c @ solver["xtxi"] @ c))
+        t = np.divide(coef, se, out=np.zeros_like(coef), where=se > 0)
+        bricks += [coef, t, t ** 2]
+    return np.array(bricks), residuals
+
+
+def ar1_pairs(censor, run_lengths):
+    """Indices (into uncensored rows) of consecutive uncensored time points within the same run."""
+    run_id = np.repeat(np.arange(len(run_lengths)), run_lengths)
+    rows = np.flatnonzero(censor)
+    consecutive = (np.diff(rows) == 1) & (run_id[rows[1:]] == run_id[rows[:-1]])
+    current = np.flatnonzero(consecutive) + 1
+    return current, current - 1
+
+
+def whiten(A, rho, current, previous):
+    """Prais-Winsten AR(1) transform, restarting at each run start and censoring gap."""
+    out = A * np.sqrt(1 - rho ** 2)
+    out[current] = A[current] - rho * A[previous]
+    return out
+
+
+def estimate_ar1(residuals, current, previous):
+    num = np.sum(residuals[current] * residuals[previous], axis=0)
+    den = np.sum(residuals ** 2, axis=0)
+    rho = np.divide(num, den, out=np.zeros_like(num), where=den > 0)
+    return np.round(np.clip(rho, 0.0, AR1_MAX) / AR1_STEP) * AR1_STEP
+
+
+def read_chunk(data, start, stop):
+    """Concatenates the time series of voxels [start, stop) across runs."""
+    return np.concatenate([np.asarray(run[:, start:stop], dtype=np.float64) for run in data], axis=0)
+
+
+def prepare_model(model, timing_dir, baseline, template, Q):
+    """Builds the design, solver and output datasets of one model."""
+    design = build_design(model["config"], timing_dir, baseline)
+    nuisance, censor = baseline["nuisance"], baseline["censor"]
+    if nuisance.shape[0] != len(censor) or design["stims"].shape[0] != len(censor):
+        raise ValueError(f"{model['subj_id']}: design, nuisance matrix and censor vector have different lengths")
+
+    S = design["stims"][censor]
+    n_stims = S.shape[1]
+    solver = make_solver(S, Q)
+    dof = int(S.shape[0] - Q.shape[1] - np.linalg.matrix_rank(solver["S"]))
+    labels, stataux = output_labels(design, dof, n_stims)
+
+    results_dir, subj_id, noise_model = model["results_dir"], model["subj_id"], model["noise_model"]
+    os.makedirs(results_dir, exist_ok=True)
+    np.savetxt(os.path.join(results_dir, "X.native.xmat.1D"), np.column_stack([nuisance, design["stims"]]), fmt="%.6g",
+               header=" ; ".join([f"nuisance#{i}" for i in range(nuisance.shape[1])] + [f"{l}#0" for l in design["labels"]]))
+    history = f"native_glm.py: {subj_id}, noise_model={noise_model}"
+    ols_path, ols_out = afni_io.create_dataset(os.path.join(results_dir, f"stats.{subj_id}"), template, labels, stataux, history)
+    reml_path, reml_out = None, None
+    if noise_model == "ar1":
+        reml_path, reml_out = afni_io.create_dataset(os.path.join(results_dir, f"stats.{subj_id}_REML"), template, labels, stataux, history)
+
+    return dict(model, S=S, solver=solver, dof=dof, ar1_solvers={},
+                contrasts=list(np.eye(n_stims)) + [w for _, w in design["glts"]],
+                ols_out=ols_out, reml_out=reml_out, paths=[p for p in (ols_path, reml_path) if p])
+
+
+def fit_models(models, timing_dir, baseline, max_memory_mb=1024):
+    """
+    Fits several models of one subject/session in a single pass over its data. Each entry of `models` is a dict
+    with "config" (the analysis_models.toml section), "results_dir", "subj_id" and "noise_model".
+    Returns the written dataset paths of each model.
+    """
+    censor = baseline["censor"]
+    X0 = baseline["nuisance"][censor]
+    Q = nuisance_basis(X0)
+    current, previous = ar1_pairs(censor, baseline["run_lengths"])
+    whitened_bases = {}
+
+    runs = [afni_io.load_dataset(dset) for dset in baseline["dsets"]]
+    template, data = runs[0][0], [d for _, d in runs]
+    n_vox = data[0].shape[1]
+    models = [prepare_model(model, timing_dir, baseline, template, Q) for model in models]
+
+    chunk_size = max(1000, int(max_memory_mb * 2 ** 20 / (len(censor) * 8 * (4 + 2 * len(models)))))
+    n_chunks = (n_vox + chunk_size - 1) // chunk_size
+    for n, start in enumerate(range(0, n_vox, chunk_size)):
+        stop = min(start + chunk_size, n_vox)
+        Y = read_chunk(data, start, stop)
+        active = np.flatnonzero(np.any(Y != 0, axis=0))
+        if not len(active):
+            continue
+        Yg = Y[censor][:, active]
+        Yr = residualize(Yg, Q)
+        rss0 = np.sum(Yr ** 2, axis=0)
+
+        for model in models:
+            bricks, residuals = fit(Yr, rss0, model["solver"], model["contrasts"], model["dof"])
+            model["ols_out"][:, start + active] = bricks
+            if model["reml_out"] is None:
+                continue
+
+            rho = estimate_ar1(residuals, current, previous)
+            reml_bricks = np.zeros_like(bricks)
+            for value in np.unique(rho):
+                if value not in whitened_bases:
+                    whitened_bases[value] = nuisance_basis(whiten(X0, value, current, previous))
+                Qw = whitened_bases[value]
+                if value not in model["ar1_solvers"]:
+                    model["ar1_solvers"][value] = make_solver(whiten(model["S"], value, current, previous), Qw)
+                selected = rho == value
+                Yw = residualize(whiten(Yg[:, selected], value, current, previous), Qw)
+                reml_bricks[:, selected], _ = fit(Yw, np.sum(Yw ** 2, axis=0), model["ar1_solvers"][value],
+                                                  model["contrasts"], model["dof"])
+            model["reml_out"][:, start + active] = reml_bricks
+        print(f"  Chunk {n + 1}/{n_chunks}: {len(active)} voxels, {len(models)} model(s)")
+
+    for model in models:
+        model["ols_out"].flush()
+        if model["reml_out"] is not None:
+            model["reml_out"].flush()
+    return [model["paths"] for model in models]
+
+
+def fit_model(model_config, timing_dir, baseline, results_dir, subj_id, noise_model="ar1", max_memory_mb=1024):
+    model = {"config": model_config, "results_dir": results_dir, "subj_id": subj_id, "noise_model": noise_model}
+    return fit_models([model], timing_dir, baseline, max_memory_mb)[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Native chunked voxelwise GLM for one subject/session and one or more analysis models.")
+    parser.add_argument("--subject", required=True, help="Subject ID (e.g. sub-MD21).")
+    parser.add_argument("--session", required=True, help="Session number.")
+    parser.add_argument("--input", required=True, help="BIDS input directory (timing files live in <subject>/ses-N/func).")
+    parser.add_argument("--output", required=True, help="Derivatives output directory.")
+    parser.add_argument("--analysis", required=True, nargs="+", help="Analysis model name(s) in analysis_models.toml. All are fitted in one pass over the data.")
+    parser.add_argument("--baseline", required=True, help="Shared baseline directory built by 03a_prepare_glm_baseline.sh.")
+    parser.add_argument("--models_config", default=DEFAULT_MODELS, help="Path to analysis_models.toml.")
+    parser.add_argument("--noise_model", choices=["ols", "ar1"], help="Overrides the models' noise_model setting.")
+    parser.add_argument("--max_memory_mb", type=int, default=1024, help="Approximate memory budget for one voxel chunk.")
+    args = parser.parse_args()
+
+    analysis_models = toml.load(args.models_config)
+    session_prefix = f"ses-{args.session}"
+    timing_dir = os.path.join(args.input, args.subject, session_prefix, "func")
+
+    models = []
+    for analysis in args.analysis:
+        model_config = analysis_models[analysis]
+        subj_id = f"{args.subject}_{analysis}"
+        models.append({
+            "config": model_config,
+            "subj_id": subj_id,
+            "noise_model": args.noise_model or model_config.get("noise_model", "ar1"),
+            "results_dir": os.path.join(args.output, args.subject, session_prefix, "glm", analysis, f"{subj_id}.results"),
+        })
+        print(f"Native GLM: {subj_id} ({session_prefix}), noise model: {models[-1]['noise_model']}")
+
+    baseline = load_baseline(args.baseline)
+    for paths in fit_models(models, timing_dir, baseline, args.max_memory_mb):
+        for path in paths:
+            print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    main()
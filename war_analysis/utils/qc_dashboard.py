@@ -0,0 +1,189 @@
+"""
+Static HTML QC dashboard of the whole cohort.
+
+<output_dir>/qc_dashboard/index.html shows every subject/session of output_dir on one page, without rendering any
+PDF: the afni_proc QC reports (preprocessing and every GLM) are linked as they are, with the first thumbnails of
+their media, and the anatomical warp and GLM results images are shown as thumbnails linking to the full-size
+images. Thumbnails are small JPEG derivatives (report_images.py, cached by source hash) that the browser loads
+lazily, so the page opens in seconds for the whole cohort.
+
+The layout of every session (the QC pages and images found, with their size/mtime signatures and thumbnails) is kept
+in qc_dashboard/layout.json. A rebuild only rescans the file listings; thumbnails are made for new or changed
+sessions only, then the page is rewritten from the layout:
+
+    python qc_dashboard.py --output <output_dir> --config analysis_configs/main_config.toml
+"""
+
+import argparse
+import glob
+import html
+import json
+import os
+import uuid
+
+import derivatives_catalog
+import report_images
+
+DASHBOARD_DIR = "qc_dashboard"
+LAYOUT_VERSION = 1
+THUMB_WIDTH = 320
+# afni_proc QC pages have dozens of images; the dashboard previews the first few and links the page for the rest.
+PAGE_THUMBS = 6
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+STYLE = """
+body { font-family: sans-serif; margin: 1em 2em; color: #222; }
+h1, h2 { color: #223668; }
+h2 { border-bottom: 1px solid #ccc; padding-top: 0.5em; }
+h3 { margin: 0.8em 0 0.3em; font-size: 1em; }
+nav a { margin-right: 0.6em; }
+.thumbs img { height: 120px; margin: 2px; border: 1px solid #ddd; }
+.group { color: #666; font-weight: normal; }
+"""
+
+
+def images_in(folder):
+    return sorted(path for path in glob.glob(os.path.join(folder, "*")) if path.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def session_sections(session_folder, subject):
+    """(title, QC page or None, images, number of images not previewed) of every QC output of a session."""
+    sections = []
+
+    def add(title, page, images, preview=None):
+        page = page if page and os.path.exists(page) else None
+        if page or images:
+            shown = images[:preview] if preview else images
+            sections.append((title, page, shown, len(images) - len(shown)))
+
+    preproc_qc = os.path.join(session_folder, "func_preproc", f"{subject}_preproc.results", f"QC_{subject}_preproc")
+    add("Preprocessing QC", os.path.join(preproc_qc, "index.html"), images_in(os.path.join(preproc_qc, "media")), PAGE_THUMBS)
+    add("Anatomical QC", None, images_in(os.path.join(session_folder, "anat_warped")))
+    glm_folder = os.path.join(session_folder, "glm")
+    for analysis in sorted(os.listdir(glm_folder)) if os.path.isdir(glm_folder) else []:
+        analysis_folder = os.path.join(glm_folder, analysis)
+        glm_qc = os.path.join(analysis_folder, f"{subject}_{analysis}.results", f"QC_{subject}_{analysis}")
+        add(f"{analysis} QC", os.path.join(glm_qc, "index.html"), images_in(os.path.join(glm_qc, "media")), PAGE_THUMBS)
+        add(f"{analysis} results", None, images_in(os.path.join(analysis_folder, "QC")))
+    return sections
+
+
+def sections_signature(sections, output_dir):
+    files = [path for _, page, images, _ in sections for path in ([page] if page else []) + images]
+    return [[os.path.relpath(path, output_dir), derivatives_catalog.file_signature(path)] for path in files]
+
+
+def layout_session(sections, dashboard_dir, n_threads):
+    """Layout entries of a session's sections: links relative to the dashboard, with the thumbnail of every image."""
+    images = [path for _, _, section_images, _ in sections for path in section_images]
+    thumbs = report_images.prepare(images, os.path.join(dashboard_dir, "thumbs"), n_threads, THUMB_WIDTH)
+    entries = []
+    for title, page, section_images, n_more in sections:
+        entries.append({
+            "title": title,
+            "page": os.path.relpath(page, dashboard_dir) if page else None,
+            "images": [[os.path.relpath(path, dashboard_dir), os.path.relpath(thumbs[path][0], dashboard_dir)]
+                       for path in section_images if path in thumbs],
+            "more": n_more,
+        })
+    return entries
+
+
+def update_layout(output_dir, groups=None, n_threads=4):
+    """Rescans the sessions of output_dir, making thumbnails for new or changed ones. Returns (layout, n_updated)."""
+    dashboard_dir = os.path.join(output_dir, DASHBOARD_DIR)
+    layout_path = os.path.join(dashboard_dir, "layout.json")
+    layout = {"version": LAYOUT_VERSION, "sessions": {}}
+    if os.path.exists(layout_path):
+        with open(layout_path) as f:
+            layout = json.load(f)
+        if layout.get("version") != LAYOUT_VERSION:
+            layout = {"version": LAYOUT_VERSION, "sessions": {}}
+
+    sessions = {}
+    n_updated = 0
+    for session_folder in sorted(glob.glob(os.path.join(output_dir, "sub-*", "ses-*"))):
+        if not os.path.isdir(session_folder):
+            continue
+        subject, session = session_folder.split(os.sep)[-2:]
+        key = f"{subject}/{session}"
+        sections = session_sections(session_folder, subject)
+        if not sections:
+            continue
+        signature = sections_signature(sections, output_dir)
+        entry = layout["sessions"].get(key)
+        if entry is None or entry["signature"] != signature:
+            entry = {"subject": subject, "session": session, "signature": signature,
+                     "sections": layout_session(sections, dashboard_dir, n_threads)}
+            n_updated += 1
+        entry["group"] = (groups or {}).get(subject, entry.get("group", "NA"))
+        sessions[key] = entry
+    layout["sessions"] = sessions
+
+    os.makedirs(dashboard_dir, exist_ok=True)
+    tmp_path = f"{layout_path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(layout, f, indent=1)
+    os.replace(tmp_path, layout_path)
+    return layout, n_updated
+
+
+def render(layout):
+    """The dashboard page of a layout."""
+    sessions = list(layout["sessions"].values())
+    subjects = sorted({entry["subject"] for entry in sessions})
+    lines = ["<!DOCTYPE html>", "<html><head><meta charset=\"utf-8\"><title>QC dashboard</title>",
+             f"<style>{STYLE}</style></head><body>", "<h1>QC dashboard</h1>",
+             f"<p>{len(sessions)} sessions of {len(subjects)} subjects.</p>", "<nav>"]
+    for entry in sessions:
+        anchor = html.escape(f"{entry['subject']}_{entry['session']}")
+        lines.append(f"<a href=\"#{anchor}\">{html.escape(entry['subject'])} {html.escape(entry['session'])}</a>")
+    lines.append("</nav>")
+
+    for entry in sessions:
+        anchor = html.escape(f"{entry['subject']}_{entry['session']}")
+        lines.append(f"<section id=\"{anchor}\"><h2>{html.escape(entry['subject'])} &middot; {html.escape(entry['session'])}"
+                     f" <span class=\"group\">{html.escape(entry['group'])}</span></h2>")
+        for section in entry["sections"]:
+            title = html.escape(section["title"])
+            if section["page"]:
+                title += f" &ndash; <a href=\"{html.escape(section['page'])}\">QC page</a>"
+            lines.append(f"<h3>{title}</h3><div class=\"thumbs\">")
+            for image, thumb in section["images"]:
+                lines.append(f"<a href=\"{html.escape(image)}\"><img src=\"{html.escape(thumb)}\" loading=\"lazy\" "
+                             f"alt=\"{html.escape(os.path.basename(image))}\"></a>")
+            if section["more"]:
+                lines.append(f"<span>+{section['more']} more</span>")
+            lines.append("</div>")
+        lines.append("</section>")
+    lines.append("</body></html>")
+    return "\n".join(lines) + "\n"
+
+
+def build(output_dir, groups=None, n_threads=4):
+    """Updates the layout and rewrites the dashboard page. Returns (page path, sessions, sessions updated)."""
+    layout, n_updated = update_layout(output_dir, groups, n_threads)
+    page_path = os.path.join(output_dir, DASHBOARD_DIR, "index.html")
+    tmp_path = f"{page_path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(render(layout))
+    os.replace(tmp_path, page_path)
+    return page_path, len(layout["sessions"]), n_updated
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the static HTML QC dashboard of all subjects and sessions.")
+    parser.add_argument("--output", required=True, help="Pipeline output_dir.")
+    parser.add_argument("--config", help="main_config.toml, to show each subject's group.")
+    parser.add_argument("--n_threads", type=int, default=4, help="Thumbnails made in parallel.")
+    args = parser.parse_args()
+
+    groups = None
+    if args.config:
+        import toml
+        groups = {s["id"]: s.get("group", "NA") for s in toml.load(args.config).get("subjects", [])}
+    page_path, n_sessions, n_updated = build(args.output, groups, args.n_threads)
+    print(f"Updated {n_updated} of {n_sessions} sessions. Dashboard: {page_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Low-priority queue for QC image rendering.
+
+The GLM and group scripts enqueue their @chauffeur_afni calls (scripts/utils_qc.sh, --qc queue) instead of running
+them inline, so the compute slot is released as soon as the model fit finishes. A worker renders the queue in
+parallel at low CPU priority. Rendered images are cached by the content hash of the input datasets plus the
+render command, so re-running a step whose stats did not change only copies the cached images.
+
+The queue is a directory of JSON job files:
+
+    <queue>/pending/   jobs waiting to run
+    <queue>/running/   jobs claimed by a worker (claimed by an atomic rename)
+    <queue>/done/      finished jobs (with "cached": true when served from the cache)
+    <queue>/failed/    failed jobs, with the log in <queue>/logs/<id>.log
+    <queue>/cache/     rendered images by cache key
+
+    python qc_queue.py enqueue --queue <dir> --prefix QC/neg_blck --inputs stats+tlrc anat+tlrc -- @chauffeur_afni ...
+    python qc_queue.py worker --queue <dir> --width 4
+    python qc_queue.py status --queue <dir>
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+STATES = ["pending", "running", "done", "failed"]
+CLOSED_MARKER = "closed"
+
+_hash_lock = threading.Lock()
+_hash_memo = {}
+
+
+def queue_dirs(queue_dir):
+    dirs = {state: os.path.join(queue_dir, state) for state in STATES + ["cache", "logs"]}
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    return dirs
+
+
+def dataset_files(path):
+    """The files holding an AFNI (HEAD/BRIK[.gz]) or NIfTI dataset. Sub-brick selectors are ignored."""
+    path = path.split("[")[0]
+    if path.endswith(".nii") or path.endswith(".nii.gz"):
+        return [path]
+    base = path[:-5] if path.endswith(".HEAD") or path.endswith(".BRIK") else path.rstrip(".")
+    return [p for p in (base + ".HEAD", base + ".BRIK", base + ".BRIK.gz") if os.path.exists(p)]
+
+
+def file_hash(path):
+    """SHA-256 of a file, memoized on (path, size, mtime) for the lifetime of the worker."""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with _hash_lock:
+        if key in _hash_memo:
+            return _hash_memo[key]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    with _hash_lock:
+        _hash_memo[key] = digest.hexdigest()
+    return _hash_memo[key]
+
+
+def cache_key(job):
+    digest = hashlib.sha256(json.dumps(job["command"]).encode())
+    for path in job["inputs"]:
+        for f in dataset_files(path):
+            digest.update(file_hash(f).encode())
+    return digest.hexdigest()[:32]
+
+
+def enqueue(queue_dir, prefix, inputs, command, cwd=None):
+    dirs = queue_dirs(queue_dir)
+    cwd = os.path.abspath(cwd or os.getcwd())
+    job = {
+        "id": f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}",
+        "cwd": cwd,
+        "prefix": os.path.join(cwd, prefix),
+        "inputs": [os.path.join(cwd, path) for path in inputs],
+        "command": command,
+        "created": time.time(),
+    }
+    # Write then rename, so a worker never reads a partial job file.
+    tmp_path = os.path.join(dirs["pending"], f".{job['id']}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(job, f, indent=2)
+    os.rename(tmp_path, os.path.join(dirs["pending"], f"{job['id']}.json"))
+    return job["id"]
+
+
+def claim(dirs):
+    """Moves the oldest pending job to running/ and returns it, or None when the queue is empty."""
+    for name in sorted(os.listdir(dirs["pending"])):
+        if not name.endswith(".json"):
+            continue
+        running_path = os.path.join(dirs["running"], name)
+        try:
+            os.rename(os.path.join(dirs["pending"], name), running_path)
+        except FileNotFoundError:
+            continue  # Claimed by another worker
+        with open(running_path) as f:
+            return json.load(f)
+    return None
+
+
+def finish(dirs, job, state, **fields):
+    job.update(fields, finished=time.time())
+    with open(os.path.join(dirs[state], f"{job['id']}.json"), "w") as f:
+        json.dump(job, f, indent=2)
+    os.remove(os.path.join(dirs["running"], f"{job['id']}.json"))
+
+
+def render(dirs, job, niceness):
+    key = cache_key(job)
+    cache_dir = os.path.join(dirs["cache"], key)
+    out_dir, stem = os.path.split(job["prefix"])
+    os.makedirs(out_dir, exist_ok=True)
+
+    if os.path.isdir(cache_dir):
+        for cached in os.listdir(cache_dir):
+            shutil.copy2(os.path.join(cache_dir, cached), os.path.join(out_dir, stem + cached))
+        finish(dirs, job, "done", cached=True, key=key)
+        return "cached"
+
+    log_path = os.path.join(dirs["logs"], f"{job['id']}.log")
+    # nice(1) lowers the priority in the child; preexec_fn is not safe in the worker's threads.
+    with open(log_path, "w") as log_file:
+        result = subprocess.run(["nice", "-n", str(niceness)] + job["command"] + ["-prefix", job["prefix"]],
+                                cwd=job["cwd"], stdout=log_file, stderr=subprocess.STDOUT)
+    outputs = glob.glob(glob.escape(job["prefix"]) + ".*")
+    if result.returncode != 0 or not outputs:
+        finish(dirs, job, "failed", returncode=result.returncode, log=log_path)
+        return "failed"
+
+    tmp_dir = cache_dir + f".{uuid.uuid4().hex[:8]}.tmp"
+    os.makedirs(tmp_dir)
+    for output in outputs:
+        shutil.copy2(output, os.path.join(tmp_dir, output[len(job["prefix"]):]))
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir)  # Same key rendered concurrently
+    finish(dirs, job, "done", cached=False, key=key)
+    return "rendered"
+
+
+def worker(queue_dir, width=2, niceness=10, until_closed=False, poll=2.0):
+    """
+    Renders jobs with `width` parallel renderers. Exits once the queue is empty, or with until_closed, once the
+    queue is empty and close_queue() was called (used by run_analysis.py to render while the pipeline runs).
+    """
+    dirs = queue_dirs(queue_dir)
+    counts = {"rendered": 0, "cached": 0, "failed": 0}
+    lock = threading.Lock()
+
+    def loop():
+        while True:
+            job = claim(dirs)
+            if job is None:
+                if until_closed and not os.path.exists(os.path.join(queue_dir, CLOSED_MARKER)):
+                    time.sleep(poll)
+                    continue
+                return
+            try:
+                outcome = render(dirs, job, niceness)
+            except Exception as e:
+                finish(dirs, job, "failed", error=str(e))
+                outcome = "failed"
+            with lock:
+                counts[outcome] += 1
+            print(f"[qc] {outcome}: {os.path.relpath(job['prefix'], job['cwd'])}", flush=True)
+
+    with ThreadPoolExecutor(max_workers=width) as executor:
+        for future in [executor.submit(loop) for _ in range(width)]:
+            future.result()
+    return counts
+
+
+def open_queue(queue_dir):
+    queue_dirs(queue_dir)
+    marker = os.path.join(queue_dir, CLOSED_MARKER)
+    if os.path.exists(marker):
+        os.remove(marker)
+
+
+def close_queue(queue_dir):
+    """Tells an until_closed worker to exit once the remaining jobs are rendered."""
+    with open(os.path.join(queue_dir, CLOSED_MARKER), "w") as f:
+        f.write(str(time.time()))
+
+
+def status(queue_dir):
+    dirs = queue_dirs(queue_dir)
+    return {state: len([n for n in os.listdir(dirs[state]) if n.endswith(".json")]) for state in STATES}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Low-priority QC rendering queue.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="Add a render job. The command follows '--', without -prefix.")
+    enqueue_parser.add_argument("--queue", required=True, help="Queue directory.")
+    enqueue_parser.add_argument("--prefix", required=True, help="Output prefix passed to the renderer as -prefix.")
+    enqueue_parser.add_argument("--inputs", nargs="+", required=True, help="Datasets whose content keys the cache.")
+    enqueue_parser.add_argument("render_command", nargs=argparse.REMAINDER, help="Render command, after '--'.")
+
+    worker_parser = subparsers.add_parser("worker", help="Render queued jobs.")
+    worker_parser.add_argument("--queue", required=True, help="Queue directory.")
+    worker_parser.add_argument("--width", type=int, default=2, help="Number of jobs rendered in parallel.")
+    worker_parser.add_argument("--nice", type=int, default=10, help="Niceness increment of the render processes.")
+    worker_parser.add_argument("--until_closed", action="store_true", help="Keep polling until the queue is closed.")
+
+    for name, help_text in [("status", "Show job counts."), ("close", "Let an --until_closed worker exit when idle."),
+                            ("retry", "Move failed jobs back to pending.")]:
+        subparsers.add_parser(name, help=help_text).add_argument("--queue", required=True, help="Queue directory.")
+    args = parser.parse_args()
+
+    if args.command == "enqueue":
+        command = args.render_command[1:] if args.render_command[:1] == ["--"] else args.render_command
+        if not command:
+            parser.error("enqueue needs a render command after '--'")
+        print(f"Queued QC job {enqueue(args.queue, args.prefix, args.inputs, command)}")
+    elif args.command == "worker":
+        counts = worker(args.queue, args.width, args.nice, args.until_closed)
+        print(f"QC queue drained: {counts['rendered']} rendered, {counts['cached']} from cache, {counts['failed']} failed.")
+    elif args.command == "status":
+        print(", ".join(f"{state}: {n}" for state, n in status(args.queue).items()))
+    elif args.command == "close":
+        close_queue(args.queue)
+    elif args.command == "retry":
+        dirs = queue_dirs(args.queue)
+        for name in os.listdir(dirs["failed"]):
+            os.rename(os.path.join(dirs["failed"], name), os.path.join(dirs["pending"], name))
+
+
+if __name__ == "__main__":
+    main()
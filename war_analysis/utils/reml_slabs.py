@@ -0,0 +1,143 @@
+"""
+Slab-parallel 3dREMLfit.
+
+Splits the input datasets into N contiguous z slabs (balanced by the number of mask voxels per slab), runs
+3dREMLfit on every slab concurrently within a core budget (OMP threads per process = cores // slabs), and merges
+each output back into one dataset with the geometry of the inputs and the sub-brick labels/statistics of the
+3dREMLfit output:
+
+    python reml_slabs.py --matrix X.xmat.1D --input pb05.r01+tlrc pb05.r02+tlrc \\
+        --Rbuck stats.sub-MD21_by_block_REML --Rvar stats.sub-MD21_by_block_REMLvar --slabs 4 --cores 16 -- -fout -tout
+
+Each voxel's REML fit only depends on its own time series, so the merged result equals a whole-brain run.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import afni_io
+
+OUTPUT_OPTIONS = ["Rbuck", "Rvar", "Rfitts", "Rerrts", "Rwherr", "Obuck", "Ofitts", "Oerrts"]
+
+# Per-slab attributes that AFNI recomputes on load. Geometry attributes are taken from the original input.
+DROPPED_ATTRIBUTES = ["BRICK_STATS", "IDCODE_ANAT_PARENT", "IDCODE_WARP_PARENT"]
+
+
+def slab_bounds(weights, n_slabs):
+    """Splits z slices into n_slabs contiguous [z0, z1] ranges with roughly equal total weight."""
+    nz = len(weights)
+    n_slabs = max(1, min(n_slabs, nz))
+    cumulative = np.cumsum(weights, dtype=float)
+    if cumulative[-1] <= 0:
+        cumulative = np.arange(1, nz + 1, dtype=float)
+    cuts = np.searchsorted(cumulative, cumulative[-1] * np.arange(1, n_slabs) / n_slabs)
+    edges = np.unique(np.concatenate([[0], np.clip(cuts + 1, 1, nz - 1), [nz]]))
+    return [(int(z0), int(z1) - 1) for z0, z1 in zip(edges[:-1], edges[1:])]
+
+
+def voxels_per_slice(path, mask=None):
+    """Mask voxels (or nonzero voxels in the first volume) per z slice."""
+    attrs, data = afni_io.load_dataset(mask or path)
+    nx, ny, nz = afni_io.dims(attrs)
+    return (np.asarray(data[0]) != 0).reshape(nz, ny * nx).sum(axis=1)
+
+
+def run(cmd, cwd, threads=1):
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads))
+    result = subprocess.run(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(cmd)} failed:\n{result.stdout[-2000:]}")
+    return result.stdout
+
+
+def cut_slab(path, z0, z1, prefix, work_dir):
+    run(["3dZcutup", "-keep", str(z0), str(z1), "-prefix", prefix, os.path.abspath(path)], work_dir)
+    return afni_io.output_path(os.path.join(work_dir, prefix), afni_io.read_head(path))
+
+
+def fit_slab(k, z0, z1, args, work_dir, threads):
+    """Cuts the inputs (and mask) to one slab and runs 3dREMLfit on it."""
+    inputs = [cut_slab(path, z0, z1, f"slab{k}.in{n}", work_dir) for n, path in enumerate(args.input)]
+    cmd = ["3dREMLfit", "-matrix", os.path.abspath(args.matrix), "-input", " ".join(inputs)]
+    if args.mask:
+        cmd += ["-mask", cut_slab(args.mask, z0, z1, f"slab{k}.mask", work_dir)]
+    for option in OUTPUT_OPTIONS:
+        if getattr(args, option):
+            cmd += [f"-{option}", f"slab{k}.{option}"]
+    cmd += args.reml_args
+    print(f"  Slab {k} (z {z0}-{z1}): 3dREMLfit with {threads} thread(s)")
+    run(cmd, work_dir, threads)
+    return k
+
+
+def merge_slabs(slab_prefixes, prefix, input_attrs):
+    """Concatenates slab outputs along z into one float32 dataset with the geometry of the original inputs."""
+    attrs = afni_io.read_head(slab_prefixes[0])
+    for name in DROPPED_ATTRIBUTES:
+        attrs.pop(name, None)
+    attrs.update({name: input_attrs[name] for name in afni_io.GEOMETRY_ATTRIBUTES if name in input_attrs})
+    nvals = afni_io.n_bricks(attrs)
+    attrs.update({"BRICK_TYPES": [3] * nvals, "BRICK_FLOAT_FACS": [0.0] * nvals})
+    attrs.update(afni_io.new_idcode())
+    if "HISTORY_NOTE" in attrs:
+        attrs["HISTORY_NOTE"] += f"\\n[reml_slabs.py] merged {len(slab_prefixes)} z slabs"
+
+    path = afni_io.output_path(prefix, input_attrs)
+    afni_io.write_attributes(path, attrs)
+    _, brik_path = afni_io.dataset_paths(path)
+    out = np.memmap(brik_path, dtype=np.float32, mode="w+", shape=(nvals, afni_io.n_voxels(input_attrs)))
+    start = 0
+    for slab in slab_prefixes:
+        _, data = afni_io.load_dataset(slab)
+        out[:, start:start + data.shape[1]] = data
+        start += data.shape[1]
+    if start != out.shape[1]:
+        raise ValueError(f"Merged {start} voxels into a dataset of {out.shape[1]}")
+    out.flush()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run 3dREMLfit on z slabs in parallel and merge the outputs.")
+    parser.add_argument("--matrix", required=True, help="Design matrix (X.xmat.1D) from 3dDeconvolve.")
+    parser.add_argument("--input", required=True, nargs="+", help="Input datasets (one per run).")
+    parser.add_argument("--mask", help="Optional mask. Slabs are balanced by mask voxels.")
+    for option in OUTPUT_OPTIONS:
+        parser.add_argument(f"--{option}", help=f"Prefix of the merged -{option} output.")
+    parser.add_argument("--slabs", type=int, default=4, help="Number of z slabs.")
+    parser.add_argument("--cores", type=int, default=os.cpu_count(), help="Total cores available to all slabs.")
+    parser.add_argument("--work_dir", help="Scratch directory. Defaults to a temporary directory next to the outputs.")
+    parser.add_argument("reml_args", nargs="*", help="Extra 3dREMLfit options, after '--' (e.g. -- -fout -tout -verb).")
+    args = parser.parse_args()
+
+    input_attrs = afni_io.read_head(args.input[0])
+    bounds = slab_bounds(voxels_per_slice(args.input[0], args.mask), args.slabs)
+    workers = max(1, min(len(bounds), args.cores))
+    threads = max(1, args.cores // workers)
+    print(f"3dREMLfit on {len(bounds)} slabs, {workers} at a time with {threads} thread(s) each")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="reml_slabs_", dir=os.getcwd())
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda b: fit_slab(b[0], *b[1], args, work_dir, threads), enumerate(bounds)))
+
+        view = afni_io.view(input_attrs)
+        for option in OUTPUT_OPTIONS:
+            prefix = getattr(args, option)
+            if prefix:
+                slabs = [os.path.join(work_dir, f"slab{k}.{option}+{view}") for k in range(len(bounds))]
+                print(f"Wrote {merge_slabs(slabs, prefix, input_attrs)}")
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
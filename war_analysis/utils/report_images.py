@@ -0,0 +1,91 @@
+"""
+Print-resolution JPEG derivatives of the QC images embedded in the exported PDF reports.
+
+Report images are laid out at most CONTENT_WIDTH_MM wide, so every image is downscaled to PRINT_DPI at that width
+and re-encoded as JPEG before fpdf embeds it, instead of embedding the full-resolution screenshots. Derivatives are
+cached in <cache_dir>/<hash>.jpg by the SHA-256 of the source bytes (and the derivative settings), so images that did
+not change since the last export, or that several reports share, are converted once. Layout sizes are read from the
+image headers only, and the images of a report are prepared in a thread pool:
+
+    python report_images.py --cache_dir <output_dir>/_export_cache/images QC/*.jpg
+"""
+
+import argparse
+import hashlib
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+CONTENT_WIDTH_MM = 190
+PRINT_DPI = 200
+JPEG_QUALITY = 85
+MAX_WIDTH = round(CONTENT_WIDTH_MM / 25.4 * PRINT_DPI)
+# Report folders also hold volumes and warps (anat_warped); only these are treated as images.
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+
+
+def image_size(path):
+    """(width, height) of an image; PIL reads the header on open and only decodes the pixels on load."""
+    with Image.open(path) as img:
+        return img.size
+
+
+def source_hash(path, max_width=MAX_WIDTH):
+    digest = hashlib.sha256(f"{max_width} {JPEG_QUALITY}".encode())
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:24]
+
+
+def derivative(path, cache_dir, max_width=MAX_WIDTH):
+    """Returns (derivative path, (width, height)) of one image at most max_width wide, converting it on a cache miss."""
+    cached = os.path.join(cache_dir, f"{source_hash(path, max_width)}.jpg")
+    if not os.path.exists(cached):
+        with Image.open(path) as img:
+            if img.mode in ("RGBA", "LA", "P"):
+                # JPEG has no alpha: transparent areas go on white, as in the PDF page
+                img = img.convert("RGBA")
+                flattened = Image.new("RGB", img.size, (255, 255, 255))
+                flattened.paste(img, mask=img.getchannel("A"))
+                img = flattened
+            else:
+                img = img.convert("RGB")
+            if img.width > max_width:
+                img = img.resize((max_width, max(1, round(img.height * max_width / img.width))), Image.LANCZOS)
+            # Written then renamed, so concurrent exports never embed a partial derivative.
+            tmp_path = f"{cached}.{uuid.uuid4().hex[:8]}.tmp"
+            img.save(tmp_path, "JPEG", quality=JPEG_QUALITY, optimize=True)
+        os.replace(tmp_path, cached)
+    return cached, image_size(cached)
+
+
+def prepare(paths, cache_dir, n_threads=4, max_width=MAX_WIDTH):
+    """{source path: (derivative path, (width, height))} of the images; images that cannot be read are left out."""
+    os.makedirs(cache_dir, exist_ok=True)
+    prepared = {}
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = {path: executor.submit(derivative, path, cache_dir, max_width) for path in paths}
+        for path, future in futures.items():
+            try:
+                prepared[path] = future.result()
+            except Exception as e:
+                print(f"  -> Failed to prepare image {path}. Error: {e}")
+    return prepared
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the cached print-resolution derivatives of report images.")
+    parser.add_argument("--cache_dir", required=True, help="Directory of cached derivatives.")
+    parser.add_argument("--n_threads", type=int, default=4, help="Images converted in parallel.")
+    parser.add_argument("images", nargs="+", help="Source images.")
+    args = parser.parse_args()
+
+    for path, (cached, (width, height)) in prepare(args.images, args.cache_dir, args.n_threads).items():
+        print(f"{path} -> {cached} ({width}x{height})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Atlas ROI extraction across the cohort.
+
+For every cataloged stats dataset of an analysis, computes the mean, median and voxel counts of every atlas label
+for every requested contrast, in one vectorized pass per dataset (bincount over the labels, medians from one
+lexsort), with datasets processed in parallel. The atlas is an integer label volume in MNI space (NIfTI or AFNI);
+when its grid differs from the stats grid it is resampled to it (nearest neighbour, by DICOM coordinates).
+
+Results go to one tidy table, <output_dir>/roi/<atlas>_<analysis>.tsv. Re-running only processes new or changed
+datasets (by HEAD size/mtime) and drops rows of deleted ones:
+
+    python roi_extract.py --output <output_dir> --analysis by_block --atlas atlases/amygdala_insula.nii.gz \\
+        --label_names atlases/amygdala_insula.tsv --contrast 'neg_blck#0_Coef' 'neg-neut_blck_GLT#0_Coef'
+
+Voxels where a dataset is 0 (outside the subject's mask) are counted in n_voxels but excluded from n_data, mean and
+median.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+
+import numpy as np
+import pandas as pd
+
+import afni_io
+import derivatives_catalog
+import group_mask
+
+COLUMNS = ["subject", "session", "group", "analysis", "contrast", "label", "label_name",
+           "n_voxels", "n_data", "mean", "median"]
+GRID_ATTRIBUTES = ["DATASET_DIMENSIONS", "ORIENT_SPECIFIC", "ORIGIN", "DELTA"]
+
+
+def read_label_names(path):
+    """Reads 'index name' lines (TSV or whitespace separated, '#' comments allowed) into {index: name}."""
+    names = {}
+    if not path:
+        return names
+    with open(path) as f:
+        for line in f:
+            parts = line.split("#", 1)[0].split(None, 1)
+            if len(parts) == 2 and parts[0].isdigit():
+                names[int(parts[0])] = parts[1].strip()
+    return names
+
+
+def resample_labels(atlas_attrs, atlas, target_attrs):
+    """Nearest-neighbour atlas labels on the target grid (flat, AFNI voxel order). Outside the atlas is 0."""
+    nx, ny, nz = afni_io.dims(target_attrs)
+    k, j, i = np.meshgrid(np.arange(nz), np.arange(ny), np.arange(nx), indexing="ij")
+    xyz = afni_io.ijk_to_xyz(target_attrs, np.stack([i.ravel(), j.ravel(), k.ravel()], axis=1))
+    ijk = np.rint(afni_io.xyz_to_ijk(atlas_attrs, xyz)).astype(int)
+    ax, ay, az = afni_io.dims(atlas_attrs)
+    inside = (ijk >= 0).all(axis=1) & (ijk < [ax, ay, az]).all(axis=1)
+    labels = np.zeros(len(xyz), dtype=np.int32)
+    labels[inside] = atlas[ijk[inside, 0] + ax * (ijk[inside, 1] + ay * ijk[inside, 2])]
+    return labels
+
+
+def grid_geometry(attrs):
+    return tuple(tuple(round(v, 3) if isinstance(v, float) else v for v in attrs[name][:3]) for name in GRID_ATTRIBUTES)
+
+
+@lru_cache(maxsize=4)
+def atlas_on_grid(atlas_path, geometry):
+    """Atlas labels on the grid described by geometry (a hashable tuple of grid_geometry), cached per process."""
+    target_attrs = dict(zip(GRID_ATTRIBUTES, (list(value) for value in geometry)))
+    atlas_attrs, atlas = afni_io.load_dataset(atlas_path)
+    atlas = np.rint(np.asarray(atlas[0])).astype(np.int32)
+    if grid_geometry(atlas_attrs) == geometry:
+        return atlas
+    return resample_labels(atlas_attrs, atlas, target_attrs)
+
+
+def label_stats(labels, values, n_labels):
+    """(n_voxels, n_data, mean, median) per label 0..n_labels-1 of one volume, in one vectorized pass."""
+    n_voxels = np.bincount(labels, minlength=n_labels)
+    has_data = (labels > 0) & (values != 0) & np.isfinite(values)
+    lab, val = labels[has_data], values[has_data].astype(np.float64)
+    n_data = np.bincount(lab, minlength=n_labels)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.bincount(lab, weights=val, minlength=n_labels) / n_data
+    # Sorting by (label, value) puts each label's values in order; the median sits in the middle of its run.
+    ordered = val[np.lexsort((val, lab))]
+    starts = np.concatenate([[0], np.cumsum(n_data)[:-1]])
+    median = np.full(n_labels, np.nan)
+    present = n_data > 0
+    lower = starts[present] + (n_data[present] - 1) // 2
+    upper = starts[present] + n_data[present] // 2
+    median[present] = (ordered[lower] + ordered[upper]) / 2
+    return n_voxels, n_data, mean, median
+
+
+def extract_dataset(dataset, contrasts, atlas_path, label_values, label_names):
+    """ROI rows of one dataset for every contrast it contains."""
+    attrs = afni_io.read_head(dataset)
+    available = [c for c in contrasts if c in afni_io.brick_labels(attrs)]
+    if not available:
+        return []
+    labels = atlas_on_grid(atlas_path, grid_geometry(attrs))
+    _, data = afni_io.load_dataset(f"{dataset}[{','.join(available)}]")
+    n_labels = max(int(labels.max()), max(label_values)) + 1
+    rows = []
+    for n, contrast in enumerate(available):
+        n_voxels, n_data, mean, median = label_stats(labels, np.asarray(data[n]), n_labels)
+        for label in label_values:
+            rows.append({"contrast": contrast, "label": label, "label_name": label_names.get(label, f"label_{label}"),
+                         "n_voxels": int(n_voxels[label]), "n_data": int(n_data[label]),
+                         "mean": mean[label], "median": median[label]})
+    return rows
+
+
+def atlas_hash(path):
+    if not afni_io.is_nifti(path):
+        return group_mask.dataset_hash(path)[:16]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def extract(output_dir, analysis, atlas_path, contrasts=None, label_names_path=None, groups=None, n_procs=None):
+    """Refreshes the ROI table of one analysis and atlas. Returns (table path, number of datasets processed)."""
+    catalog = derivatives_catalog.refresh(output_dir, [analysis])
+    entries = {key: entry for key, entry in catalog["datasets"].items()
+               if entry["analysis"] == analysis and key == derivatives_catalog.stats_key(entry["subject"], entry["session"], analysis)}
+    if contrasts is None:
+        contrasts = sorted({label for entry in entries.values() for label in entry["labels"] if re.search(r"#0_Coef$", label)})
+
+    _, atlas = afni_io.load_dataset(atlas_path)
+    label_values = sorted(int(v) for v in np.unique(np.rint(np.asarray(atlas[0]))) if v > 0)
+    label_names = read_label_names(label_names_path)
+
+    roi_dir = os.path.join(output_dir, "roi")
+    os.makedirs(roi_dir, exist_ok=True)
+    atlas_name = re.sub(r"(\.nii(\.gz)?|\+\w+(\.HEAD)?)$", "", os.path.basename(atlas_path))
+    table_path = os.path.join(roi_dir, f"{atlas_name}_{analysis}.tsv")
+    state_path = table_path + ".state.json"
+
+    # The state records what every dataset's rows were computed from; a different atlas or contrast list redoes all.
+    settings = {"atlas": atlas_hash(atlas_path), "contrasts": contrasts, "label_names": label_names}
+    state = {"settings": None, "datasets": {}}
+    if os.path.exists(state_path) and os.path.exists(table_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    if state["settings"] != json.loads(json.dumps(settings)):
+        state = {"settings": settings, "datasets": {}}
+        table = pd.DataFrame(columns=COLUMNS)
+    else:
+        table = pd.read_csv(table_path, sep="\t", dtype={"session": str}, keep_default_na=False, na_values=[""])
+
+    # Rows of changed and deleted datasets are dropped; changed and new datasets are (re)extracted.
+    todo = [key for key, entry in entries.items() if state["datasets"].get(key, {}).get("head") != entry["head"]]
+    stale = {(done["subject"], done["session"]) for key, done in state["datasets"].items()
+             if key not in entries or key in todo}
+    if len(table):
+        table = table[[(subject, session) not in stale for subject, session in zip(table["subject"], table["session"])]]
+
+    worker = partial(extract_dataset, contrasts=contrasts, atlas_path=atlas_path,
+                     label_values=label_values, label_names=label_names)
+    datasets = [os.path.join(output_dir, key[:-len(".HEAD")]) for key in todo]
+    new_rows = []
+    with ProcessPoolExecutor(max_workers=n_procs) as executor:
+        for key, rows in zip(todo, executor.map(worker, datasets)):
+            entry = entries[key]
+            for row in rows:
+                row.update(subject=entry["subject"], session=entry["session"],
+                           group=(groups or {}).get(entry["subject"], "NA"), analysis=analysis)
+            new_rows.extend(rows)
+            state["datasets"][key] = {"subject": entry["subject"], "session": entry["session"], "head": entry["head"]}
+    state["datasets"] = {key: done for key, done in state["datasets"].items() if key in entries}
+
+    if new_rows:
+        new_table = pd.DataFrame(new_rows, columns=COLUMNS)
+        table = pd.concat([table, new_table], ignore_index=True) if len(table) else new_table
+    if groups:
+        table["group"] = [groups.get(subject, "NA") for subject in table["subject"]]
+    table = table.sort_values(["subject", "session", "contrast", "label"], kind="stable")
+    tmp_path = table_path + ".tmp"
+    table.to_csv(tmp_path, sep="\t", index=False, columns=COLUMNS, float_format="%.6g")
+    os.replace(tmp_path, table_path)
+    with open(state_path, "w") as f:
+        json.dump(state, f, indent=1)
+    return table_path, len(todo)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract atlas ROI statistics from every stats dataset of an analysis.")
+    parser.add_argument("--output", required=True, help="Pipeline output_dir.")
+    parser.add_argument("--analysis", required=True, help="First-level analysis.")
+    parser.add_argument("--atlas", required=True, help="Integer label volume in MNI space (NIfTI or AFNI).")
+    parser.add_argument("--label_names", help="Optional 'index name' table of the atlas labels.")
+    parser.add_argument("--contrast", nargs="+", help="Sub-brick labels to extract (default: all '#0_Coef' sub-bricks).")
+    parser.add_argument("--config", help="main_config.toml, to add each subject's group to the table.")
+    parser.add_argument("--n_procs", type=int, default=None, help="Datasets processed in parallel (default: all cores).")
+    args = parser.parse_args()
+
+    groups = None
+    if args.config:
+        import toml
+        groups = {s["id"]: s.get("group", "NA") for s in toml.load(args.config).get("subjects", [])}
+    table_path, n_done = extract(args.output, args.analysis, args.atlas, args.contrast, args.label_names, groups, args.n_procs)
+    print(f"Processed {n_done} new or changed datasets. Table: {table_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+Cohort SCR feature warehouse.
+
+Builds a tidy per-subject/per-event table from the Ledalab ERA exports (and pain ratings for the TIM task),
+together with precomputed per-subject aggregates, and caches everything on disk. Subjects are only reloaded
+when one of their input files changed, so notebooks can open the cohort in seconds:
+
+    import scr_features
+    warehouse = scr_features.build_warehouse("~/Downloads/tim_data", task="war")
+    warehouse["events"], warehouse["by_emotion"], warehouse["by_image"], warehouse["by_bin"]
+"""
+
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+CACHE_VERSION = 2
+
+# Ledalab ERA measures kept in the tables. "Phasic" is derived as Global.Mean - CDA.Tonic.
+MEASURES = ["CDA.nSCR", "CDA.Latency", "CDA.AmpSum", "CDA.SCR", "CDA.ISCR", "CDA.PhasicMax", "CDA.Tonic",
+            "TTP.nSCR", "TTP.Latency", "TTP.AmpSum", "Global.Mean", "Global.MaxDeflection", "Phasic"]
+
+WAR_EVENTS = [31, 32, 33, 34,
+              51, 52, 53, 54,
+              71, 72, 73, 74]
+WAR_BLOCK_EVENTS = [31, 51, 71]
+EMOTIONS = np.array(["", "Negative", "Neutral", "Positive"])
+
+TIM_EVENTS = [21, 22, 23, 24, 25, 26,
+              41, 42, 43, 44, 45, 46,
+              81, 82, 83, 84, 85, 86]
+TIM_PAIN_EVENTS = [26, 46, 86]
+COLORS = np.array(["", "Green", "Yellow", "", "Red"])
+
+TASKS = {
+    "war": {"inputs": ["{subject}_era_4s.txt", "{subject}_era_aggregated.txt"]},
+    "tim": {"inputs": ["{subject}_era_2s.txt", "{subject}_era_4s.txt", "*Pain*.csv"]},
+}
+
+
+def read_era(path, events):
+    if not os.path.exists(path):
+        return None
+    df = pd.read_csv(path, sep="\t")
+    df = df[df["Event.Name"].isin(events)].copy()
+    if "Global.Mean" in df and "CDA.Tonic" in df:
+        df["Phasic"] = df["Global.Mean"] - df["CDA.Tonic"]
+    return df
+
+
+def measure_columns(df):
+    return [m for m in MEASURES if m in df.columns]
+
+
+def load_war_subject(subject_dir, subject):
+    """Returns the per-event and per-bin tables for one WAR subject."""
+    codes_df = read_era(os.path.join(subject_dir, f"{subject}_era_4s.txt"), WAR_EVENTS)
+    events = pd.DataFrame()
+    if codes_df is not None:
+        codes = codes_df["Event.Name"].to_numpy().astype(int)
+        events = codes_df[["Event.Name"] + measure_columns(codes_df)].copy()
+        events.insert(0, "Subject", subject)
+        events.insert(2, "Emotion", EMOTIONS[codes // 20])
+        events.insert(3, "Image", codes % 10)
+        events.insert(4, "Trial", np.arange(len(events)))
+
+    binned_df = read_era(os.path.join(subject_dir, f"{subject}_era_aggregated.txt"), WAR_BLOCK_EVENTS)
+    bins = pd.DataFrame()
+    if binned_df is not None:
+        codes = binned_df["Event.Name"].to_numpy().astype(int)
+        bins = binned_df[["Event.Name", "Bin"] + measure_columns(binned_df)].copy()
+        bins.insert(0, "Subject", subject)
+        bins.insert(2, "Emotion", EMOTIONS[codes // 20])
+
+    return {"events": events, "bins": bins}
+
+
+def load_tim_subject(subject_dir, subject):
+    """Returns the per-event table (2s anticipation window and 4s pain window with ratings) for one TIM subject."""
+    tables = []
+    anticipation_df = read_era(os.path.join(subject_dir, f"{subject}_era_2s.txt"), TIM_EVENTS)
+    if anticipation_df is not None:
+        anticipation_df["Window"] = "2s"
+        tables.append(anticipation_df)
+
+    pain_df = read_era(os.path.join(subject_dir, f"{subject}_era_4s.txt"), TIM_PAIN_EVENTS)
+    if pain_df is not None:
+        pain_df["Window"] = "4s"
+        pain_df["Rating"] = np.nan
+        rating_files = sorted(glob.glob(os.path.join(subject_dir, "*Pain*.csv")))
+        if rating_files:
+            ratings = pd.read_csv(rating_files[0])["Pain"].to_numpy()
+            # Ratings belong to the last pain events, as in era_to_timing.get_pain_scr_timing_file
+            n = min(len(ratings), len(pain_df))
+            if n:
+                pain_df.iloc[len(pain_df) - n:, pain_df.columns.get_loc("Rating")] = ratings[len(ratings) - n:]
+        tables.append(pain_df)
+
+    if not tables:
+        return {"events": pd.DataFrame()}
+
+    df = pd.concat(tables, ignore_index=True)
+    codes = df["Event.Name"].to_numpy().astype(int)
+    columns = ["Event.Name", "Window"] + measure_columns(df) + (["Rating"] if "Rating" in df else [])
+    events = df[columns].copy()
+    events.insert(0, "Subject", subject)
+    events.insert(2, "Color", COLORS[codes // 20])
+    events.insert(3, "Step", codes % 10)
+    return {"events": events}
+
+
+LOADERS = {"war": load_war_subject, "tim": load_tim_subject}
+
+
+def input_signature(subject_dir, subject, task):
+    """Size and mtime of every input file of a subject. Used to detect which subjects changed."""
+    signature = {}
+    for pattern in TASKS[task]["inputs"]:
+        for path in sorted(glob.glob(os.path.join(subject_dir, pattern.format(subject=subject)))):
+            stat = os.stat(path)
+            signature[os.path.basename(path)] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+def load_subject(job):
+    subject_dir, subject, task = job
+    return subject, LOADERS[task](subject_dir, subject)
+
+
+def compute_aggregates(tables, task):
+    """Per-subject means by emotion, image index and bin (WAR), or by pain level and step (TIM)."""
+    events = tables["events"]
+    aggregates = {}
+    if events.empty:
+        return aggregates
+    measures = measure_columns(events)
+    if task == "war":
+        aggregates["by_emotion"] = events.groupby(["Subject", "Emotion"], as_index=False)[measures].mean()
+        aggregates["by_image"] = events.groupby(["Subject", "Emotion", "Image"], as_index=False)[measures].mean()
+        bins = tables.get("bins", pd.DataFrame())
+        if not bins.empty:
+            aggregates["by_bin"] = bins.groupby(["Subject", "Emotion", "Bin"], as_index=False)[measure_columns(bins)].mean()
+    else:
+        values = measures + (["Rating"] if "Rating" in events else [])
+        pain = events[(events["Window"] == "4s") & events["Event.Name"].isin(TIM_PAIN_EVENTS)]
+        aggregates["by_pain_level"] = pain.groupby(["Subject", "Color"], as_index=False)[values].mean()
+        aggregates["by_step"] = events.groupby(["Subject", "Window", "Color", "Step"], as_index=False)[values].mean()
+    return aggregates
+
+
+def find_subjects(data_dir, subject_prefix=None, exclude=()):
+    subjects = []
+    for name in sorted(os.listdir(data_dir)):
+        if not os.path.isdir(os.path.join(data_dir, name)) or not name.startswith("sub-"):
+            continue
+        if subject_prefix and not name.startswith(subject_prefix):
+            continue
+        if name in exclude:
+            continue
+        subjects.append(name)
+    return subjects
+
+
+def build_warehouse(data_dir, task="war", cache_dir=None, subject_prefix=None, exclude=(), n_procs=None, force=False):
+    """
+    Builds or incrementally refreshes the cohort tables for `task` ("war" or "tim") and returns them as a dict
+    of DataFrames ("events", "bins" and the aggregate tables). Only subjects whose ERA/rating files changed since
+    the last call are reloaded, in parallel across `n_procs` processes.
+    """
+    data_dir = os.path.expanduser(data_dir)
+    cache_dir = os.path.expanduser(cache_dir or os.path.join(data_dir, f".scr_warehouse_{task}"))
+    subjects_cache = os.path.join(cache_dir, "subjects")
+    os.makedirs(subjects_cache, exist_ok=True)
+
+    manifest_path = os.path.join(cache_dir, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path) and not force:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("version") != CACHE_VERSION:
+            manifest = {}
+    cached_signatures = manifest.get("subjects", {})
+
+    subjects = find_subjects(data_dir, subject_prefix, exclude)
+    signatures = {s: input_signature(os.path.join(data_dir, s), s, task) for s in subjects}
+    stale = [s for s in subjects
+             if cached_signatures.get(s) != signatures[s]
+             or not os.path.exists(os.path.join(subjects_cache, f"{s}.pkl"))]
+
+    if stale:
+        print(f"Loading {len(stale)} of {len(subjects)} subjects...")
+        jobs = [(os.path.join(data_dir, s), s, task) for s in stale]
+        if n_procs != 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=n_procs) as executor:
+                results = list(executor.map(load_subject, jobs))
+        else:
+            results = [load_subject(job) for job in jobs]
+        for subject, tables in results:
+            pd.to_pickle(tables, os.path.join(subjects_cache, f"{subject}.pkl"))
+
+    combined_path = os.path.join(cache_dir, "warehouse.pkl")
+    up_to_date = not stale and set(cached_signatures) == set(subjects) and os.path.exists(combined_path)
+    if up_to_date:
+        return pd.read_pickle(combined_path)
+
+    per_subject = [pd.read_pickle(os.path.join(subjects_cache, f"{s}.pkl")) for s in subjects]
+    warehouse = {}
+    for name in ["events", "bins"]:
+        frames = [tables[name] for tables in per_subject if not tables.get(name, pd.DataFrame()).empty]
+        if frames:
+            warehouse[name] = pd.concat(frames, ignore_index=True)
+    if "events" in warehouse:
+        warehouse.update(compute_aggregates(warehouse, task))
+
+    pd.to_pickle(warehouse, combined_path)
+    with open(manifest_path, "w") as f:
+        json.dump({"version": CACHE_VERSION, "task": task, "subjects": signatures}, f, indent=2)
+    return warehouse
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or refresh the cohort SCR feature warehouse.")
+    parser.add_argument("data_dir", help="Directory with one folder per subject containing the Ledalab ERA exports.")
+    parser.add_argument("--task", choices=list(TASKS), default="war", help="Task whose ERA files are loaded.")
+    parser.add_argument("--cache_dir", help="Cache directory. Defaults to <data_dir>/.scr_warehouse_<task>.")
+    parser.add_argument("--subject_prefix", help="Only include subjects starting with this prefix (e.g. sub-AL).")
+    parser.add_argument("--exclude", nargs="*", default=[], help="Subjects to leave out.")
+    parser.add_argument("--n_procs", type=int, default=None, help="Number of subjects to load in parallel.")
+    parser.add_argument("--export", help="Optional directory to write every table as TSV.")
+    parser.add_argument("--force", action="store_true", help="Ignore the cache and reload every subject.")
+    args = parser.parse_args()
+
+    warehouse = build_warehouse(args.data_dir, args.task, args.cache_dir, args.subject_prefix,
+                                args.exclude, args.n_procs, args.force)
+    for name, table in warehouse.items():
+        print(f"{name}: {len(table)} rows")
+        if args.export:
+            os.makedirs(args.export, exist_ok=True)
+            table.to_csv(os.path.join(args.export, f"scr_{args.task}_{name}.tsv"), sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    main()
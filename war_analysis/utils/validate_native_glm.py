@@ -0,0 +1,193 @@
+"""
+Validates the native GLM backend on a synthetic dataset.
+
+Builds a small two-run dataset with known block responses, drift, motion-like nuisance, censored volumes and
+AR(1) noise, fits it with native_glm, and compares the bucket against:
+  - 3dDeconvolve run on the same inputs, when AFNI is on the PATH (coefficients and t-statistics per label);
+  - the simulated ground truth otherwise (AR(1) coefficients, scaled by their standard errors).
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+
+import afni_io
+import native_glm
+
+TR = 2.0
+RUN_LENGTHS = [150, 150]
+# Past the 1000-voxel chunk floor of native_glm several times, so max_memory_mb=1 fits it in several chunks.
+DIMS = (24, 20, 16)
+MODEL = {
+    "stim_files": ["neg_blck.1D", "neut_blck.1D"],
+    "stim_labels": ["neg_blck", "neut_blck"],
+    "basis": "BLOCK(22,1)",
+    "glt": [{"label": "neg-neut", "sym": "SYM: neg_blck -neut_blck"}],
+}
+
+
+def legendre_baseline(run_lengths, polort):
+    """Per-run Legendre polynomials, as 3dDeconvolve -polort builds them."""
+    columns = []
+    for run, n_time in enumerate(run_lengths):
+        x = np.linspace(-1, 1, n_time)
+        for order in range(polort + 1):
+            column = np.zeros(sum(run_lengths))
+            start = sum(run_lengths[:run])
+            column[start:start + n_time] = np.polynomial.legendre.Legendre.basis(order)(x)
+            columns.append(column)
+    return np.column_stack(columns)
+
+
+def make_synthetic(work_dir, seed=0):
+    rng = np.random.default_rng(seed)
+    n_total, n_vox = sum(RUN_LENGTHS), int(np.prod(DIMS))
+
+    # Timing: alternating negative/neutral blocks, 22s each with 22s rest, in both runs
+    timing_dir = os.path.join(work_dir, "func")
+    os.makedirs(timing_dir)
+    onsets = {"neg_blck": [], "neut_blck": []}
+    for n_time in RUN_LENGTHS:
+        times = np.arange(10.0, n_time * TR - 44, 44.0)
+        onsets["neg_blck"].append(times[::2])
+        onsets["neut_blck"].append(times[1::2])
+    for label, runs in onsets.items():
+        with open(os.path.join(timing_dir, f"{label}.1D"), "w") as f:
+            f.write("\n".join(" ".join(f"{t:g}" for t in run) for run in runs) + "\n")
+
+    # Ground truth
+    baseline = {"run_lengths": RUN_LENGTHS, "tr": TR}
+    design = native_glm.build_design(MODEL, timing_dir, baseline)
+    motion = rng.standard_normal((n_total, 3)).cumsum(axis=0) * 0.05
+    motion -= motion.mean(axis=0)
+    polort = 1 + int(sum(RUN_LENGTHS) * TR / len(RUN_LENGTHS) / 150)
+    nuisance = np.column_stack([legendre_baseline(RUN_LENGTHS, polort), motion])
+
+    betas = rng.normal(0, 1.5, (2, n_vox))
+    betas[:, rng.random(n_vox) < 0.5] = 0
+    drift = rng.normal(0, 0.5, (nuisance.shape[1], n_vox))
+    drift[0] = 100
+    noise = rng.standard_normal((n_total, n_vox))
+    for t in range(1, n_total):
+        if t not in np.cumsum(RUN_LENGTHS):
+            noise[t] += 0.3 * noise[t - 1]
+    Y = nuisance @ drift + design["stims"] @ betas + noise
+    Y[:, :10] = 0  # some empty voxels outside the brain
+
+    template = {
+        "DATASET_DIMENSIONS": list(DIMS) + [0, 0],
+        "ORIENT_SPECIFIC": [0, 3, 4],
+        "ORIGIN": [-20.0, -20.0, -10.0],
+        "DELTA": [3.0, 3.0, 3.0],
+        "SCENE_DATA": [2, 0, 0],
+    }
+    dsets, start = [], 0
+    for run, n_time in enumerate(RUN_LENGTHS):
+        labels = [f"#{i}" for i in range(n_time)]
+        dsets.append(afni_io.write_dataset(os.path.join(work_dir, f"pb05.synth.r{run + 1:02d}.scale"),
+                                           Y[start:start + n_time], template, labels) + ".HEAD")
+        start += n_time
+
+    censor = np.ones(n_total)
+    censor[rng.choice(n_total, 12, replace=False)] = 0
+
+    baseline_dir = os.path.join(work_dir, "baseline")
+    os.makedirs(baseline_dir)
+    np.savetxt(os.path.join(baseline_dir, "X.nuisance.nocensor.xmat.1D"), nuisance, fmt="%.8g")
+    np.savetxt(os.path.join(baseline_dir, "motion.1D"), motion, fmt="%.8g")
+    np.savetxt(os.path.join(baseline_dir, "censor.1D"), censor, fmt="%d")
+    with open(os.path.join(baseline_dir, "baseline.json"), "w") as f:
+        json.dump({
+            "tr": TR,
+            "run_lengths": RUN_LENGTHS,
+            "dsets": dsets,
+            "censor_file": os.path.join(baseline_dir, "censor.1D"),
+            "nuisance_xmat": os.path.join(baseline_dir, "X.nuisance.nocensor.xmat.1D"),
+        }, f, indent=2)
+    return timing_dir, baseline_dir, betas, polort
+
+
+def run_3ddeconvolve(work_dir, timing_dir, baseline_dir, polort):
+    with open(os.path.join(baseline_dir, "baseline.json")) as f:
+        baseline = json.load(f)
+    cmd = ["3dDeconvolve", "-input"] + baseline["dsets"] + [
+        "-censor", baseline["censor_file"],
+        "-ortvec", os.path.join(baseline_dir, "motion.1D"), "motion",
+        "-polort", str(polort), "-float",
+        "-num_stimts", str(len(MODEL["stim_files"]))]
+    for k, (stim_file, label) in enumerate(zip(MODEL["stim_files"], MODEL["stim_labels"]), 1):
+        cmd += ["-stim_times", str(k), os.path.join(timing_dir, stim_file), MODEL["basis"], "-stim_label", str(k), label]
+    cmd += ["-num_glt", str(len(MODEL["glt"]))]
+    for k, glt in enumerate(MODEL["glt"], 1):
+        cmd += ["-gltsym", glt["sym"], "-glt_label", str(k), glt["label"]]
+    cmd += ["-fout", "-tout", "-bucket", os.path.join(work_dir, "stats.afni")]
+    subprocess.run(cmd, check=True, cwd=work_dir, stdout=subprocess.DEVNULL)
+    return os.path.join(work_dir, "stats.afni+tlrc")
+
+
+def compare(native_path, reference_path):
+    native_attrs, native = afni_io.load_dataset(native_path)
+    reference_attrs, reference = afni_io.load_dataset(reference_path)
+    reference_labels = afni_io.brick_labels(reference_attrs)
+    ok = True
+    for index, label in enumerate(afni_io.brick_labels(native_attrs)):
+        if label not in reference_labels:
+            print(f"  {label:<24} missing from the 3dDeconvolve bucket")
+            ok = False
+            continue
+        a, b = np.asarray(native[index]), np.asarray(reference[reference_labels.index(label)])
+        error = np.max(np.abs(a - b)) / max(np.max(np.abs(b)), 1e-6)
+        ok &= error < 1e-2
+        print(f"  {label:<24} max relative difference {error:.2e}")
+    for label in reference_labels:
+        if label not in afni_io.brick_labels(native_attrs):
+            print(f"  {label:<24} missing from the native bucket")
+            ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate the native GLM backend against 3dDeconvolve on synthetic data.")
+    parser.add_argument("--work_dir", help="Directory for the synthetic data. Defaults to a temporary directory.")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic data and outputs.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="native_glm_")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        timing_dir, baseline_dir, betas, polort = make_synthetic(work_dir, args.seed)
+        baseline = native_glm.load_baseline(baseline_dir)
+        native_path, reml_path = native_glm.fit_model(MODEL, timing_dir, baseline, os.path.join(work_dir, "native"),
+                                                      "synth", noise_model="ar1", max_memory_mb=1)
+
+        if shutil.which("3dDeconvolve"):
+            print("Comparing against 3dDeconvolve:")
+            ok = compare(native_path, run_3ddeconvolve(work_dir, timing_dir, baseline_dir, polort))
+        else:
+            # Without AFNI, check that the AR(1) fit recovers the betas within its own standard errors
+            print("3dDeconvolve not found. Comparing the AR(1) fit against the simulated betas:")
+            attrs, stats = afni_io.load_dataset(reml_path)
+            labels = afni_io.brick_labels(attrs)
+            ok = True
+            for k, label in enumerate(MODEL["stim_labels"]):
+                coef = np.asarray(stats[labels.index(f"{label}#0_Coef")])[10:]
+                tstat = np.asarray(stats[labels.index(f"{label}#0_Tstat")])[10:]
+                z = (coef - betas[k, 10:]) * tstat / coef
+                ok &= np.mean(z ** 2) < 1.5
+                print(f"  {label}#0_Coef  mean squared z-error {np.mean(z ** 2):.2f} (expected ~1)")
+        print("PASSED" if ok else "FAILED")
+        if not ok:
+            raise SystemExit(1)
+    finally:
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()